@@ -7,7 +7,7 @@ from sqlmodel import SQLModel, create_engine
 from sqlmodel.ext.asyncio.session import AsyncEngine
 
 from alembic import context
-from kookaburra.models import GitHubUser, Llm  # noqa
+from kookaburra.models import DeployJob, GitHubUser, Llm, SmsJob  # noqa
 from kookaburra.settings import env
 
 # this is the Alembic Config object, which provides
@@ -1,6 +1,8 @@
 import base64
+import secrets
 import urllib.parse
 from datetime import datetime
+from typing import List
 
 from authlib.integrations.httpx_client import AsyncOAuth2Client
 from fastapi import (
@@ -11,9 +13,10 @@ from fastapi import (
     Request,
     Response,
 )
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse
 from pydantic import UUID4
 from sqlmodel.ext.asyncio.session import AsyncSession
+from starlette.background import BackgroundTask
 
 from kookaburra import __version__
 from kookaburra.const import (
@@ -21,20 +24,29 @@ from kookaburra.const import (
     KB_AUTH_TOKEN,
     KB_AUTH_TOKEN_EXPIRE_SECONDS,
     LOCAL_DOMAINS,
+    SMS_INGEST_QUEUE,
 )
 from kookaburra.db import psql_db
+from kookaburra.deploy_jobs import deploy_job_svc
 from kookaburra.gh import gh_svc
-from kookaburra.gs import gs_svc
 from kookaburra.llm import llm_svc
 from kookaburra.log import log
-from kookaburra.models import GitHubUserCreate
+from kookaburra.metrics import metrics
+from kookaburra.models import (
+    DeployJobLogRead,
+    DeployJobRead,
+    GitHubUserCreate,
+    LlmUpdate,
+)
 from kookaburra.settings import env
-from kookaburra.twilio import twilio_svc
+from kookaburra.sms import sms_svc
 from kookaburra.types import (
     BaseResponse,
+    ChatRequest,
     GitHubToken,
     GitHubUserAuthToken,
     HealthResponse,
+    MetricsResponse,
     SMSResponse,
 )
 from kookaburra.user import githubuser_svc
@@ -60,6 +72,11 @@ llm_router = APIRouter(
     tags=["llm"],
     prefix=API_V0,
 )
+deploy_router = APIRouter(
+    route_class=_APIRoute,
+    tags=["deploy"],
+    prefix=API_V0,
+)
 
 
 @health_router.get(
@@ -79,6 +96,28 @@ async def get_health() -> HealthResponse:
     )
 
 
+@health_router.get(
+    "/metrics",
+    response_model=MetricsResponse,
+)
+async def get_metrics(request: Request) -> MetricsResponse:
+    """Get the metrics of this server process.
+
+    They cover every llm, so they need the `METRICS_TOKEN` as a bearer token.
+    Returns:
+        MetricsResponse: The counters and gauges of this process.
+    """
+    authorization = request.headers.get("Authorization", "").encode("utf8")
+    if not env.METRICS_TOKEN or not secrets.compare_digest(
+        authorization, f"Bearer {env.METRICS_TOKEN}".encode("utf8")
+    ):
+        raise HTTPException(
+            status_code=403,
+            detail="Forbidden.",
+        )
+    return MetricsResponse(metrics=metrics.snapshot())
+
+
 @sms_router.post(
     "/sms",
     response_model=SMSResponse,
@@ -109,28 +148,21 @@ async def send_message(
         log.error(f"Could not find LLM for phone number {body['To']}")
         return SMSResponse(message="🪶")
 
-    chat_history = await gs_svc.get_sms_chat_history(
-        llm,
-        body["From"],
-    )
+    # a stopped llm is redeployed before it can reply, which a queued job
+    # waits for, see `sms_svc.hold`
+    if env.SMS_INGEST_MODE == SMS_INGEST_QUEUE or llm.idle_stopped_at is not None:
+        # acknowledge straight away, a worker will generate and send the reply
+        await sms_svc.enqueue(
+            llm=llm,
+            body=body,
+            psql=psql,
+        )
+        return SMSResponse(message="🪶")
 
-    response = await llm_svc.respond(
+    await sms_svc.reply(
         llm=llm,
-        message=body["Body"],
-        chat_history=chat_history,
-    )
-
-    bgt.add_task(
-        gs_svc.upload_sms_chat,
-        llm,
-        body,
-        response,
-    )
-
-    twilio_svc.send_message(
-        from_number=body["To"],
-        to_number=body["From"],
-        message=response.message,
+        body=body,
+        bgt=bgt,
     )
     return SMSResponse(message="🪶")
 
@@ -246,13 +278,86 @@ async def wh_github(
             status_code=403,
             detail="You are waitlisted!",
         )
-    await gh_svc.handle_webhook(  # pragma: no cover
+    if not await gh_svc.is_push(headers=dict(headers)):
+        return Response(status_code=200)
+    # deploys outlast GitHub's webhook timeout, so a worker runs them
+    await deploy_job_svc.enqueue(
+        user=user,
         request=dict(request),
-        headers=dict(headers),
         psql=psql,
-        user=user,
     )
-    return Response(status_code=200)  # pragma: no cover
+    return Response(status_code=202)
+
+
+@llm_router.patch(
+    "/llm/{llm_id}",
+    response_model=BaseResponse,
+)
+async def update(
+    llm_id: UUID4,
+    llm_update: LlmUpdate,
+    request: Request,
+    psql: AsyncSession = Depends(psql_db),
+) -> BaseResponse:
+    current_githubuser = await githubuser_svc.get_current_user(
+        request=request,
+        psql=psql,
+    )
+    if not current_githubuser:
+        raise HTTPException(
+            status_code=403,
+            detail="Please sign up!",
+        )
+    await llm_svc.update(
+        llm_id=llm_id,
+        githubuser_id=current_githubuser.id,
+        llm_update=llm_update,
+        psql=psql,
+    )
+    return BaseResponse(message="🪶")
+
+
+@llm_router.post(
+    "/llm/{llm_id}/chat",
+    response_class=StreamingResponse,
+)
+async def chat(
+    llm_id: UUID4,
+    chat_request: ChatRequest,
+    request: Request,
+    psql: AsyncSession = Depends(psql_db),
+) -> StreamingResponse:
+    current_githubuser = await githubuser_svc.get_current_user(
+        request=request,
+        psql=psql,
+    )
+    if not current_githubuser:
+        raise HTTPException(
+            status_code=403,
+            detail="Please sign up!",
+        )
+    llm = await llm_svc.get_for_user(
+        llm_id=llm_id,
+        githubuser_id=current_githubuser.id,
+        psql=psql,
+    )
+    if llm is None:
+        raise HTTPException(
+            status_code=400,
+            detail="Bad request.",
+        )
+    response = await llm_svc.stream(
+        llm=llm,
+        message=chat_request.message,
+        chat_history=chat_request.chat_history,
+    )
+    # relay the server-sent events as they arrive, without buffering
+    return StreamingResponse(
+        response.aiter_raw(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(response.aclose),
+    )
 
 
 @llm_router.delete(
@@ -281,3 +386,84 @@ async def delete(
     )
     response.headers["HX-Location"] = "/"
     return BaseResponse(message="🪶")
+
+
+@llm_router.post(
+    "/llm/{llm_id}/rollback",
+    response_model=BaseResponse,
+)
+async def rollback(
+    llm_id: UUID4,
+    request: Request,
+    psql: AsyncSession = Depends(psql_db),
+) -> BaseResponse:
+    current_githubuser = await githubuser_svc.get_current_user(
+        request=request,
+        psql=psql,
+    )
+    if not current_githubuser:
+        raise HTTPException(
+            status_code=403,
+            detail="Please sign up!",
+        )
+    await llm_svc.rollback(
+        llm_id=llm_id,
+        githubuser_id=current_githubuser.id,
+        psql=psql,
+    )
+    return BaseResponse(message="🪶")
+
+
+@deploy_router.get(
+    "/deploys",
+    response_model=List[DeployJobRead],
+)
+async def list_deploys(
+    request: Request,
+    psql: AsyncSession = Depends(psql_db),
+) -> List[DeployJobRead]:
+    current_githubuser = await githubuser_svc.get_current_user(
+        request=request,
+        psql=psql,
+    )
+    if not current_githubuser:
+        raise HTTPException(
+            status_code=403,
+            detail="Please sign up!",
+        )
+    jobs = await deploy_job_svc.list_for_user(
+        user=current_githubuser,
+        psql=psql,
+    )
+    return [DeployJobRead.from_orm(job) for job in jobs]
+
+
+@deploy_router.get(
+    "/deploys/{job_id}",
+    response_model=DeployJobLogRead,
+)
+async def get_deploy(
+    job_id: UUID4,
+    request: Request,
+    psql: AsyncSession = Depends(psql_db),
+) -> DeployJobLogRead:
+    current_githubuser = await githubuser_svc.get_current_user(
+        request=request,
+        psql=psql,
+    )
+    if not current_githubuser:
+        raise HTTPException(
+            status_code=403,
+            detail="Please sign up!",
+        )
+    job = await deploy_job_svc.get_for_user(
+        job_id=job_id,
+        githubuser_id=current_githubuser.id,
+        psql=psql,
+    )
+    if job is None:
+        raise HTTPException(
+            status_code=400,
+            detail="Bad request.",
+        )
+    return DeployJobLogRead.from_orm(job)
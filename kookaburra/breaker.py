@@ -0,0 +1,115 @@
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from kookaburra.const import BREAKER_CLOSED, BREAKER_HALF_OPEN, BREAKER_OPEN
+from kookaburra.log import log
+from kookaburra.metrics import metrics
+from kookaburra.settings import env
+
+_STATE_VALUES = {BREAKER_CLOSED: 0, BREAKER_HALF_OPEN: 1, BREAKER_OPEN: 2}
+
+
+def _percentile(values: Deque[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+class LlmHealth:
+    """LlmHealth.
+
+    LlmHealth tracks the recent latencies and failures of one Llm. Timeouts
+    adapt to the observed p99 and the circuit opens after consecutive
+    failures, so a cold or broken Modal app fails fast instead of holding a
+    worker for the full timeout on every message. After a cooldown a single
+    probe request is let through to decide whether to close the circuit.
+    """
+
+    def __init__(self, llm_id: str) -> None:
+        self.llm_id = llm_id
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._latencies: Deque[float] = deque(maxlen=env.LLM_LATENCY_WINDOW)
+
+    def _transition(self, state: str) -> None:
+        if state == self.state:
+            return
+        log.warning(f"LLM {self.llm_id} circuit breaker {self.state} -> {state}")
+        self.state = state
+        metrics.inc("llm_breaker_transitions", llm_id=self.llm_id, state=state)
+        metrics.set("llm_breaker_state", _STATE_VALUES[state], llm_id=self.llm_id)
+
+    def _percentile(self, p: float) -> Optional[float]:
+        if len(self._latencies) < env.LLM_LATENCY_MIN_SAMPLES:
+            return None
+        return _percentile(self._latencies, p)
+
+    def timeout(self) -> float:
+        """The time to wait for a response, in seconds."""
+        p99 = self._percentile(0.99)
+        if p99 is None:
+            # until there is enough data, assume a cold start
+            return env.LLM_TIMEOUT_SECONDS
+        return min(
+            env.LLM_TIMEOUT_SECONDS,
+            max(env.LLM_TIMEOUT_MIN_SECONDS, p99 * env.LLM_TIMEOUT_P99_MULTIPLIER),
+        )
+
+    def hedge_after(self) -> Optional[float]:
+        """The time after which a second request is sent, in seconds."""
+        if not env.LLM_HEDGE or self.state != BREAKER_CLOSED:
+            return None
+        return self._percentile(0.95)
+
+    def allow(self) -> bool:
+        """Whether a request may be sent."""
+        if self.state == BREAKER_CLOSED:
+            return True
+        if (
+            self.state == BREAKER_OPEN
+            and time.monotonic() - self.opened_at >= env.LLM_BREAKER_COOLDOWN_SECONDS
+        ):
+            self._transition(BREAKER_HALF_OPEN)
+            return True
+        # only one probe at a time while half open
+        return False
+
+    def success(self, seconds: float) -> None:
+        self._latencies.append(seconds)
+        self.failures = 0
+        self._transition(BREAKER_CLOSED)
+        p95 = self._percentile(0.95)
+        if p95 is not None:
+            metrics.set("llm_latency_p95_seconds", p95, llm_id=self.llm_id)
+
+    def failure(self) -> None:
+        self.failures += 1
+        metrics.inc("llm_failures", llm_id=self.llm_id)
+        if self.state == BREAKER_HALF_OPEN or self.failures >= env.LLM_BREAKER_FAILURES:
+            self.opened_at = time.monotonic()
+            self._transition(BREAKER_OPEN)
+
+
+class Breakers:
+    """Breakers.
+
+    The health of every Llm, per process.
+    """
+
+    def __init__(self) -> None:
+        self._health: Dict[str, LlmHealth] = {}
+
+    def get(self, llm_id: str) -> LlmHealth:
+        if llm_id not in self._health:
+            self._health[llm_id] = LlmHealth(llm_id)
+        return self._health[llm_id]
+
+    def reset(self, llm_id: Optional[str] = None) -> None:
+        if llm_id is None:
+            self._health.clear()
+        else:
+            self._health.pop(llm_id, None)
+
+
+breakers = Breakers()
@@ -0,0 +1,242 @@
+import asyncio
+import hashlib
+import json
+import string
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import asyncpg
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from kookaburra.breaker import breakers
+from kookaburra.const import CACHE_CHANNEL, CACHE_RESPONSE, CACHE_ROUTING
+from kookaburra.log import log
+from kookaburra.metrics import metrics
+from kookaburra.models import Llm
+from kookaburra.settings import env
+
+
+class RoutingCache:
+    """RoutingCache.
+
+    RoutingCache maps phone numbers to Llms. Unknown phone numbers are cached
+    too, for a shorter time, so that stray messages don't hit the database.
+    """
+
+    def __init__(self, ttl: float, negative_ttl: float) -> None:
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries: Dict[str, Tuple[float, Optional[Llm]]] = {}
+
+    def get(self, phone_number: str) -> Tuple[bool, Optional[Llm]]:
+        """Get a cached Llm.
+        Returns:
+            Tuple[bool, Optional[Llm]]: Whether the lookup was a hit, and the
+                cached Llm, which is None for a cached unknown phone number.
+        """
+        entry = self._entries.get(phone_number)
+        if entry is None or entry[0] < time.monotonic():
+            self._entries.pop(phone_number, None)
+            metrics.inc("routing_cache_misses")
+            return False, None
+        metrics.inc("routing_cache_hits")
+        return True, entry[1]
+
+    def set(self, phone_number: str, llm: Optional[Llm]) -> None:
+        ttl = self.ttl if llm is not None else self.negative_ttl
+        self._entries[phone_number] = (time.monotonic() + ttl, llm)
+
+    def invalidate(self, phone_number: Optional[str] = None) -> None:
+        if phone_number is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(phone_number, None)
+        metrics.inc("routing_cache_invalidations")
+
+
+class ResponseCache:
+    """ResponseCache.
+
+    ResponseCache is an LRU cache of LLM responses with a TTL and a memory
+    budget. Keys include the deployed commit, so a redeploy never serves
+    responses from the previous version.
+    """
+
+    # rough per entry overhead of the key, tuple and dict slot
+    _ENTRY_OVERHEAD = 256
+
+    def __init__(self, ttl: float, max_bytes: int, history_turns: int) -> None:
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.history_turns = history_turns
+        self.size = 0
+        self._entries: OrderedDict[Tuple[str, str], Tuple[float, str, int]]
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def normalize(message: str) -> str:
+        return " ".join(message.lower().split()).strip(string.punctuation + " ")
+
+    def key(
+        self,
+        llm: Llm,
+        message: str,
+        chat_history: List[Tuple[str, str]],
+    ) -> Tuple[str, str]:
+        window = chat_history[-self.history_turns :] if self.history_turns else []
+        digest = hashlib.sha256(
+            json.dumps(
+                [
+                    self.normalize(message),
+                    [[self.normalize(i), o] for i, o in window],
+                    llm.deployed_sha,
+                ]
+            ).encode("utf8")
+        ).hexdigest()
+        return str(llm.id), digest
+
+    def _record(self, llm_id: str, hit: bool) -> None:
+        metrics.inc(
+            "llm_response_cache_hits" if hit else "llm_response_cache_misses",
+            llm_id=llm_id,
+        )
+        hits = metrics.get("llm_response_cache_hits", llm_id=llm_id)
+        misses = metrics.get("llm_response_cache_misses", llm_id=llm_id)
+        metrics.set(
+            "llm_response_cache_hit_ratio", hits / (hits + misses), llm_id=llm_id
+        )
+
+    def get(self, key: Tuple[str, str]) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            self._pop(key)
+            entry = None
+        self._record(llm_id=key[0], hit=entry is not None)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: Tuple[str, str], message: str) -> None:
+        self._pop(key)
+        size = len(message.encode("utf8")) + self._ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, message, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            self._pop(next(iter(self._entries)))
+            metrics.inc("llm_response_cache_evictions")
+        metrics.set("llm_response_cache_bytes", self.size)
+
+    def _pop(self, key: Tuple[str, str]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def invalidate(self, llm_id: Optional[str] = None) -> None:
+        for key in [k for k in self._entries if llm_id is None or k[0] == llm_id]:
+            self._pop(key)
+        metrics.set("llm_response_cache_bytes", self.size)
+
+
+class CacheInvalidator:
+    """CacheInvalidator.
+
+    CacheInvalidator keeps the caches of every worker consistent using
+    Postgres LISTEN/NOTIFY. Notifications are sent in the same transaction as
+    the change that caused them, so they are only delivered on commit.
+    """
+
+    def __init__(self) -> None:
+        self._handlers: Dict[str, List[Callable[[Optional[str]], None]]] = {}
+        self._stopping = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, kind: str, handler: Callable[[Optional[str]], None]) -> None:
+        self._handlers.setdefault(kind, []).append(handler)
+
+    def invalidate(self, kind: str, key: Optional[str] = None) -> None:
+        for handler in self._handlers.get(kind, []):
+            handler(key)
+
+    async def notify(
+        self,
+        psql: AsyncSession,
+        kind: str,
+        key: Optional[str] = None,
+    ) -> None:
+        await psql.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {
+                "channel": CACHE_CHANNEL,
+                "payload": json.dumps({"kind": kind, "key": key}),
+            },
+        )
+
+    def _on_notify(
+        self,
+        conn: asyncpg.Connection,
+        pid: int,
+        channel: str,
+        payload: str,
+    ) -> None:
+        message = json.loads(payload)
+        self.invalidate(kind=message["kind"], key=message.get("key"))
+
+    def start(self) -> None:  # pragma: no cover
+        if self._task is None or self._task.done():
+            self._stopping.clear()
+            self._task = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:  # pragma: no cover
+        self._stopping.set()
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _listen(self) -> None:  # pragma: no cover
+        dsn = make_url(env.PSQL_URL).set(drivername="postgresql")
+        while not self._stopping.is_set():
+            terminated = asyncio.Event()
+            try:
+                conn = await asyncpg.connect(dsn.render_as_string(hide_password=False))
+                conn.add_termination_listener(lambda _: terminated.set())
+                await conn.add_listener(CACHE_CHANNEL, self._on_notify)
+                # anything could have changed while we were not listening
+                for kind in self._handlers:
+                    self.invalidate(kind=kind)
+                log.info(f"Listening for cache invalidations on {CACHE_CHANNEL}")
+                waiters = [
+                    asyncio.create_task(self._stopping.wait()),
+                    asyncio.create_task(terminated.wait()),
+                ]
+                _, pending = await asyncio.wait(
+                    waiters,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for waiter in pending:
+                    waiter.cancel()
+                if not conn.is_closed():
+                    await conn.close()
+            except Exception:
+                log.exception("Cache invalidation listener failed, reconnecting")
+                await asyncio.sleep(1)
+
+
+routing_cache = RoutingCache(
+    ttl=env.LLM_ROUTING_CACHE_TTL_SECONDS,
+    negative_ttl=env.LLM_ROUTING_CACHE_NEGATIVE_TTL_SECONDS,
+)
+response_cache = ResponseCache(
+    ttl=env.LLM_RESPONSE_CACHE_TTL_SECONDS,
+    max_bytes=env.LLM_RESPONSE_CACHE_MAX_BYTES,
+    history_turns=env.LLM_RESPONSE_CACHE_HISTORY_TURNS,
+)
+cache_invalidator = CacheInvalidator()
+cache_invalidator.register(CACHE_ROUTING, routing_cache.invalidate)
+cache_invalidator.register(CACHE_RESPONSE, response_cache.invalidate)
+# a redeploy starts with a clean bill of health
+cache_invalidator.register(CACHE_RESPONSE, breakers.reset)
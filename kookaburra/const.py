@@ -14,12 +14,47 @@ LOCAL_DOMAINS = [
 KOOKABURRA_DEPLOY_PATH = "kookaburra_deployment"
 MODAL_STUB_FILE = "_modal.py::stub"
 MODAL_API = "api.modal.run"
-_APP = "_app"
 
 MODAL_ACCOUNT_NAME = "kookaburracodes"
+# each deploy goes to the slot that isn't serving, blue or green, as the app
+# {llm id}-{slot}, which keeps its url within the 63 characters of a dns label
+DEPLOY_SLOTS = ["b", "g"]
 
 KB_AUTH_TOKEN = "kb_auth_token"
 
 KB_AUTH_TOKEN_EXPIRE_SECONDS = timedelta(seconds=60 * 60 * 24 * 2)
 
 BUCKET_NAME = "kookaburra-codes-dev-llms"
+
+SMS_INGEST_SYNC = "sync"
+SMS_INGEST_QUEUE = "queue"
+
+GITHUB_API = "https://api.github.com"
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_SUPERSEDED = "superseded"
+# the advisory lock that serializes deploy job claims
+DEPLOY_CLAIM_LOCK = 0x6B6264
+# the advisory lock held by the one reconciler running at a time
+MODAL_RECONCILE_LOCK = 0x6B6272
+
+CACHE_CHANNEL = "kookaburra_cache"
+CACHE_ROUTING = "routing"
+
+CHAT_HEAD = "head.json"
+CHAT_SEGMENTS = "segments"
+CHAT_LEGACY = "chat.json"
+CACHE_RESPONSE = "response"
+
+BREAKER_CLOSED = "closed"
+BREAKER_HALF_OPEN = "half_open"
+BREAKER_OPEN = "open"
+
+WARMUP_HEADER = "X-Kookaburra-Warmup"
+# the reply to an SMS to an LLM that was stopped for being idle
+WAKING_UP_MESSAGE = "Waking up, I'll answer in a minute or two. 🪶"
+
+KB_JSON = "_kb.json"
@@ -1,3 +1,4 @@
+from contextlib import asynccontextmanager
 from typing import AsyncGenerator
 
 from sqlalchemy.ext.asyncio import create_async_engine
@@ -23,3 +24,7 @@ async def psql_db() -> AsyncGenerator:
     )
     async with async_session() as session:
         yield session
+
+
+# for use outside of a request, e.g. in background workers
+psql_session = asynccontextmanager(psql_db)
@@ -0,0 +1,286 @@
+import asyncio
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from pydantic import UUID4
+from sqlalchemy import and_, or_, text
+from sqlalchemy.sql.elements import ColumnElement
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from kookaburra.const import (
+    DEPLOY_CLAIM_LOCK,
+    JOB_FAILED,
+    JOB_QUEUED,
+    JOB_RUNNING,
+    JOB_SUCCEEDED,
+    JOB_SUPERSEDED,
+)
+from kookaburra.db import psql_session
+from kookaburra.exc import KookaburraException
+from kookaburra.gh import gh_svc
+from kookaburra.llm import llm_svc
+from kookaburra.log import log
+from kookaburra.metrics import metrics
+from kookaburra.models import DeployJob, DeployJobCreate, GitHubUser, Llm
+from kookaburra.recorder import DeployRecorder
+from kookaburra.settings import env
+from kookaburra.worker import WorkerPool
+
+
+class DeployJobService:
+    def __init__(self) -> None:
+        self.pool = WorkerPool(
+            name="deploy",
+            size=env.DEPLOY_WORKERS,
+            poll_seconds=env.DEPLOY_WORKER_POLL_SECONDS,
+            work=self.process_next,
+        )
+
+    async def enqueue(
+        self,
+        user: GitHubUser,
+        request: Dict,
+        psql: AsyncSession,
+    ) -> DeployJob:
+        """Persist a GitHub push as a deploy job."""
+        now = datetime.utcnow()
+        job = DeployJob(
+            **DeployJobCreate(
+                githubuser_id=user.id,
+                full_name=request["repository"]["full_name"],
+                ref=request["ref"],
+                sha=request["after"],
+                payload=request,
+            ).dict(),
+            created_at=now,
+            updated_at=now,
+        )
+        psql.add(job)
+        await psql.commit()
+        metrics.inc("deploy_jobs", status=JOB_QUEUED)
+        return job
+
+    async def claim(self, psql: AsyncSession) -> Optional[DeployJob]:
+        """Claim the oldest job that the concurrency limits allow to run.
+
+        Claims are serialized by an advisory lock, so the running counts can't
+        change between counting them and claiming. Jobs left running by a
+        worker that died are reclaimed once they have been running for twice
+        the job timeout, and don't count towards the limits.
+
+        Only one job per repository runs at a time, and only the latest push
+        to a branch is deployed, the jobs of older pushes are superseded.
+        """
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=2 * env.DEPLOY_JOB_TIMEOUT_SECONDS)
+        await psql.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": DEPLOY_CLAIM_LOCK}
+        )
+        running = (
+            await psql.execute(
+                select(DeployJob.githubuser_id, DeployJob.full_name).where(
+                    DeployJob.status == JOB_RUNNING,
+                    col(DeployJob.started_at) >= stale,
+                )
+            )
+        ).all()
+        if len(running) >= env.DEPLOY_MAX_CONCURRENT:
+            await psql.rollback()
+            return None
+        per_user = Counter(githubuser_id for githubuser_id, _ in running)
+        busy = [
+            githubuser_id
+            for githubuser_id, count in per_user.items()
+            if count >= env.DEPLOY_MAX_CONCURRENT_PER_USER
+        ]
+        claimable = or_(
+            col(DeployJob.status) == JOB_QUEUED,
+            and_(
+                col(DeployJob.status) == JOB_RUNNING,
+                col(DeployJob.started_at) < stale,
+            ),
+        )
+        job = (
+            (
+                await psql.execute(
+                    select(DeployJob)
+                    .where(
+                        claimable,
+                        col(DeployJob.githubuser_id).not_in(busy),
+                        col(DeployJob.full_name).not_in(
+                            {full_name for _, full_name in running}
+                        ),
+                    )
+                    .order_by(DeployJob.created_at)
+                    .limit(1)
+                    .with_for_update(skip_locked=True)
+                )
+            )
+            .scalars()
+            .first()
+        )
+        if job is None:
+            await psql.rollback()
+            return None
+        pending = (
+            (
+                await psql.execute(
+                    select(DeployJob)
+                    .where(
+                        claimable,
+                        DeployJob.full_name == job.full_name,
+                        DeployJob.ref == job.ref,
+                    )
+                    .order_by(DeployJob.created_at)
+                    .with_for_update(skip_locked=True)
+                )
+            )
+            .scalars()
+            .all()
+        )
+        job, superseded = pending[-1], pending[:-1]
+        for old in superseded:
+            old.status = JOB_SUPERSEDED
+            old.finished_at = now
+            old.log = f"Superseded by {job.sha}"
+            psql.add(old)
+        job.status = JOB_RUNNING
+        job.started_at = now
+        job.attempts += 1
+        psql.add(job)
+        await psql.commit()
+        for old in superseded:
+            metrics.inc("deploy_jobs", status=JOB_SUPERSEDED)
+            try:
+                await gh_svc.post_commit_status(
+                    full_name=old.full_name,
+                    sha=old.sha,
+                    state="error",
+                    description=f"Superseded by {job.sha[:7]}, not deployed.",
+                )
+            except Exception:
+                log.exception(f"Could not post the status of deploy job {old.id}")
+        return job
+
+    async def run(self, job: DeployJob, psql: AsyncSession) -> None:
+        recorder = DeployRecorder(max_bytes=env.DEPLOY_JOB_MAX_LOG_BYTES)
+        recorder.log(f"Deploying {job.full_name}@{job.sha}, attempt {job.attempts}")
+        try:
+            # a job is only retried when its worker died, a failed deploy
+            # would fail the same way again
+            if job.attempts > env.DEPLOY_JOB_MAX_ATTEMPTS:
+                raise KookaburraException(
+                    f"Gave up after {env.DEPLOY_JOB_MAX_ATTEMPTS} attempts."
+                )
+            user = await psql.get(GitHubUser, job.githubuser_id)
+            if user is None:
+                raise KookaburraException(f"Could not find user {job.githubuser_id}")
+            await asyncio.wait_for(
+                gh_svc.handle_push(
+                    request=job.payload,
+                    psql=psql,
+                    user=user,
+                    recorder=recorder,
+                ),
+                timeout=env.DEPLOY_JOB_TIMEOUT_SECONDS,
+            )
+        except Exception as e:
+            log.exception(f"Deploy job {job.id} failed on attempt {job.attempts}")
+            job.status = JOB_FAILED
+            job.last_error = repr(e)
+        else:
+            job.status = JOB_SUCCEEDED
+            job.last_error = None
+        job.finished_at = datetime.utcnow()
+        job.stages = recorder.stages
+        job.log = recorder.output
+        psql.add(job)
+        await psql.commit()
+        metrics.inc("deploy_jobs", status=job.status)
+
+    async def process_next(self) -> bool:
+        async with psql_session() as psql:
+            job = await self.claim(psql=psql)
+            if job is None:
+                return False
+            await self.run(job=job, psql=psql)
+            return True
+
+    async def list_for_user(
+        self,
+        user: GitHubUser,
+        psql: AsyncSession,
+        limit: int = 20,
+    ) -> List[DeployJob]:
+        return (
+            (
+                await psql.execute(
+                    select(DeployJob)
+                    .where(DeployJob.githubuser_id == user.id)
+                    .order_by(col(DeployJob.created_at).desc())
+                    .limit(limit)
+                )
+            )
+            .scalars()
+            .all()
+        )
+
+    async def get_for_user(
+        self,
+        job_id: UUID4,
+        githubuser_id: UUID4,
+        psql: AsyncSession,
+    ) -> Optional[DeployJob]:
+        return (
+            (
+                await psql.execute(
+                    select(DeployJob).where(
+                        DeployJob.id == job_id,
+                        DeployJob.githubuser_id == githubuser_id,
+                    )
+                )
+            )
+            .scalars()
+            .first()
+        )
+
+    def deployed(self) -> ColumnElement:
+        """Matches the succeeded deploy jobs of an Llm's deployed commit."""
+        return and_(
+            col(DeployJob.githubuser_id) == col(Llm.githubuser_id),
+            col(DeployJob.sha) == col(Llm.deployed_sha),
+            col(DeployJob.status) == JOB_SUCCEEDED,
+        )
+
+    async def get_deployed(self, llm: Llm, psql: AsyncSession) -> Optional[DeployJob]:
+        """The latest job that deployed the commit `llm` is serving."""
+        return (
+            (
+                await psql.execute(
+                    select(DeployJob)
+                    .join(Llm, self.deployed())
+                    .where(Llm.id == llm.id)
+                    .order_by(col(DeployJob.created_at).desc())
+                    .limit(1)
+                )
+            )
+            .scalars()
+            .first()
+        )
+
+
+deploy_job_svc = DeployJobService()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    # run the deploy workers, and the stops of drained versions, as a
+    # standalone process
+    async def _main() -> None:
+        await asyncio.gather(
+            deploy_job_svc.pool.run_forever(),
+            llm_svc.drain_pool.run_forever(),
+        )
+
+    asyncio.run(_main())
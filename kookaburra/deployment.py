@@ -1,7 +1,9 @@
+import asyncio
 import os
+import signal
+from typing import Dict, List, Optional
 
-import sh
-from modal.cli.run import deploy
+import modal
 
 from kookaburra.const import (
     KOOKABURRA_DEPLOY_PATH,
@@ -9,40 +11,109 @@ from kookaburra.const import (
     MODAL_API,
     MODAL_STUB_FILE,
 )
+from kookaburra.exc import KookaburraException
+from kookaburra.metrics import metrics
 from kookaburra.settings import env
 
+# the output of a failed command that is kept in its exception
+ERROR_OUTPUT_BYTES = 4096
 
-class DeploymentService:  # pragma: no cover
-    async def modal_deploy(self, tmpdir: str, llm_id: str) -> None:
-        sh.modal(
-            "token",
-            "set",
-            "--token-id",
-            env.MODAL_TOKEN_ID,
-            "--token-secret",
-            env.MODAL_TOKEN_SECRET,
-            _out="/tmp/modal_token_set.log",
-            _new_session=False,
+
+async def run_command(
+    args: List[str],
+    timeout: float,
+    cwd: Optional[str] = None,
+) -> str:
+    """Run a command in its own process group.
+
+    The command is killed, with any processes it started, if it outlives
+    `timeout` or the caller is cancelled.
+    Returns:
+        str: The command's stdout and stderr, interleaved.
+    Raises:
+        KookaburraException: If the command fails or times out, with the tail
+            of its output.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        cwd=cwd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        start_new_session=True,
+    )
+    assert proc.stdout is not None
+    chunks: List[bytes] = []
+
+    async def _read() -> None:
+        async for line in proc.stdout:  # type: ignore
+            chunks.append(line)
+
+    timed_out = False
+    try:
+        await asyncio.wait_for(asyncio.gather(_read(), proc.wait()), timeout)
+    except BaseException as e:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:  # pragma: no cover
+            pass
+        await proc.wait()
+        if not isinstance(e, asyncio.TimeoutError):
+            raise
+        timed_out = True
+    output = b"".join(chunks).decode("utf8", errors="replace")
+    if timed_out or proc.returncode != 0:
+        reason = (
+            f"timed out after {timeout}s"
+            if timed_out
+            else f"exited with {proc.returncode}"
         )
-        pwd = os.getcwd()
-        os.chdir(tmpdir)
-        deploy(
-            stub_ref=f"{KOOKABURRA_DEPLOY_PATH}/{MODAL_STUB_FILE}",
-            name=llm_id,
+        raise KookaburraException(
+            f"{' '.join(args[:2])} {reason}:\n{output[-ERROR_OUTPUT_BYTES:]}"
         )
-        os.chdir(pwd)
-
-    def get_modal_url(self, llm_id: str) -> str:
-        return f"https://{MODAL_ACCOUNT_NAME}--{llm_id}--{MODAL_API}/"
-
-    async def stop_modal_app(self, llm_id: str) -> None:
-        sh.modal(
-            "app",
-            "stop",
-            "--name",
-            llm_id,
-            _out="/tmp/modal_app_stop.log",
-            _new_session=False,
+    return output
+
+
+class DeploymentService:  # pragma: no cover
+    def __init__(self) -> None:
+        # the modal CLI, and the client in this process, read the token from
+        # the environment, so no deploy has to write it to ~/.modal.toml
+        if env.MODAL_TOKEN_ID:
+            os.environ["MODAL_TOKEN_ID"] = env.MODAL_TOKEN_ID
+            os.environ["MODAL_TOKEN_SECRET"] = env.MODAL_TOKEN_SECRET
+        self._deploys = asyncio.Semaphore(env.MODAL_DEPLOY_CONCURRENCY)
+
+    async def modal_deploy(self, tmpdir: str, app_name: str) -> str:
+        """Deploy the app laid out in `tmpdir`.
+        Returns:
+            str: The output of `modal deploy`.
+        """
+        if self._deploys.locked():
+            metrics.inc("modal_deploy_waits")
+        async with self._deploys:
+            return await run_command(
+                [
+                    "modal",
+                    "deploy",
+                    f"{KOOKABURRA_DEPLOY_PATH}/{MODAL_STUB_FILE}",
+                    "--name",
+                    app_name,
+                ],
+                timeout=env.MODAL_DEPLOY_TIMEOUT_SECONDS,
+                cwd=tmpdir,
+            )
+
+    async def build_index(self, app_name: str) -> Dict:
+        """Run the build_index function of a deployed app."""
+        fn = modal.lookup(app_name, "build_index")
+        return await asyncio.to_thread(fn.call)
+
+    def get_modal_url(self, app_name: str) -> str:
+        return f"https://{MODAL_ACCOUNT_NAME}--{app_name}--{MODAL_API}/"
+
+    async def stop_modal_app(self, app_name: str) -> None:
+        await run_command(
+            ["modal", "app", "stop", "--name", app_name],
+            timeout=env.MODAL_DEPLOY_TIMEOUT_SECONDS,
         )
 
 
@@ -1,30 +1,40 @@
+import asyncio
+import json
 import os
-import shutil
 import tempfile
-import time
-from typing import Dict
+import traceback
+from pathlib import Path
+from typing import Dict, Optional
 
-import httpx
-import jwt
-from git import Repo
 from github import Github
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-from kookaburra.const import _APP, KOOKABURRA_DEPLOY_PATH
+from kookaburra.const import GITHUB_API, KB_JSON, KOOKABURRA_DEPLOY_PATH
 from kookaburra.deployment import deploy_svc
-from kookaburra.exc import KookaburraException
+from kookaburra.gh_app import gh_app_auth
+from kookaburra.http import http_clients
 from kookaburra.llm import llm_svc
+from kookaburra.log import log
+from kookaburra.metrics import metrics
+from kookaburra.mirrors import mirror_cache
 from kookaburra.models import GitHubUser
+from kookaburra.recorder import DeployRecorder
+from kookaburra.runtime import runtime_cache
 from kookaburra.settings import env
 from kookaburra.twilio import twilio_svc
 from kookaburra.types import GitHubToken, GitHubUserData
+from kookaburra.warmup import warmup_svc
+from kookaburra_deployment.bundle import Bundle
+from kookaburra_deployment.image import deps_digest
 
 
-class GitHubService:  # pragma: no cover
-    def get_github(self, token: GitHubToken) -> Github:
+class GitHubService:
+    def get_github(self, token: GitHubToken) -> Github:  # pragma: no cover
         return Github(login_or_token=token.access_token)
 
-    async def get_gh_user_data(self, token: GitHubToken) -> GitHubUserData:
+    async def get_gh_user_data(
+        self, token: GitHubToken
+    ) -> GitHubUserData:  # pragma: no cover
         _gh = self.get_github(token=token)
         _gh_user = _gh.get_user()
         return GitHubUserData(
@@ -32,18 +42,22 @@ class GitHubService:  # pragma: no cover
             raw_data=_gh_user.raw_data,
         )
 
-    async def handle_webhook(
-        self, request: Dict, headers: Dict, user: GitHubUser, psql: AsyncSession
-    ) -> None:
-        if await self.is_push(headers=headers):
-            await self.handle_push(request=request, psql=psql, user=user)
-
     async def is_push(self, headers: Dict) -> bool:
         return headers.get("x-github-event", None) == "push"
 
     async def handle_push(
-        self, request: Dict, psql: AsyncSession, user: GitHubUser
+        self,
+        request: Dict,
+        psql: AsyncSession,
+        user: GitHubUser,
+        recorder: Optional[DeployRecorder] = None,
     ) -> None:
+        """Deploy a push to the default branch.
+
+        Runs in a deploy job, see `kookaburra.deploy_jobs`. Raises once the
+        failure is posted as the commit status, so the job is marked failed.
+        """
+        recorder = recorder or DeployRecorder(max_bytes=env.DEPLOY_JOB_MAX_LOG_BYTES)
         await self.post_commit_status(
             full_name=request["repository"]["full_name"],
             sha=request["after"],
@@ -55,137 +69,155 @@ class GitHubService:  # pragma: no cover
             # clone the content into kookaburra_deploy and run the deploy to modal
             ref = request["ref"]
             default_branch = await self.get_default_branch(request=request)
-            if ref.endswith(default_branch):
-                # in a temporary directory, clone the repo
-                with tempfile.TemporaryDirectory() as tmpdir:
-                    # copy kookaburra_deployment to the tmpdir
-                    # clone the repo into the tmpdir
-                    # run the deploy
-                    to_path = os.path.join(tmpdir, KOOKABURRA_DEPLOY_PATH, _APP)
-                    os.makedirs(to_path, exist_ok=True)
-                    to_path = await self.clone_repo(request=request, to_path=to_path)
-                    deploy_root = os.path.join(tmpdir, KOOKABURRA_DEPLOY_PATH)
-                    # copy the app to the deploy root
-                    shutil.copytree(
-                        src=to_path,
-                        dst=deploy_root,
-                        dirs_exist_ok=True,
+            if not ref.endswith(default_branch):
+                recorder.log(f"Skipping {ref}, only {default_branch} is deployed.")
+                return
+            # in a temporary directory, clone the repo
+            with tempfile.TemporaryDirectory() as tmpdir:
+                # check the app out straight into the deploy root, then link
+                # the runtime files over it from the cached pristine copy
+                deploy_root = os.path.join(tmpdir, KOOKABURRA_DEPLOY_PATH)
+                with recorder.stage("clone") as stage:
+                    checkout = await self.clone_repo(
+                        request=request, to_path=deploy_root
                     )
-                    # remove the app from the deploy root
-                    shutil.rmtree(to_path)
-                    # copy the kookaburra_deployment to the deploy root
-                    shutil.copytree(
-                        src=KOOKABURRA_DEPLOY_PATH,
-                        dst=deploy_root,
-                        dirs_exist_ok=True,
+                    stage["bytes"] = checkout["bytes"]
+                with recorder.stage("runtime") as stage:
+                    linked = await asyncio.to_thread(
+                        runtime_cache.link_into, Path(deploy_root)
                     )
-                    llm = await llm_svc.get_by_clone_url(
-                        clone_url=request["repository"]["clone_url"], psql=psql
-                    )
-                    if llm is None:
-                        llm = await llm_svc.create(
-                            clone_url=request["repository"]["clone_url"],
-                            psql=psql,
-                            user=user,
-                            phone_number=twilio_svc.provision_phone_number(),
-                        )
-                    await deploy_svc.modal_deploy(
-                        tmpdir=tmpdir,
-                        llm_id=str(llm.id),
+                    stage["bytes"] = linked["copied_bytes"]
+                llm = await llm_svc.get_by_clone_url(
+                    clone_url=request["repository"]["clone_url"], psql=psql
+                )
+                if llm is None:
+                    llm = await llm_svc.create(
+                        clone_url=request["repository"]["clone_url"],
+                        psql=psql,
+                        user=user,
+                        phone_number=twilio_svc.provision_phone_number(),
                     )
+                with recorder.stage("bundle"):
+                    bundle = await asyncio.to_thread(Bundle, Path(deploy_root))
+                    summary = await asyncio.to_thread(bundle.summary)
+                    tree_hash = bundle.runtime_digest
+                    # code only pushes reuse the cached dependency layers
+                    deps_hash = deps_digest(Path(deploy_root))
+                if llm.deployed_sha is not None and tree_hash == llm.tree_hash:
+                    recorder.log(f"No changes to deploy for LLM {llm.id}: {summary}")
+                    metrics.inc("deploy_unchanged")
+                    # the serving version, and its index, stay those of the
+                    # commit that was deployed
                     await self.post_commit_status(
                         full_name=request["repository"]["full_name"],
                         sha=request["after"],
                         state="success",
-                        description="Deployed!",
+                        description="No changes to deploy.",
                     )
-        except Exception:
+                    return
+                # deploy next to the serving version, which keeps serving until
+                # the new one is ready
+                app_name = await llm_svc.next_app_name(llm=llm, psql=psql)
+                # tell the app who it is, e.g. to find its vector index, and
+                # which versions stay up, whose indexes it must keep
+                with open(os.path.join(deploy_root, KB_JSON), "w") as f:
+                    json.dump(
+                        {
+                            "llm_id": str(llm.id),
+                            "sha": request["after"],
+                            "keep": [
+                                sha
+                                for sha in (llm.deployed_sha, llm.previous_sha)
+                                if sha is not None
+                            ],
+                        },
+                        f,
+                    )
+                recorder.log(f"Deploying LLM {llm.id} to {app_name}: {summary}")
+                deps_cache = "hit" if deps_hash == llm.deps_hash else "miss"
+                metrics.inc("deploy_deps_cache", result=deps_cache)
+                recorder.log(f"Dependency layers of LLM {llm.id}: cache {deps_cache}")
+                with recorder.stage("deploy"):
+                    output = await deploy_svc.modal_deploy(
+                        tmpdir=tmpdir,
+                        app_name=app_name,
+                    )
+                recorder.log(output)
+                # embed the documents of apps that have any, once per commit
+                with recorder.stage("index"):
+                    build = await deploy_svc.build_index(app_name=app_name)
+                recorder.log(f"Built the vector index of LLM {llm.id}: {build}")
+                modal_url = deploy_svc.get_modal_url(app_name=app_name)
+                with recorder.stage("health"):
+                    await warmup_svc.ready(modal_url)
+                # absorb the cold start before any traffic moves over
+                with recorder.stage("warmup"):
+                    llm.cold_start_ms, llm.warm_ms = await warmup_svc.warm(
+                        llm, modal_url=modal_url
+                    )
+                llm.deps_hash = deps_hash
+                llm.tree_hash = tree_hash
+                await llm_svc.cutover(
+                    llm=llm,
+                    app_name=app_name,
+                    sha=request["after"],
+                    psql=psql,
+                )
+                await self.post_commit_status(
+                    full_name=request["repository"]["full_name"],
+                    sha=request["after"],
+                    state="success",
+                    description="Deployed!",
+                )
+        except BaseException:
+            recorder.log(traceback.format_exc())
             await self.post_commit_status(
                 full_name=request["repository"]["full_name"],
                 sha=request["after"],
                 state="failure",
                 description="Failed to deploy.",
             )
+            raise
 
     async def get_default_branch(self, request: Dict) -> str:
         return request["repository"]["default_branch"]
 
-    async def clone_repo(self, request: Dict, to_path: str) -> str:
+    async def clone_repo(self, request: Dict, to_path: str) -> Dict:  # pragma: no cover
         clone_url = request["repository"]["clone_url"]
-        full_name = request["repository"]["full_name"]
-        jwt = self.make_private_app_cloner_jwt()
-        installation_id = await self.get_installation_id(full_name=full_name, jwt=jwt)
-        access_token = await self.get_access_token_for_app(
-            installation_id=installation_id, jwt=jwt
+        access_token = await gh_app_auth.installation_token(
+            full_name=request["repository"]["full_name"]
         )
         clone_url = clone_url.replace(
             "https://", f"https://x-access-token:{access_token}@"
         )
-        Repo.clone_from(url=clone_url, to_path=to_path)
-        return to_path
-
-    def make_private_app_cloner_jwt(self) -> str:
-        with open(env.GH_APP_PRIVATE_KEY_PATH, "rb") as pem_file:
-            signing_key = jwt.jwk_from_pem(pem_file.read())
-        payload = {
-            # Issued at time
-            "iat": int(time.time()),
-            # JWT expiration time (10 minutes maximum)
-            "exp": int(time.time()) + 600,
-            # GitHub App's identifier
-            "iss": env.GH_APP_ID,
-        }
-        jwt_instance = jwt.JWT()
-        return jwt_instance.encode(payload, signing_key, alg="RS256")
-
-    async def get_installation_id(self, full_name: str, jwt: str) -> str:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                "https://api.github.com/app/installations",
-                headers={
-                    "Accept": "application/vnd.github+json",
-                    "Authorization": f"Bearer {jwt}",
-                },
-            )
-        installations = response.json()
-        for installation in installations:
-            if installation["account"]["login"] == full_name.split("/")[0]:
-                return installation["id"]
-        raise KookaburraException(f"No installation found for this repo {full_name}.")
-
-    async def get_access_token_for_app(self, installation_id: str, jwt: str) -> str:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"https://api.github.com/app/installations/{installation_id}/access_tokens",
-                headers={
-                    "Accept": "application/vnd.github+json",
-                    "Authorization": f"Bearer {jwt}",
-                },
-            )
-        return response.json()["token"]
+        # only the objects that are new since the last deploy are fetched
+        result = await asyncio.to_thread(
+            mirror_cache.checkout,
+            clone_url=clone_url,
+            full_name=request["repository"]["full_name"],
+            sha=request["after"],
+            to_path=to_path,
+        )
+        log.info(f"Checked out {request['after']}: {result}")
+        return result
 
     async def post_commit_status(
         self, full_name: str, sha: str, state: str, description: str
-    ) -> None:
-        jwt = self.make_private_app_cloner_jwt()
-        installation_id = await self.get_installation_id(full_name=full_name, jwt=jwt)
-        access_token = await self.get_access_token_for_app(
-            installation_id=installation_id, jwt=jwt
+    ) -> None:  # pragma: no cover
+        access_token = await gh_app_auth.installation_token(full_name=full_name)
+        response = await http_clients.get(GITHUB_API).post(
+            f"{GITHUB_API}/repos/{full_name}/statuses/{sha}",
+            headers={
+                "Accept": "application/vnd.github+json",
+                "Authorization": f"Bearer {access_token}",
+            },
+            json={
+                "state": state,
+                "target_url": env.KOOKABURRA_URL,
+                "description": description,
+                "context": "kookaburra",
+            },
         )
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"https://api.github.com/repos/{full_name}/statuses/{sha}",
-                headers={
-                    "Accept": "application/vnd.github+json",
-                    "Authorization": f"Bearer {access_token}",
-                },
-                json={
-                    "state": state,
-                    "target_url": env.KOOKABURRA_URL,
-                    "description": description,
-                    "context": "kookaburra",
-                },
-            )
         return response.json()
 
 
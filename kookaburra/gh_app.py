@@ -0,0 +1,148 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+import jwt
+
+from kookaburra.const import GITHUB_API
+from kookaburra.exc import KookaburraException
+from kookaburra.http import http_clients
+from kookaburra.log import log
+from kookaburra.metrics import metrics
+from kookaburra.settings import env
+
+# GitHub rejects app JWTs that expire more than 10 minutes after they're sent
+JWT_TTL_SECONDS = 540
+# and that are issued in the future, so backdate them for clock drift
+JWT_BACKDATE_SECONDS = 60
+INSTALLATIONS_PER_PAGE = 100
+
+
+class GitHubAppAuth:
+    """GitHubAppAuth.
+
+    GitHubAppAuth authenticates as the Kookaburra GitHub App. The signing key
+    is read once, the app JWT is reused until it is about to expire, the
+    installation of each account is looked up in an index that is only
+    listed again when an account is missing from it, and installation tokens
+    are reused until they are about to expire.
+    """
+
+    def __init__(self) -> None:
+        self._signing_key: Any = None
+        self._jwt: Optional[Tuple[str, float]] = None
+        self._installations: Dict[str, int] = {}
+        self._tokens: Dict[int, Tuple[str, float]] = {}
+        self._lock = asyncio.Lock()
+
+    def _headers(self, token: str) -> Dict[str, str]:
+        return {
+            "Accept": "application/vnd.github+json",
+            "Authorization": f"Bearer {token}",
+        }
+
+    def _fresh(self, expires_at: float, now: float) -> bool:
+        return now < expires_at - env.GH_APP_TOKEN_REFRESH_SECONDS
+
+    def app_jwt(self, now: Optional[float] = None) -> str:
+        """The JWT that authenticates as the app itself."""
+        now = time.time() if now is None else now
+        if self._jwt is not None and self._fresh(self._jwt[1], now):
+            return self._jwt[0]
+        if self._signing_key is None:
+            with open(env.GH_APP_PRIVATE_KEY_PATH, "rb") as pem_file:
+                self._signing_key = jwt.jwk_from_pem(pem_file.read())
+        expires_at = int(now) + JWT_TTL_SECONDS
+        payload = {
+            # Issued at time
+            "iat": int(now) - JWT_BACKDATE_SECONDS,
+            # JWT expiration time
+            "exp": expires_at,
+            # GitHub App's identifier
+            "iss": env.GH_APP_ID,
+        }
+        token = jwt.JWT().encode(payload, self._signing_key, alg="RS256")
+        self._jwt = (token, expires_at)
+        metrics.inc("gh_app_jwts")
+        return token
+
+    async def _list_installations(self) -> Dict[str, int]:
+        installations = {}
+        url: Optional[str] = f"{GITHUB_API}/app/installations"
+        params: Optional[Dict] = {"per_page": INSTALLATIONS_PER_PAGE}
+        while url is not None:
+            response = await http_clients.get(GITHUB_API).get(
+                url,
+                params=params,
+                headers=self._headers(self.app_jwt()),
+            )
+            self._raise_for_status(response, "list the app installations")
+            metrics.inc("gh_app_requests", endpoint="installations")
+            for installation in response.json():
+                installations[installation["account"]["login"]] = installation["id"]
+            # the next link carries the query string
+            url, params = response.links.get("next", {}).get("url"), None
+        return installations
+
+    async def installation_id(self, owner: str) -> int:
+        """The installation of the app on the account `owner`."""
+        if owner not in self._installations:
+            async with self._lock:
+                if owner not in self._installations:
+                    self._installations = await self._list_installations()
+        if owner not in self._installations:
+            raise KookaburraException(f"No installation found for {owner}.")
+        return self._installations[owner]
+
+    async def installation_token(
+        self,
+        full_name: str,
+        now: Optional[float] = None,
+    ) -> str:
+        """A token with the app's access to the repo `full_name`."""
+        owner = full_name.split("/")[0]
+        installation_id = await self.installation_id(owner)
+        now = time.time() if now is None else now
+        cached = self._tokens.get(installation_id)
+        if cached is not None and self._fresh(cached[1], now):
+            metrics.inc("gh_app_tokens", result="hit")
+            return cached[0]
+        async with self._lock:
+            cached = self._tokens.get(installation_id)
+            if cached is not None and self._fresh(cached[1], now):
+                metrics.inc("gh_app_tokens", result="hit")
+                return cached[0]
+            response = await http_clients.get(GITHUB_API).post(
+                f"{GITHUB_API}/app/installations/{installation_id}/access_tokens",
+                headers=self._headers(self.app_jwt(now)),
+            )
+            if response.status_code == 404:
+                # the app was uninstalled, or installed again with a new id
+                log.info(f"Forgetting installation {installation_id} of {owner}")
+                self._installations.pop(owner, None)
+            self._raise_for_status(response, f"get a token for {full_name}")
+            metrics.inc("gh_app_tokens", result="miss")
+            data = response.json()
+            expires_at = (
+                datetime.strptime(data["expires_at"], "%Y-%m-%dT%H:%M:%SZ")
+                .replace(tzinfo=timezone.utc)
+                .timestamp()
+            )
+            self._tokens[installation_id] = (data["token"], expires_at)
+            return data["token"]
+
+    def _raise_for_status(self, response: httpx.Response, action: str) -> None:
+        if response.is_error:
+            raise KookaburraException(
+                f"Could not {action}, GitHub responded {response.status_code}."
+            )
+
+    def reset(self) -> None:
+        self._jwt = None
+        self._installations = {}
+        self._tokens = {}
+
+
+gh_app_auth = GitHubAppAuth()
@@ -1,35 +1,334 @@
+import asyncio
 import json
 import time
-from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from uuid import uuid4
 
+from google.api_core.exceptions import NotFound, PreconditionFailed
 from google.cloud import storage
+from requests.adapters import HTTPAdapter
 
-from kookaburra.const import BUCKET_NAME
+from kookaburra.const import BUCKET_NAME, CHAT_HEAD, CHAT_LEGACY, CHAT_SEGMENTS
+from kookaburra.exc import KookaburraException
+from kookaburra.log import log
 from kookaburra.models import Llm
+from kookaburra.settings import env
+from kookaburra.tokenizer import count_tokens
 from kookaburra.types import BaseResponse
 from kookaburra.utils import _phone_hash
 
 
+class _HistoryWindow:
+    """The newest turns of a conversation that fit a turn and token budget."""
+
+    def __init__(self, max_turns: int, max_tokens: int) -> None:
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.tokens = 0
+        self._turns: List[Dict] = []
+        self.full = max_turns <= 0
+
+    def extend(self, newest_first: Iterable[Dict]) -> bool:
+        """Add turns until the budget is spent.
+        Returns:
+            bool: Whether the window has room for older turns.
+        """
+        for turn in newest_first:
+            if self.full:
+                break
+            tokens = count_tokens(turn["_in"]) + count_tokens(turn["_out"])
+            if self.tokens + tokens > self.max_tokens:
+                self.full = True
+                break
+            self.tokens += tokens
+            self._turns.append(turn)
+            self.full = len(self._turns) >= self.max_turns
+        return not self.full
+
+    @property
+    def turns(self) -> List[Dict]:
+        return self._turns[::-1]
+
+
+def _head_size(turns: List[Dict], max_turns: int, max_tokens: int) -> int:
+    """The number of newest turns a read within the budget needs.
+
+    With them in the head, the read is answered from the head alone. The turn
+    over the token budget is counted, it tells the reader the budget is spent.
+    """
+    window = _HistoryWindow(max_turns=max_turns, max_tokens=max_tokens)
+    window.extend(reversed(turns))
+    size = len(window.turns)
+    if window.full and size < max_turns:
+        size += 1
+    return min(size, len(turns))
+
+
+def _legacy_timestamp(blob: storage.Blob) -> int:
+    # {llm.id}/{phone_hash}/{timestamp}/chat.json
+    return int(blob.name.split("/")[-2])
+
+
 class GsService:
-    def _gs(self) -> storage.Client:
-        return storage.Client()  # pragma: no cover
+    """GsService.
+
+    Each conversation is stored under `{llm.id}/{phone_hash}` as a head
+    object with the turns a history read needs, plus immutable segments of
+    older turns.
+    The head doubles as the manifest of the segments, so a conversation can
+    be read without listing the bucket. Head updates use generation
+    preconditions, so concurrent writers retry rather than lose turns.
+
+    The storage client is blocking, so requests run on a bounded thread pool
+    instead of the event loop.
+    """
+
+    def __init__(self) -> None:
+        self._client: Optional[storage.Client] = None
+        self._executor = ThreadPoolExecutor(
+            max_workers=env.GS_DOWNLOAD_CONCURRENCY,
+            thread_name_prefix="gs",
+        )
+
+    def _gs(self) -> storage.Client:  # pragma: no cover
+        if self._client is None:
+            self._client = storage.Client()
+            # allow one pooled connection per executor thread
+            adapter = HTTPAdapter(
+                pool_connections=env.GS_DOWNLOAD_CONCURRENCY,
+                pool_maxsize=env.GS_DOWNLOAD_CONCURRENCY,
+            )
+            self._client._http.mount("https://", adapter)
+        return self._client
+
+    async def _run(self, fn: Callable, *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, fn, *args
+        )
+
+    def _bucket(self) -> storage.Bucket:
+        # no request is made until an object is read or written
+        return self._gs().bucket(BUCKET_NAME)
+
+    def _prefix(self, llm_id: str, phone_number: str) -> str:
+        return f"{llm_id}/{_phone_hash(phone_number)}"
+
+    def _read_head(self, bucket: storage.Bucket, prefix: str) -> Tuple[Dict, int]:
+        blob = bucket.blob(f"{prefix}/{CHAT_HEAD}")
+        try:
+            data = blob.download_as_bytes()
+        except NotFound:
+            return {"turns": [], "segments": []}, 0
+        return json.loads(data), blob.generation
+
+    def _write_head(
+        self,
+        bucket: storage.Bucket,
+        prefix: str,
+        head: Dict,
+        generation: int,
+    ) -> None:
+        bucket.blob(f"{prefix}/{CHAT_HEAD}").upload_from_string(
+            data=json.dumps(head),
+            content_type="application/json",
+            if_generation_match=generation,
+        )
+
+    def _read_segment(self, bucket: storage.Bucket, name: str) -> List[Dict]:
+        return json.loads(bucket.blob(name).download_as_bytes())["turns"]
+
+    def _write_segment(
+        self,
+        bucket: storage.Bucket,
+        prefix: str,
+        turns: List[Dict],
+    ) -> Dict:
+        first, last = turns[0]["timestamp"], turns[-1]["timestamp"]
+        # concurrent writers can compact the same turns in the same millisecond,
+        # and the one that loses the head write deletes what it wrote
+        name = f"{prefix}/{CHAT_SEGMENTS}/{first}-{last}-{uuid4().hex[:8]}.json"
+        bucket.blob(name).upload_from_string(
+            data=json.dumps({"turns": turns}),
+            content_type="application/json",
+        )
+        return {
+            "name": name,
+            "count": len(turns),
+            "first": first,
+            "last": last,
+        }
+
+    def _delete(self, bucket: storage.Bucket, names: Iterable[str]) -> None:
+        for name in names:
+            try:
+                bucket.blob(name).delete()
+            except NotFound:  # pragma: no cover
+                pass
+
+    def _legacy_blobs(self, bucket: storage.Bucket, prefix: str) -> List:
+        return [
+            blob
+            for blob in bucket.list_blobs(prefix=f"{prefix}/")
+            if blob.name.endswith(f"/{CHAT_LEGACY}")
+        ]
+
+    def _download(self, blob: storage.Blob) -> Dict:
+        return json.loads(blob.download_as_bytes())
+
+    def _read_legacy(self, bucket: storage.Bucket, prefix: str) -> List[Dict]:
+        # one object per turn, as written before chats were segmented
+        return [self._download(blob) for blob in self._legacy_blobs(bucket, prefix)]
+
+    async def _read_window(
+        self,
+        bucket: storage.Bucket,
+        prefix: str,
+        max_turns: int,
+        max_tokens: int,
+    ) -> List[Dict]:
+        """Read the newest turns of a conversation that fit the budget.
+
+        Objects are read newest first and reading stops as soon as the budget
+        is spent, so older segments are never downloaded.
+        """
+        for _ in range(env.GS_CHAT_WRITE_ATTEMPTS):
+            window = _HistoryWindow(max_turns=max_turns, max_tokens=max_tokens)
+            head, generation = await self._run(self._read_head, bucket, prefix)
+            if not generation:
+                blobs = await self._run(self._legacy_blobs, bucket, prefix)
+                blobs = sorted(blobs, key=_legacy_timestamp, reverse=True)[:max_turns]
+                step = env.GS_DOWNLOAD_CONCURRENCY
+                for i in range(0, len(blobs), step):
+                    turns = await asyncio.gather(
+                        *[
+                            self._run(self._download, blob)
+                            for blob in blobs[i : i + step]
+                        ]
+                    )
+                    if not window.extend(turns):
+                        break
+                return window.turns
+            if window.extend(reversed(head["turns"])):
+                try:
+                    for segment in reversed(head["segments"]):
+                        turns = await self._run(
+                            self._read_segment, bucket, segment["name"]
+                        )
+                        if not window.extend(reversed(turns)):
+                            break
+                except NotFound:  # pragma: no cover
+                    # a segment was compacted away after we read the head
+                    continue
+            return window.turns
+        raise KookaburraException(  # pragma: no cover
+            f"Could not read a consistent chat history for {prefix}."
+        )
+
+    def _build(
+        self,
+        bucket: storage.Bucket,
+        prefix: str,
+        turns: List[Dict],
+        max_turns: int,
+        max_tokens: int,
+    ) -> Dict:
+        """Write segments for all but the newest turns and return a new head.
+
+        The head keeps the turns a history read within the budget needs.
+        """
+        turns = sorted(turns, key=lambda x: x["timestamp"])
+        split = len(turns) - _head_size(turns, max_turns, max_tokens)
+        size = env.GS_CHAT_SEGMENT_MAX_TURNS
+        return {
+            "turns": turns[split:],
+            "segments": [
+                self._write_segment(bucket, prefix, turns[i : min(i + size, split)])
+                for i in range(0, split, size)
+            ],
+        }
+
+    def _compact(
+        self,
+        bucket: storage.Bucket,
+        prefix: str,
+        head: Dict,
+        max_turns: int,
+        max_tokens: int,
+    ) -> Tuple[List[str], List[str]]:
+        """Move the older turns of an oversized head into a segment.
+
+        The head keeps the turns a history read within the budget needs, so
+        the read stays a single request. The older turns are merged into the
+        newest segment while it has room, in which case that segment is
+        rewritten under a new name.
+        Returns:
+            Tuple[List[str], List[str]]: The segments that were written, and
+                the segments that are obsolete once the head is written.
+        """
+        split = len(head["turns"]) - _head_size(head["turns"], max_turns, max_tokens)
+        if split <= env.GS_CHAT_HEAD_MAX_TURNS:
+            return [], []
+        turns, head["turns"] = head["turns"][:split], head["turns"][split:]
+        obsolete = []
+        segments = head["segments"]
+        if (
+            segments
+            and segments[-1]["count"] + len(turns) <= env.GS_CHAT_SEGMENT_MAX_TURNS
+        ):
+            last = segments.pop()
+            turns = self._read_segment(bucket, last["name"]) + turns
+            obsolete.append(last["name"])
+        segment = self._write_segment(bucket, prefix, turns)
+        segments.append(segment)
+        return [segment["name"]], obsolete
+
+    def _budget(
+        self,
+        llm: Optional[Llm] = None,
+        max_turns: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+    ) -> Tuple[int, int]:
+        """The turn and token budget of a history read, by default the llm's."""
+        if max_turns is None and llm is not None:
+            max_turns = llm.history_max_turns
+        if max_turns is None:
+            max_turns = env.GS_CHAT_HISTORY_MAX_TURNS
+        if max_tokens is None and llm is not None:
+            max_tokens = llm.history_max_tokens
+        if max_tokens is None:
+            max_tokens = env.GS_CHAT_HISTORY_MAX_TOKENS
+        return max_turns, max_tokens
 
     async def get_sms_chat_history(
         self,
         llm: Llm,
         phone_number: str,
+        max_turns: Optional[int] = None,
+        max_tokens: Optional[int] = None,
     ) -> List[Tuple[str, str]]:
-        bucket = self._gs().get_bucket(BUCKET_NAME)
-        _phone_number = _phone_hash(phone_number)
-        blobs = bucket.list_blobs(
-            prefix=f"{llm.id}/{_phone_number}",
-        )
-        content = []
-        for blob in blobs:
-            content.append(json.loads(blob.download_as_string()))
+        """Get the newest turns of a conversation.
+        Args:
+            llm (Llm): The llm that owns the phone number.
+            phone_number (str): The phone number of the other party.
+            max_turns (int): The maximum number of turns, defaults to the
+                budget of the llm.
+            max_tokens (int): The maximum number of tokens, defaults to the
+                budget of the llm.
+        Returns:
+            List[Tuple[str, str]]: The turns, oldest first.
+        """
+        max_turns, max_tokens = self._budget(llm, max_turns, max_tokens)
+        bucket = self._bucket()
+        turns = await self._read_window(
+            bucket,
+            self._prefix(str(llm.id), phone_number),
+            max_turns=max_turns,
+            max_tokens=max_tokens,
+        )
         chat_history = [
             (chat["_in"], chat["_out"])
-            for chat in sorted(content, key=lambda x: x["timestamp"])
+            for chat in sorted(turns, key=lambda x: x["timestamp"])
         ]
         return chat_history
 
@@ -39,18 +338,105 @@ class GsService:
         body: dict,
         response: BaseResponse,
     ) -> None:
-        bucket = self._gs().get_bucket(BUCKET_NAME)
-        _from = _phone_hash(body["From"])
-        _t = int(time.time() * 1000)
-        blob = bucket.blob(f"{llm.id}/{_from}/{_t}/chat.json")
-        blob.upload_from_string(
-            data=json.dumps(
-                {
-                    "_in": body["Body"],
-                    "_out": response.message,
-                    "timestamp": _t,
-                }
+        bucket = self._bucket()
+        turn = {
+            "_in": body["Body"],
+            "_out": response.message,
+            "timestamp": int(time.time() * 1000),
+        }
+        await self._run(
+            self._append,
+            bucket,
+            self._prefix(str(llm.id), body["From"]),
+            turn,
+            *self._budget(llm),
+        )
+
+    def _append(
+        self,
+        bucket: storage.Bucket,
+        prefix: str,
+        turn: Dict,
+        max_turns: int,
+        max_tokens: int,
+    ) -> None:
+        for _ in range(env.GS_CHAT_WRITE_ATTEMPTS):
+            head, generation = self._read_head(bucket, prefix)
+            obsolete: List[str] = []
+            if not generation:
+                # first write since segmenting, fold in any per-turn objects
+                head = self._build(
+                    bucket,
+                    prefix,
+                    self._read_legacy(bucket, prefix) + [turn],
+                    max_turns,
+                    max_tokens,
+                )
+                created = [s["name"] for s in head["segments"]]
+            else:
+                head["turns"].append(turn)
+                created, obsolete = self._compact(
+                    bucket, prefix, head, max_turns, max_tokens
+                )
+            try:
+                self._write_head(bucket, prefix, head, generation)
+            except PreconditionFailed:
+                # another message in this conversation was written first
+                self._delete(bucket, created)
+                continue
+            self._delete(bucket, obsolete)
+            return
+        raise KookaburraException(f"Could not write chat for {prefix}.")
+
+    async def migrate_legacy_chat(
+        self,
+        bucket: storage.Bucket,
+        prefix: str,
+        delete_legacy: bool = False,
+    ) -> Optional[int]:
+        """Rewrite the per-turn objects of a conversation into segments.
+
+        Turns that were already written to segments are kept, so this is safe
+        to run while the conversation is receiving messages.
+        Returns:
+            Optional[int]: The number of turns in the conversation, or None if
+                there was nothing to migrate.
+        """
+        legacy_blobs = await self._run(self._legacy_blobs, bucket, prefix)
+        if not legacy_blobs:
+            return None
+        legacy = await asyncio.gather(
+            *[self._run(self._download, blob) for blob in legacy_blobs]
+        )
+        for _ in range(env.GS_CHAT_WRITE_ATTEMPTS):
+            head, generation = await self._run(self._read_head, bucket, prefix)
+            turns = list(legacy)
+            previous: List[str] = []
+            if generation:
+                previous = [s["name"] for s in head["segments"]]
+                segments = await asyncio.gather(
+                    *[self._run(self._read_segment, bucket, name) for name in previous]
+                )
+                turns += [t for segment in segments for t in segment] + head["turns"]
+            unique = {(t["timestamp"], t["_in"], t["_out"]): t for t in turns}
+            head = await self._run(
+                self._build, bucket, prefix, list(unique.values()), *self._budget()
             )
+            created = [s["name"] for s in head["segments"]]
+            try:
+                await self._run(self._write_head, bucket, prefix, head, generation)
+            except PreconditionFailed:  # pragma: no cover
+                await self._run(self._delete, bucket, set(created) - set(previous))
+                continue
+            await self._run(self._delete, bucket, set(previous) - set(created))
+            if delete_legacy:
+                await self._run(
+                    self._delete, bucket, [blob.name for blob in legacy_blobs]
+                )
+            log.info(f"Migrated {len(unique)} turns for {prefix}")
+            return len(unique)
+        raise KookaburraException(  # pragma: no cover
+            f"Could not migrate chat history for {prefix}."
         )
 
 
@@ -0,0 +1,140 @@
+import asyncio
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Set, Tuple
+
+import httpx
+
+from kookaburra.metrics import metrics
+from kookaburra.settings import env
+
+
+class _MeteredStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, on_close: Callable) -> None:
+        self._stream = stream
+        self._on_close = on_close
+        self._closed = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._closed:
+                self._closed = True
+                self._on_close()
+
+
+class _MeteredTransport(httpx.AsyncBaseTransport):
+    """Track how many requests to a host are in flight.
+
+    A request is in flight until its response has been closed, which is when
+    its connection goes back to the pool.
+    """
+
+    def __init__(self, host: str, transport: httpx.AsyncBaseTransport) -> None:
+        self.host = host
+        self.in_flight = 0
+        self._transport = transport
+
+    def _update(self, delta: int) -> None:
+        self.in_flight += delta
+        metrics.set("http_pool_in_flight", self.in_flight, host=self.host)
+        metrics.set(
+            "http_pool_saturation",
+            self.in_flight / env.HTTP_MAX_CONNECTIONS_PER_HOST,
+            host=self.host,
+        )
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        metrics.inc("http_requests", host=self.host)
+        self._update(1)
+        if self.in_flight > env.HTTP_MAX_CONNECTIONS_PER_HOST:
+            # this request has to wait for a connection
+            metrics.inc("http_pool_waits", host=self.host)
+        try:
+            response = await self._transport.handle_async_request(request)
+        except BaseException:
+            self._update(-1)
+            raise
+        assert isinstance(response.stream, httpx.AsyncByteStream)
+        response.stream = _MeteredStream(response.stream, lambda: self._update(-1))
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class HttpClients:
+    """HttpClients.
+
+    HttpClients keeps one pooled client per host, so outbound requests reuse
+    connections instead of paying a new TCP and TLS handshake each time. Every
+    Llm is its own host, so only the `HTTP_MAX_HOSTS` most recently used
+    clients are kept, and the idle ones beyond that are closed.
+    """
+
+    def __init__(self) -> None:
+        # host -> its client, and the transport that counts its requests
+        self._clients: OrderedDict[
+            str, Tuple[httpx.AsyncClient, _MeteredTransport]
+        ] = OrderedDict()
+        # evicted clients being closed, kept so their tasks aren't collected
+        self._closing: Set[asyncio.Task] = set()
+
+    def _transport(self) -> httpx.AsyncBaseTransport:  # pragma: no cover
+        return httpx.AsyncHTTPTransport(
+            http2=env.HTTP_HTTP2,
+            limits=httpx.Limits(
+                max_connections=env.HTTP_MAX_CONNECTIONS_PER_HOST,
+                max_keepalive_connections=env.HTTP_MAX_KEEPALIVE_CONNECTIONS_PER_HOST,
+                keepalive_expiry=env.HTTP_KEEPALIVE_EXPIRY_SECONDS,
+            ),
+        )
+
+    def get(self, url: str) -> httpx.AsyncClient:
+        """Get the client for the host of `url`."""
+        host = httpx.URL(url).host
+        if host not in self._clients or self._clients[host][0].is_closed:
+            transport = _MeteredTransport(host=host, transport=self._transport())
+            client = httpx.AsyncClient(
+                transport=transport,
+                timeout=httpx.Timeout(
+                    connect=env.HTTP_CONNECT_TIMEOUT_SECONDS,
+                    read=env.HTTP_READ_TIMEOUT_SECONDS,
+                    write=env.HTTP_WRITE_TIMEOUT_SECONDS,
+                    pool=env.HTTP_POOL_TIMEOUT_SECONDS,
+                ),
+            )
+            self._clients[host] = (client, transport)
+        self._clients.move_to_end(host)
+        self._evict()
+        return self._clients[host][0]
+
+    def _evict(self) -> None:
+        """Close the least recently used clients over `HTTP_MAX_HOSTS`.
+
+        A client with requests in flight is kept until a later eviction, and
+        so is the one just used.
+        """
+        excess = len(self._clients) - env.HTTP_MAX_HOSTS
+        for host, (client, transport) in list(self._clients.items())[:-1]:
+            if excess <= 0:
+                break
+            if transport.in_flight:
+                continue
+            del self._clients[host]
+            excess -= 1
+            task = asyncio.create_task(client.aclose())
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+            metrics.inc("http_clients_evicted")
+
+    async def close(self) -> None:
+        clients, self._clients = list(self._clients.values()), OrderedDict()
+        await asyncio.gather(*[c.aclose() for c, _ in clients], *self._closing)
+
+
+http_clients = HttpClients()
@@ -0,0 +1,182 @@
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from pydantic import UUID4
+from sqlalchemy import Integer, bindparam, exists, func, text, update
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from kookaburra.db import psql_session
+from kookaburra.deploy_jobs import deploy_job_svc
+from kookaburra.exc import KookaburraException
+from kookaburra.llm import llm_svc
+from kookaburra.log import log
+from kookaburra.metrics import metrics
+from kookaburra.models import GitHubUser, Llm
+from kookaburra.reconciler import modal_reconciler
+from kookaburra.settings import env
+from kookaburra.worker import WorkerPool
+
+
+class IdleService:
+    """IdleService.
+
+    IdleService stops the Modal apps of Llms that have had no SMS or deploy
+    for `IDLE_STOP_DAYS`, and redeploys them when the next SMS arrives. The
+    last activity of each Llm, and its messages per hour of the day, which
+    keep-warm reads, are kept in memory and written in batches, so the SMS
+    path never waits on the database for them.
+    """
+
+    def __init__(self) -> None:
+        self.flush_pool = WorkerPool(
+            name="activity",
+            size=1,
+            poll_seconds=env.ACTIVITY_FLUSH_SECONDS,
+            work=self.flush,
+        )
+        self.pool = WorkerPool(
+            name="idle",
+            size=1,
+            poll_seconds=env.IDLE_POLL_SECONDS,
+            work=self.stop_idle,
+        )
+        # llm id -> last activity, and messages per hour, not yet written
+        self._pending: Dict[UUID4, datetime] = {}
+        self._hours: Dict[UUID4, Counter] = {}
+
+    def record_activity(self, llm: Llm, now: Optional[datetime] = None) -> None:
+        now = now or datetime.utcnow()
+        self._pending[llm.id] = now
+        self._hours.setdefault(llm.id, Counter())[now.hour] += 1
+
+    async def flush(self) -> bool:
+        """Write the pending activity, in one statement."""
+        if not self._pending:
+            return False
+        pending, self._pending = self._pending, {}
+        hours, self._hours = self._hours, {}
+        table = Llm.__table__  # type: ignore
+        try:
+            async with psql_session() as psql:
+                await psql.execute(
+                    update(table).where(table.c.id == bindparam("llm_id"))
+                    # greatest ignores nulls, and another process may have
+                    # written newer activity
+                    .values(
+                        last_active_at=func.greatest(
+                            table.c.last_active_at, bindparam("active_at")
+                        ),
+                        # add the counts of each hour
+                        active_hours=text(
+                            "ARRAY(SELECT coalesce(a, 0) + coalesce(b, 0) "
+                            "FROM unnest(llms.active_hours, CAST(:hours AS int[])) "
+                            "WITH ORDINALITY AS t(a, b, i) ORDER BY i)"
+                        ).bindparams(bindparam("hours", type_=ARRAY(Integer))),
+                    ),
+                    [
+                        {
+                            "llm_id": llm_id,
+                            "active_at": active_at,
+                            "hours": [hours[llm_id][h] for h in range(24)],
+                        }
+                        for llm_id, active_at in pending.items()
+                    ],
+                )
+                await psql.commit()
+        except Exception:
+            # keep it for the next flush, unless there was activity since
+            for llm_id, active_at in pending.items():
+                self._pending.setdefault(llm_id, active_at)
+                self._hours.setdefault(llm_id, Counter()).update(hours[llm_id])
+            raise
+        metrics.inc("llm_activity_flushed", len(pending))
+        # always wait for the next interval
+        return False
+
+    async def stop_idle(self) -> bool:
+        """Stop the apps of the next idle Llm.
+
+        Only Llms that can be revived, from the deploy job of the commit they
+        serve, are stopped.
+        """
+        now = datetime.utcnow()
+        idle_since = now - timedelta(days=env.IDLE_STOP_DAYS)
+        async with psql_session() as psql:
+            llm = (
+                (
+                    await psql.execute(
+                        select(Llm)
+                        .where(
+                            col(Llm.idle_stopped_at).is_(None),
+                            col(Llm.deployed_sha).is_not(None),
+                            func.coalesce(Llm.last_active_at, Llm.created_at)
+                            < idle_since,
+                            exists().where(deploy_job_svc.deployed()),
+                        )
+                        .limit(1)
+                        .with_for_update(skip_locked=True, of=Llm)
+                    )
+                )
+                .scalars()
+                .first()
+            )
+            if llm is None:
+                await psql.rollback()
+                return False
+            # before blue/green deploys, apps were named after their llm
+            app_names = {llm.app_name or str(llm.id), llm.previous_app_name}
+            app_names.discard(None)
+            if await modal_reconciler.stop(app_names) < len(app_names):
+                # tried again on the next poll
+                await psql.rollback()
+                return False
+            await llm_svc.mark_idle(llm=llm, psql=psql)
+        log.info(f"Stopped LLM {llm.id}, idle since {llm.last_active_at}")
+        metrics.inc("llm_idle_stops")
+        return True
+
+    async def wake(self, llm_id: UUID4, psql: AsyncSession) -> bool:
+        """Redeploy a stopped Llm from the deploy job of the commit it served.
+
+        The Llm stays locked until the caller commits, so concurrent SMS start
+        one revival. A revival that hasn't finished within
+        `REVIVE_TIMEOUT_SECONDS` is started again.
+        Returns:
+            bool: Whether this call started a revival.
+        """
+        now = datetime.utcnow()
+        llm = (
+            (
+                await psql.execute(
+                    select(Llm)
+                    .where(Llm.id == llm_id)
+                    .with_for_update()
+                    .execution_options(populate_existing=True)
+                )
+            )
+            .scalars()
+            .first()
+        )
+        if llm is None or llm.idle_stopped_at is None:
+            return False
+        if llm.waking_at is not None and now - llm.waking_at < timedelta(
+            seconds=env.REVIVE_TIMEOUT_SECONDS
+        ):
+            return False
+        job = await deploy_job_svc.get_deployed(llm=llm, psql=psql)
+        user = await psql.get(GitHubUser, llm.githubuser_id)
+        if job is None or user is None:
+            raise KookaburraException(f"Could not find a deploy to revive {llm.id}")
+        llm.waking_at = now
+        psql.add(llm)
+        # commits the llm with the job
+        await deploy_job_svc.enqueue(user=user, request=job.payload, psql=psql)
+        log.info(f"Reviving LLM {llm.id} at {job.sha}")
+        metrics.inc("llm_revivals")
+        return True
+
+
+idle_svc = IdleService()
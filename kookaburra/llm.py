@@ -1,19 +1,53 @@
-from typing import List, Optional, Tuple
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional, Set, Tuple
 from uuid import uuid4
 
 import httpx
 from fastapi import HTTPException, status
 from pydantic import UUID4
-from sqlmodel import select
+from sqlmodel import col, select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
+from kookaburra.breaker import LlmHealth, breakers
+from kookaburra.cache import cache_invalidator, response_cache, routing_cache
+from kookaburra.const import CACHE_RESPONSE, CACHE_ROUTING, DEPLOY_SLOTS
+from kookaburra.db import psql_session
 from kookaburra.deployment import deploy_svc
-from kookaburra.models import GitHubUser, Llm
+from kookaburra.exc import KookaburraException
+from kookaburra.http import http_clients
+from kookaburra.log import log
+from kookaburra.metrics import metrics
+from kookaburra.models import GitHubUser, Llm, LlmUpdate
+from kookaburra.reconciler import modal_reconciler
+from kookaburra.settings import env
 from kookaburra.twilio import twilio_svc
-from kookaburra.types import BaseResponse
+from kookaburra.types import BaseResponse, FallbackResponse
+from kookaburra.worker import WorkerPool
 
 
 class LlmService:
+    def __init__(self) -> None:
+        self.drain_pool = WorkerPool(
+            name="drain",
+            size=1,
+            poll_seconds=env.DEPLOY_DRAIN_POLL_SECONDS,
+            work=self.stop_drained,
+        )
+
+    async def _commit(self, llm: Llm, psql: AsyncSession, *kinds: str) -> None:
+        """Commit, and drop the cached copies of `llm` in every worker."""
+        keys = {
+            CACHE_ROUTING: llm.phone_number,
+            CACHE_RESPONSE: str(llm.id),
+        }
+        for kind in kinds:
+            await cache_invalidator.notify(psql=psql, kind=kind, key=keys[kind])
+        await psql.commit()
+        for kind in kinds:
+            cache_invalidator.invalidate(kind=kind, key=keys[kind])
+
     async def get_by_clone_url(
         self,
         clone_url: str,
@@ -40,7 +74,10 @@ class LlmService:
         phone_number: str,
     ) -> Llm:
         llm_id = uuid4()
-        modal_url = deploy_svc.get_modal_url(llm_id=str(llm_id))
+        # where the first deploy will be
+        modal_url = deploy_svc.get_modal_url(
+            app_name=self.get_app_name(llm_id, DEPLOY_SLOTS[0])
+        )
         llm = Llm(
             id=llm_id,
             clone_url=clone_url,
@@ -49,35 +86,312 @@ class LlmService:
             githubuser_id=user.id,
         )
         psql.add(llm)
-        await psql.commit()
+        await self._commit(llm, psql, CACHE_ROUTING)
         await psql.refresh(llm)
         return llm
 
+    async def get_by_id(
+        self,
+        llm_id: UUID4,
+        psql: AsyncSession,
+    ) -> Optional[Llm]:
+        results = (
+            (await psql.execute(select(Llm).where(Llm.id == llm_id))).scalars().first()
+        )
+        return results
+
     async def get_llm_by_phone_number(
         self, phone_number: str, psql: AsyncSession
     ) -> Optional[Llm]:
+        hit, llm = routing_cache.get(phone_number)
+        if hit:
+            return llm
         results = (
             (await psql.execute(select(Llm).where(Llm.phone_number == phone_number)))
             .scalars()
             .first()
         )
+        routing_cache.set(phone_number, results)
         return results
 
+    def get_app_name(self, llm_id: UUID4, slot: str) -> str:
+        return f"{llm_id}-{slot}"
+
+    async def next_app_name(self, llm: Llm, psql: AsyncSession) -> str:
+        """The app to deploy the next version of `llm` to.
+
+        That is the slot that isn't serving. A previous version still
+        draining in it is replaced by the deploy, so it is no longer stopped.
+        """
+        blue, green = DEPLOY_SLOTS
+        serving = llm.app_name
+        app_name = self.get_app_name(
+            llm.id, green if serving == self.get_app_name(llm.id, blue) else blue
+        )
+        if llm.previous_app_name == app_name:
+            llm.previous_app_name = None
+            llm.previous_sha = None
+            llm.drain_until = None
+            psql.add(llm)
+            await psql.commit()
+        return app_name
+
+    async def cutover(
+        self,
+        llm: Llm,
+        app_name: str,
+        sha: str,
+        psql: AsyncSession,
+    ) -> None:
+        """Route `llm` to a new, ready version.
+
+        The switch is one commit, and every worker drops its cached routing at
+        once. The version it replaces keeps running until `drain_until`, so
+        its requests in flight finish and it can be rolled back to.
+        """
+        stale = llm.previous_app_name
+        # an idle llm's app is already stopped, there is nothing to drain
+        if (
+            llm.deployed_sha is not None
+            and llm.idle_stopped_at is None
+            and llm.app_name != app_name
+        ):
+            # before blue/green deploys, apps were named after their llm
+            llm.previous_app_name = llm.app_name or str(llm.id)
+            llm.previous_sha = llm.deployed_sha
+            llm.drain_until = datetime.utcnow() + timedelta(
+                seconds=env.DEPLOY_DRAIN_SECONDS
+            )
+        llm.app_name = app_name
+        llm.modal_url = deploy_svc.get_modal_url(app_name=app_name)
+        llm.deployed_sha = sha
+        # a fresh deploy isn't idle, and wakes an idle llm
+        llm.last_active_at = datetime.utcnow()
+        llm.idle_stopped_at = None
+        llm.waking_at = None
+        psql.add(llm)
+        await self._commit(llm, psql, CACHE_ROUTING, CACHE_RESPONSE)
+        metrics.inc("deploy_cutovers")
+        if stale is not None and stale not in (llm.previous_app_name, app_name):
+            # only one version drains at a time
+            await modal_reconciler.stop([stale])
+
+    async def mark_idle(self, llm: Llm, psql: AsyncSession) -> None:
+        """Record that the apps of `llm` were stopped for being idle."""
+        llm.idle_stopped_at = datetime.utcnow()
+        llm.waking_at = None
+        llm.previous_app_name = None
+        llm.previous_sha = None
+        llm.drain_until = None
+        # the revival deploys the same tree again
+        llm.tree_hash = None
+        psql.add(llm)
+        await self._commit(llm, psql, CACHE_ROUTING)
+
+    async def rollback(
+        self,
+        llm_id: UUID4,
+        githubuser_id: UUID4,
+        psql: AsyncSession,
+    ) -> None:
+        """Route an Llm back to the version it replaced, if it is still up."""
+        llm = await self.get_for_user(
+            llm_id=llm_id,
+            githubuser_id=githubuser_id,
+            psql=psql,
+        )
+        if llm is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Bad request.",
+            )
+        if llm.previous_app_name is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="There is no version to roll back to.",
+            )
+        llm.app_name, llm.previous_app_name = llm.previous_app_name, llm.app_name
+        llm.deployed_sha, llm.previous_sha = llm.previous_sha, llm.deployed_sha
+        llm.modal_url = deploy_svc.get_modal_url(app_name=llm.app_name)
+        llm.drain_until = datetime.utcnow() + timedelta(
+            seconds=env.DEPLOY_DRAIN_SECONDS
+        )
+        # deploy the next push, even if it is the tree that was rolled back
+        llm.tree_hash = None
+        psql.add(llm)
+        await self._commit(llm, psql, CACHE_ROUTING, CACHE_RESPONSE)
+        metrics.inc("deploy_rollbacks")
+
+    async def stop_drained(self) -> bool:
+        """Stop the next previous version whose drain window has passed."""
+        async with psql_session() as psql:
+            llm = (
+                (
+                    await psql.execute(
+                        select(Llm)
+                        .where(
+                            col(Llm.previous_app_name).is_not(None),
+                            col(Llm.drain_until) <= datetime.utcnow(),
+                        )
+                        .limit(1)
+                        .with_for_update(skip_locked=True)
+                    )
+                )
+                .scalars()
+                .first()
+            )
+            if llm is None:
+                await psql.rollback()
+                return False
+            if await modal_reconciler.stop([llm.previous_app_name]):
+                llm.previous_app_name = None
+                llm.previous_sha = None
+                llm.drain_until = None
+            else:
+                llm.drain_until = datetime.utcnow() + timedelta(
+                    seconds=env.DEPLOY_DRAIN_POLL_SECONDS
+                )
+            psql.add(llm)
+            await psql.commit()
+            return True
+
     async def respond(
         self,
         llm: Llm,
         message: str,
         chat_history: Optional[List[Tuple[str, str]]] = None,
+    ) -> BaseResponse:
+        key = None
+        if llm.response_cache_enabled:
+            key = response_cache.key(llm, message, chat_history or [])
+            cached = response_cache.get(key)
+            if cached is not None:
+                return BaseResponse(message=cached)
+        try:
+            response = await self._guarded(llm, message, chat_history)
+        except KookaburraException:
+            if not env.LLM_FALLBACK_MESSAGE:
+                raise
+            metrics.inc("llm_fallbacks", llm_id=str(llm.id))
+            return FallbackResponse(message=env.LLM_FALLBACK_MESSAGE)
+        if key is not None:
+            response_cache.set(key, response.message)
+        return response
+
+    async def _guarded(
+        self,
+        llm: Llm,
+        message: str,
+        chat_history: Optional[List[Tuple[str, str]]] = None,
+    ) -> BaseResponse:
+        """Call the Llm through its circuit breaker, with an adaptive timeout."""
+        health = breakers.get(str(llm.id))
+        if not health.allow():
+            raise KookaburraException(f"LLM {llm.id} circuit breaker is open")
+        start = time.monotonic()
+        try:
+            response = await asyncio.wait_for(
+                self._hedged(llm, message, chat_history, health),
+                timeout=health.timeout(),
+            )
+        except Exception as e:
+            health.failure()
+            if isinstance(e, asyncio.TimeoutError):
+                metrics.inc("llm_timeouts", llm_id=str(llm.id))
+            log.exception(f"LLM {llm.id} failed to respond")
+            raise KookaburraException(f"LLM {llm.id} failed to respond") from e
+        except BaseException:
+            # e.g. cancelled, a half open breaker must not wait for this probe
+            health.failure()
+            raise
+        health.success(time.monotonic() - start)
+        return response
+
+    async def _hedged(
+        self,
+        llm: Llm,
+        message: str,
+        chat_history: Optional[List[Tuple[str, str]]],
+        health: LlmHealth,
+    ) -> BaseResponse:
+        """Send a second request if the first is slower than the p95.
+
+        Whichever request answers first wins and the other is cancelled.
+        """
+        tasks: Set[asyncio.Task] = {
+            asyncio.create_task(self._respond(llm, message, chat_history))
+        }
+        hedge_after = health.hedge_after()
+        try:
+            if hedge_after is not None:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                if not done:
+                    metrics.inc("llm_hedges", llm_id=str(llm.id))
+                    tasks.add(
+                        asyncio.create_task(self._respond(llm, message, chat_history))
+                    )
+            while True:
+                done, tasks = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                if not tasks:
+                    return next(iter(done)).result()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _respond(
+        self,
+        llm: Llm,
+        message: str,
+        chat_history: Optional[List[Tuple[str, str]]] = None,
     ) -> BaseResponse:  # pragma: no cover
-        async with httpx.AsyncClient(timeout=300) as client:
-            response = await client.post(
-                f"{llm.modal_url.strip('/')}/hey",
+        response = await http_clients.get(llm.modal_url).post(
+            f"{llm.modal_url.strip('/')}/hey",
+            json={
+                "message": message,
+                "chat_history": chat_history,
+            },
+        )
+        return BaseResponse(**response.json())
+
+    async def stream(
+        self,
+        llm: Llm,
+        message: str,
+        chat_history: Optional[List[Tuple[str, str]]] = None,
+    ) -> httpx.Response:
+        """Open a stream of server-sent events from the Llm.
+
+        The response body is not read, the caller relays it and closes it.
+        """
+        client = http_clients.get(llm.modal_url)
+        response = await client.send(
+            client.build_request(
+                "POST",
+                f"{llm.modal_url.strip('/')}/hey/stream",
                 json={
                     "message": message,
-                    "chat_history": chat_history,
+                    "chat_history": chat_history or [],
                 },
+            ),
+            stream=True,
+        )
+        if response.status_code != status.HTTP_200_OK:
+            await response.aclose()
+            log.error(f"LLM {llm.id} stream failed with {response.status_code}")
+            raise HTTPException(
+                status_code=(
+                    status.HTTP_429_TOO_MANY_REQUESTS
+                    if response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+                    else status.HTTP_502_BAD_GATEWAY
+                ),
+                detail="The LLM is unavailable.",
             )
-            return BaseResponse(**response.json())
+        return response
 
     async def get_llms_for_user(
         self,
@@ -110,6 +424,30 @@ class LlmService:
         )
         return results
 
+    async def update(
+        self,
+        llm_id: UUID4,
+        githubuser_id: UUID4,
+        llm_update: LlmUpdate,
+        psql: AsyncSession,
+    ) -> Llm:
+        llm = await self.get_for_user(
+            llm_id=llm_id,
+            githubuser_id=githubuser_id,
+            psql=psql,
+        )
+        if llm is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Bad request.",
+            )
+        for k, v in llm_update.dict(exclude_unset=True).items():
+            setattr(llm, k, v)
+        psql.add(llm)
+        await self._commit(llm, psql, CACHE_ROUTING)
+        await psql.refresh(llm)
+        return llm
+
     async def delete(
         self,
         llm_id: UUID4,
@@ -127,14 +465,15 @@ class LlmService:
                 detail="Bad request.",
             )
         await psql.delete(llm)
-        await psql.commit()
+        await self._commit(llm, psql, CACHE_ROUTING, CACHE_RESPONSE)
         phone_number = llm.phone_number
         await twilio_svc.release_phone_number(phone_number)
-        # TODO: stop the deployed modal app
-        # _llm_id = str(llm.id)
-        # await deploy_svc.stop_modal_app(_llm_id)
-        # for now this script is run manually
-        # scripts/clean-up-modal.py
+        # before blue/green deploys, apps were named after their llm
+        app_names = [llm.app_name or str(llm.id)]
+        if llm.previous_app_name is not None:
+            app_names.append(llm.previous_app_name)
+        # stopping an app can take a while, so the request doesn't wait for it
+        modal_reconciler.stop_later(app_names)
 
 
 llm_svc = LlmService()
@@ -9,12 +9,26 @@ from starlette.middleware.authentication import AuthenticationMiddleware
 from starlette.middleware.sessions import SessionMiddleware
 
 from kookaburra import __version__
-from kookaburra.api import gh_router, health_router, llm_router, sms_router
+from kookaburra.api import (
+    deploy_router,
+    gh_router,
+    health_router,
+    llm_router,
+    sms_router,
+)
 from kookaburra.auth import GitHubAuthBackend
-from kookaburra.const import LOCAL_DOMAINS, ORIGINS
+from kookaburra.cache import cache_invalidator
+from kookaburra.const import LOCAL_DOMAINS, ORIGINS, SMS_INGEST_QUEUE
+from kookaburra.deploy_jobs import deploy_job_svc
 from kookaburra.exc import exception_handlers
+from kookaburra.http import http_clients
+from kookaburra.idle import idle_svc
+from kookaburra.llm import llm_svc
+from kookaburra.reconciler import modal_reconciler
 from kookaburra.settings import env
+from kookaburra.sms import sms_svc
 from kookaburra.views import views
+from kookaburra.warmup import warmup_svc
 
 os.environ["TZ"] = "UTC"
 
@@ -60,6 +74,7 @@ app.include_router(health_router)
 app.include_router(sms_router)
 app.include_router(gh_router)
 app.include_router(llm_router)
+app.include_router(deploy_router)
 app.include_router(views)
 
 
@@ -73,3 +88,40 @@ async def add_process_time_header(
     process_time = time.time() - start_time
     response.headers["X-Process-Time-Seconds"] = str(process_time)
     return response
+
+
+@app.on_event("startup")
+async def startup() -> None:  # pragma: no cover
+    if env.CACHE_INVALIDATION_LISTEN:
+        cache_invalidator.start()
+    # with idle stops, SMS to stopped llms are queued in either ingest mode
+    if (env.SMS_INGEST_MODE == SMS_INGEST_QUEUE or env.IDLE_STOP) and (
+        env.SMS_WORKERS > 0
+    ):
+        sms_svc.pool.start()
+    if env.KEEP_WARM:
+        warmup_svc.pool.start()
+    if env.DEPLOY_WORKERS_IN_APP and env.DEPLOY_WORKERS > 0:
+        deploy_job_svc.pool.start()
+        llm_svc.drain_pool.start()
+    if env.MODAL_RECONCILE:
+        modal_reconciler.pool.start()
+    if env.IDLE_STOP:
+        idle_svc.pool.start()
+    idle_svc.flush_pool.start()
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:  # pragma: no cover
+    await sms_svc.pool.stop()
+    await warmup_svc.pool.stop()
+    await deploy_job_svc.pool.stop()
+    await llm_svc.drain_pool.stop()
+    await modal_reconciler.pool.stop()
+    await modal_reconciler.close()
+    await idle_svc.pool.stop()
+    await idle_svc.flush_pool.stop()
+    # write the activity seen since the last flush
+    await idle_svc.flush()
+    await cache_invalidator.stop()
+    await http_clients.close()
@@ -0,0 +1,43 @@
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+_Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: Dict[str, str]) -> _Key:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Metrics:
+    """Metrics.
+
+    A minimal in-process registry of counters and gauges. Values are per
+    process, so with several gunicorn workers each worker reports its own.
+    """
+
+    def __init__(self) -> None:
+        self._counters: Dict[_Key, float] = defaultdict(float)
+        self._gauges: Dict[_Key, float] = {}
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        self._counters[_key(name, labels)] += value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        self._gauges[_key(name, labels)] = value
+
+    def get(self, name: str, **labels: str) -> float:
+        key = _key(name, labels)
+        if key in self._gauges:
+            return self._gauges[key]
+        return self._counters.get(key, 0)
+
+    def snapshot(self) -> List[Dict]:
+        return [
+            {"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in sorted(
+                [*self._counters.items(), *self._gauges.items()]
+            )
+        ]
+
+
+metrics = Metrics()
@@ -0,0 +1,190 @@
+import fcntl
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, cast
+
+from git import GitCommandError, Repo
+
+from kookaburra.exc import KookaburraException
+from kookaburra.log import log
+from kookaburra.metrics import metrics
+from kookaburra.settings import env
+
+# archives bigger than this are spilled to disk
+_SPOOL_BYTES = 16 * 1024 * 1024
+# the ref that keeps the last deployed commit, so the next fetch negotiates
+# from it and only downloads what changed since
+DEPLOYED_REF = "refs/kookaburra/deployed"
+
+
+def _du(path: Path) -> int:
+    return sum(
+        os.path.getsize(os.path.join(dirpath, f))
+        for dirpath, _, filenames in os.walk(path)
+        for f in filenames
+    )
+
+
+# python's own checks, where it has them, on top of ours
+_EXTRACT_FILTER: Dict[str, Any] = (
+    {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+)
+
+
+def _safe_members(tar: tarfile.TarFile, to_path: str) -> List[tarfile.TarInfo]:
+    """The members of an archive of repo content, if all stay in `to_path`.
+    Raises:
+        KookaburraException: If a member is absolute, escapes with `..`, is a
+            link that points outside `to_path`, or is a device.
+    """
+    root = os.path.realpath(to_path)
+
+    def _inside(path: str) -> bool:
+        return os.path.commonpath([root, os.path.realpath(path)]) == root
+
+    members = tar.getmembers()
+    for member in members:
+        target = os.path.join(root, member.name)
+        if os.path.isabs(member.name) or not _inside(target):
+            raise KookaburraException(f"Unsafe path in archive: {member.name}")
+        if member.issym() and not _inside(
+            os.path.join(os.path.dirname(target), member.linkname)
+        ):
+            raise KookaburraException(f"Unsafe link in archive: {member.name}")
+        if member.islnk() and not _inside(os.path.join(root, member.linkname)):
+            raise KookaburraException(f"Unsafe link in archive: {member.name}")
+        if member.isdev():
+            raise KookaburraException(f"Device in archive: {member.name}")
+    return members
+
+
+class MirrorCache:
+    """MirrorCache.
+
+    MirrorCache keeps a bare mirror of each deployed repository on local
+    disk. A push only fetches the objects of its commit that the mirror
+    doesn't have yet, and the commit is exported without any history with
+    `git archive`. Mirrors that haven't been used recently are evicted once
+    they take more than `budget_bytes`.
+    """
+
+    def __init__(
+        self,
+        root: Optional[str] = None,
+        budget_bytes: Optional[int] = None,
+    ) -> None:
+        self.root = Path(root or env.GIT_MIRROR_ROOT)
+        self.budget_bytes = (
+            env.GIT_MIRROR_BUDGET_BYTES if budget_bytes is None else budget_bytes
+        )
+
+    def path(self, full_name: str) -> Path:
+        return self.root / (re.sub(r"[^A-Za-z0-9._-]", "__", full_name) + ".git")
+
+    @contextmanager
+    def _lock(self, mirror: Path, blocking: bool = True) -> Iterator[bool]:
+        """Lock a mirror across threads and processes sharing the disk."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(mirror.with_suffix(".lock"), "w") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _fetch(self, repo: Repo, clone_url: str, sha: str) -> None:
+        start = time.perf_counter()
+        try:
+            repo.git.fetch("--no-tags", clone_url, sha)
+        except GitCommandError as e:
+            # git echoes the URL, which carries the token
+            stderr = re.sub(r"//[^/@]+@", "//", str(e.stderr)).strip()
+            raise KookaburraException(f"Could not fetch {sha}: {stderr}") from None
+        metrics.inc("git_mirror_fetch_ms", (time.perf_counter() - start) * 1000)
+
+    def checkout(
+        self,
+        clone_url: str,
+        full_name: str,
+        sha: str,
+        to_path: str,
+    ) -> Dict:
+        """Write the files of commit `sha` of the repo to `to_path`.
+        Args:
+            clone_url (str): The URL to fetch from, with any credentials. It
+                is never stored in the mirror, as tokens expire.
+        Returns:
+            Dict: Whether the mirror had to be created and had the commit,
+                and the bytes written.
+        """
+        mirror = self.path(full_name)
+        with self._lock(mirror):
+            created = not mirror.exists()
+            if created:
+                Repo.init(mirror, bare=True)
+            repo = Repo(mirror)
+            try:
+                repo.git.cat_file("-e", f"{sha}^{{commit}}")
+                fetched = False
+            except GitCommandError:
+                self._fetch(repo, clone_url, sha)
+                fetched = True
+            repo.git.update_ref(DEPLOYED_REF, sha)
+            with tempfile.SpooledTemporaryFile(max_size=_SPOOL_BYTES) as archive:
+                repo.archive(cast(BinaryIO, archive), treeish=sha, format="tar")
+                archive.seek(0)
+                with tarfile.open(fileobj=archive) as tar:
+                    members = _safe_members(tar, to_path)
+                    tar.extractall(to_path, members=members, **_EXTRACT_FILTER)
+                    size = sum(m.size for m in members if m.isfile())
+            # the modification time orders mirrors for eviction
+            os.utime(mirror)
+        result = "miss" if created else "hit"
+        metrics.inc("git_mirror", result=result)
+        self.evict(keep=mirror)
+        return {"mirror": result, "fetched": fetched, "bytes": size}
+
+    def evict(self, keep: Optional[Path] = None) -> int:
+        """Remove the least recently used mirrors until they fit the budget.
+
+        Mirrors in use are skipped.
+        Returns:
+            int: How many mirrors were removed.
+        """
+        if not self.root.exists():
+            return 0
+        mirrors = sorted(
+            (p for p in self.root.glob("*.git") if p.is_dir()),
+            key=lambda p: p.stat().st_mtime,
+        )
+        sizes = {p: _du(p) for p in mirrors}
+        total = sum(sizes.values())
+        evicted = 0
+        for mirror in mirrors:
+            if total <= self.budget_bytes:
+                break
+            if mirror == keep:
+                continue
+            with self._lock(mirror, blocking=False) as locked:
+                if not locked:
+                    continue
+                log.info(f"Evicting the git mirror {mirror.name}")
+                shutil.rmtree(mirror)
+            total -= sizes[mirror]
+            evicted += 1
+        metrics.inc("git_mirror_evictions", evicted)
+        metrics.set("git_mirror_bytes", total)
+        return evicted
+
+
+mirror_cache = MirrorCache()
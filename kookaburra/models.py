@@ -1,11 +1,14 @@
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional
 from uuid import uuid4
 
 from pydantic import UUID4, BaseModel, EmailStr
-from sqlalchemy import Column, DateTime
+from sqlalchemy import Column, DateTime, Integer, Text
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlmodel import JSON, Field, Relationship, SQLModel
 
+from kookaburra.const import JOB_QUEUED
+
 
 class TimestampsMixin(BaseModel):
     created_at: Optional[datetime] = Field(
@@ -118,6 +121,20 @@ class LLMCreate(BaseLlm):
     githubuser_id: UUID4
 
 
+class LlmUpdate(SQLModel):
+    history_max_turns: Optional[int] = Field(
+        default=None,
+        ge=0,
+    )
+    history_max_tokens: Optional[int] = Field(
+        default=None,
+        ge=0,
+    )
+    response_cache_enabled: bool = Field(
+        default=False,
+    )
+
+
 class Llm(
     BaseLlm,
     UUIDMixin,
@@ -134,6 +151,249 @@ class Llm(
     githubuser: GitHubUser = Relationship(
         back_populates="llms",
     )
+    history_max_turns: Optional[int] = Field(
+        default=None,
+        nullable=True,
+    )
+    history_max_tokens: Optional[int] = Field(
+        default=None,
+        nullable=True,
+    )
+    response_cache_enabled: bool = Field(
+        default=False,
+        nullable=False,
+    )
+    deployed_sha: Optional[str] = Field(
+        default=None,
+        nullable=True,
+    )
+    cold_start_ms: Optional[int] = Field(
+        default=None,
+        nullable=True,
+    )
+    warm_ms: Optional[int] = Field(
+        default=None,
+        nullable=True,
+    )
+    deps_hash: Optional[str] = Field(
+        default=None,
+        nullable=True,
+    )
+    tree_hash: Optional[str] = Field(
+        default=None,
+        nullable=True,
+    )
+    # the modal app serving modal_url, and the one it replaced, which is
+    # stopped once drain_until has passed
+    app_name: Optional[str] = Field(
+        default=None,
+        nullable=True,
+    )
+    previous_app_name: Optional[str] = Field(
+        default=None,
+        nullable=True,
+    )
+    previous_sha: Optional[str] = Field(
+        default=None,
+        nullable=True,
+    )
+    drain_until: Optional[datetime] = Field(
+        default=None,
+        index=True,
+        nullable=True,
+    )
+    # the last SMS or deploy, written in batches, see `kookaburra.idle`
+    last_active_at: Optional[datetime] = Field(
+        default=None,
+        index=True,
+        nullable=True,
+    )
+    # set while the modal app is stopped for being idle, until it is
+    # redeployed by a revival that started at waking_at
+    idle_stopped_at: Optional[datetime] = Field(
+        default=None,
+        index=True,
+        nullable=True,
+    )
+    waking_at: Optional[datetime] = Field(
+        default=None,
+        nullable=True,
+    )
+    # the messages seen in each hour of the day, in UTC, and the last
+    # keep-warm ping, see `kookaburra.warmup`
+    active_hours: Optional[List[int]] = Field(
+        default=None,
+        sa_column=Column(ARRAY(Integer), nullable=True),
+    )
+    warmed_at: Optional[datetime] = Field(
+        default=None,
+        nullable=True,
+    )
+
+
+class BaseSmsJob(SQLModel):
+    llm_id: UUID4 = Field(
+        index=True,
+        nullable=False,
+    )
+    message_sid: Optional[str] = Field(
+        default=None,
+        unique=True,
+        nullable=True,
+    )
+    from_number: str = Field(
+        nullable=False,
+    )
+    to_number: str = Field(
+        nullable=False,
+    )
+    body: str = Field(
+        nullable=False,
+    )
+
+
+class SmsJobCreate(BaseSmsJob):
+    ...
+
+
+class SmsJob(
+    BaseSmsJob,
+    UUIDMixin,
+    TimestampsMixin,
+    table=True,
+):
+    __tablename__ = "smsjobs"
+
+    status: str = Field(
+        default=JOB_QUEUED,
+        index=True,
+        nullable=False,
+    )
+    attempts: int = Field(
+        default=0,
+        nullable=False,
+    )
+    last_error: Optional[str] = Field(
+        default=None,
+        nullable=True,
+    )
+    run_after: datetime = Field(
+        default_factory=datetime.utcnow,
+        index=True,
+        nullable=False,
+    )
+    # set once the job is held for its stopped llm to be redeployed
+    waiting_since: Optional[datetime] = Field(
+        default=None,
+        nullable=True,
+    )
+    started_at: Optional[datetime] = Field(
+        default=None,
+        nullable=True,
+    )
+    # set once the reply has been sent, so a retry doesn't send it again
+    sent_at: Optional[datetime] = Field(
+        default=None,
+        nullable=True,
+    )
+    finished_at: Optional[datetime] = Field(
+        default=None,
+        nullable=True,
+    )
+    queued_ms: Optional[int] = Field(
+        default=None,
+        nullable=True,
+    )
+    history_ms: Optional[int] = Field(
+        default=None,
+        nullable=True,
+    )
+    respond_ms: Optional[int] = Field(
+        default=None,
+        nullable=True,
+    )
+    send_ms: Optional[int] = Field(
+        default=None,
+        nullable=True,
+    )
 
 
 GitHubUser.update_forward_refs()
+
+
+class BaseDeployJob(SQLModel):
+    githubuser_id: UUID4 = Field(
+        index=True,
+        nullable=False,
+    )
+    full_name: str = Field(
+        nullable=False,
+    )
+    ref: str = Field(
+        nullable=False,
+    )
+    sha: str = Field(
+        nullable=False,
+    )
+
+
+class DeployJobCreate(BaseDeployJob):
+    payload: Dict
+
+
+class DeployJobRead(BaseDeployJob):
+    id: UUID4
+    status: str
+    attempts: int
+    last_error: Optional[str]
+    stages: Dict
+    created_at: datetime
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
+
+
+class DeployJobLogRead(DeployJobRead):
+    log: str
+
+
+class DeployJob(
+    BaseDeployJob,
+    UUIDMixin,
+    TimestampsMixin,
+    table=True,
+):
+    __tablename__ = "deployjobs"
+
+    payload: Dict = Field(
+        sa_column=Column(JSON, nullable=False),
+    )
+    status: str = Field(
+        default=JOB_QUEUED,
+        index=True,
+        nullable=False,
+    )
+    attempts: int = Field(
+        default=0,
+        nullable=False,
+    )
+    last_error: Optional[str] = Field(
+        default=None,
+        nullable=True,
+    )
+    started_at: Optional[datetime] = Field(
+        default=None,
+        nullable=True,
+    )
+    finished_at: Optional[datetime] = Field(
+        default=None,
+        nullable=True,
+    )
+    # milliseconds spent in each stage of the deploy, by stage name
+    stages: Dict = Field(
+        default_factory=dict,
+        sa_column=Column(JSON, nullable=False),
+    )
+    log: str = Field(
+        default="",
+        sa_column=Column(Text, nullable=False),
+    )
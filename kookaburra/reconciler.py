@@ -0,0 +1,164 @@
+import asyncio
+import re
+import time
+from typing import Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import text
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from kookaburra.const import MODAL_RECONCILE_LOCK
+from kookaburra.db import psql_session
+from kookaburra.deployment import deploy_svc
+from kookaburra.log import log
+from kookaburra.metrics import metrics
+from kookaburra.models import Llm
+from kookaburra.settings import env
+from kookaburra.types import ModalApp
+from kookaburra.worker import WorkerPool
+
+# an app kookaburra deployed is named after its llm, and maybe a slot
+APP_NAME = re.compile(r"^[0-9a-f]{8}(-[0-9a-f]{4}){3}-[0-9a-f]{12}(-[a-z])?$")
+
+
+class ModalReconciler:
+    """ModalReconciler.
+
+    ModalReconciler stops the Modal apps that no Llm routes to anymore, e.g.
+    those of deleted Llms or of versions that failed to drain. Apps that
+    kookaburra didn't name, and apps younger than the grace period, which may
+    be deploys waiting for their cutover, are left alone.
+    """
+
+    def __init__(self) -> None:
+        self.pool = WorkerPool(
+            name="reconcile",
+            size=1,
+            poll_seconds=env.MODAL_RECONCILE_INTERVAL_SECONDS,
+            work=self.run,
+        )
+        self._stopping: Set[asyncio.Task] = set()
+
+    async def list_apps(self) -> List[ModalApp]:  # pragma: no cover
+        """The apps of the Modal account that aren't stopped."""
+        # the app list is only in the client's protobuf API
+        from google.protobuf import empty_pb2  # type: ignore
+        from modal.client import AioClient
+        from modal_proto import api_pb2
+        from modal_utils.async_utils import synchronizer
+
+        @synchronizer
+        async def _app_list() -> api_pb2.AppListResponse:
+            aio_client = await AioClient.from_env()
+            return await aio_client.stub.AppList(empty_pb2.Empty())
+
+        res = await _app_list()
+        return [
+            ModalApp(name=app.description, created_at=app.created_at)
+            for app in res.apps
+            if app.state != api_pb2.APP_STATE_STOPPED
+        ]
+
+    async def app_names_in_use(self, psql: AsyncSession) -> Set[str]:
+        rows = await psql.execute(select(Llm.id, Llm.app_name, Llm.previous_app_name))
+        names: Set[str] = set()
+        for llm_id, app_name, previous_app_name in rows.all():
+            # apps deployed before blue/green deploys are named after their llm
+            names.add(app_name or str(llm_id))
+            if previous_app_name is not None:
+                names.add(previous_app_name)
+        return names
+
+    def orphans(
+        self,
+        apps: List[ModalApp],
+        in_use: Set[str],
+        now: Optional[float] = None,
+    ) -> List[str]:
+        now = time.time() if now is None else now
+        return sorted(
+            app.name
+            for app in apps
+            if APP_NAME.match(app.name)
+            and app.name not in in_use
+            and now - app.created_at >= env.MODAL_RECONCILE_GRACE_SECONDS
+        )
+
+    async def stop(self, app_names: Iterable[str]) -> int:
+        """Stop apps, a bounded number at a time.
+
+        A failed stop is logged and left for the next reconciliation.
+        Returns:
+            int: The number of apps stopped.
+        """
+        limit = asyncio.Semaphore(env.MODAL_RECONCILE_CONCURRENCY)
+
+        async def _stop(app_name: str) -> bool:
+            async with limit:
+                try:
+                    await deploy_svc.stop_modal_app(app_name)
+                except Exception:
+                    log.exception(f"Could not stop the modal app {app_name}")
+                    metrics.inc("modal_app_stops", ok="false")
+                    return False
+            log.info(f"Stopped the modal app {app_name}")
+            metrics.inc("modal_app_stops", ok="true")
+            return True
+
+        return sum(await asyncio.gather(*[_stop(name) for name in app_names]))
+
+    def stop_later(self, app_names: Iterable[str]) -> None:
+        """Stop apps in the background, e.g. those of a deleted Llm.
+
+        Apps that fail to stop are orphans, left for the next reconciliation.
+        """
+        task = asyncio.create_task(self.stop(app_names))
+        self._stopping.add(task)
+        task.add_done_callback(self._stopping.discard)
+
+    async def close(self) -> None:
+        await asyncio.gather(*self._stopping)
+
+    async def reconcile(self, dry_run: Optional[bool] = None) -> Dict[str, int]:
+        """Stop the apps that no Llm uses.
+
+        Only one process reconciles at a time, the others skip their turn.
+        Returns:
+            Dict[str, int]: The number of apps listed, of orphans, and of
+                orphans stopped.
+        """
+        dry_run = env.MODAL_RECONCILE_DRY_RUN if dry_run is None else dry_run
+        start = time.perf_counter()
+        async with psql_session() as psql:
+            locked = (
+                await psql.execute(
+                    text("SELECT pg_try_advisory_xact_lock(:key)"),
+                    {"key": MODAL_RECONCILE_LOCK},
+                )
+            ).scalar()
+            if not locked:
+                log.info("Another process is reconciling the modal apps.")
+                return {}
+            apps = await self.list_apps()
+            orphans = self.orphans(apps, await self.app_names_in_use(psql))
+            if dry_run:
+                for name in orphans:
+                    log.warning(f"Would stop the modal app {name} (dry run)")
+                stopped = 0
+            else:
+                stopped = await self.stop(orphans)
+            await psql.rollback()
+        counts = {"apps": len(apps), "orphans": len(orphans), "stopped": stopped}
+        for key, value in counts.items():
+            metrics.set(f"modal_reconcile_{key}", value)
+        metrics.set("modal_reconcile_ms", int((time.perf_counter() - start) * 1000))
+        log.info(f"Reconciled the modal apps: {counts}")
+        return counts
+
+    async def run(self) -> bool:
+        await self.reconcile()
+        # always wait for the next interval
+        return False
+
+
+modal_reconciler = ModalReconciler()
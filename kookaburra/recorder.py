@@ -0,0 +1,49 @@
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, List
+
+from kookaburra.log import log
+
+
+class DeployRecorder:
+    """DeployRecorder.
+
+    DeployRecorder collects the log lines and the time spent in each stage of
+    one deploy, so they can be stored with its job.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.lines: List[str] = []
+        self.stages: Dict[str, int] = {}
+
+    def log(self, message: str) -> None:
+        log.info(message)
+        self.lines.append(f"{datetime.utcnow().isoformat()} {message}")
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[Dict[str, int]]:
+        """Time the block as the stage `name`, in milliseconds.
+
+        Anything the block counts in the yielded dict is recorded with the
+        stage, e.g. `{"bytes": 1024}` as `{name}_bytes`.
+        """
+        start = time.perf_counter()
+        self.log(f"{name}: started")
+        counts: Dict[str, int] = {}
+        try:
+            yield counts
+        finally:
+            counts["ms"] = int((time.perf_counter() - start) * 1000)
+            for key, value in counts.items():
+                self.stages[f"{name}_{key}"] = value
+            self.log(f"{name}: {counts}")
+
+    @property
+    def output(self) -> str:
+        """The log, without its oldest lines if it is over `max_bytes`."""
+        data = "\n".join(self.lines).encode("utf8")
+        if len(data) > self.max_bytes:
+            data = data[-self.max_bytes :]
+        return data.decode("utf8", errors="ignore")
@@ -0,0 +1,124 @@
+import fcntl
+import os
+import shutil
+import stat
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+from kookaburra.const import KOOKABURRA_DEPLOY_PATH
+from kookaburra.log import log
+from kookaburra.settings import env
+from kookaburra_deployment.bundle import Bundle
+
+LOCK = ".lock"
+
+
+class RuntimeCache:
+    """RuntimeCache.
+
+    RuntimeCache keeps a pristine, read-only copy of kookaburra_deployment per
+    version of its files, and hardlinks it into each deploy root, so the
+    runtime is copied once per version rather than once per deploy. Files
+    are copied instead when the deploy root is on another filesystem. Old
+    versions are removed only while no deploy is linking from the cache.
+    """
+
+    def __init__(
+        self,
+        src: str = KOOKABURRA_DEPLOY_PATH,
+        root: Optional[str] = None,
+    ) -> None:
+        self.src = Path(src)
+        self.root = Path(root or env.DEPLOY_RUNTIME_CACHE_ROOT)
+
+    @contextmanager
+    def _lock(self, exclusive: bool) -> Iterator[bool]:
+        """Lock the cache across threads and processes sharing the disk.
+
+        Deploys share the lock, removing old versions takes it alone, and
+        doesn't wait for it.
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / LOCK, "w") as f:
+            try:
+                fcntl.flock(
+                    f, (fcntl.LOCK_EX | fcntl.LOCK_NB) if exclusive else fcntl.LOCK_SH
+                )
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def pristine(self) -> Path:
+        """The copy of the current runtime files, made if it doesn't exist."""
+        bundle = Bundle(self.src)
+        path = self.root / bundle.digest[:16]
+        if path.exists():
+            return path
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(dir=self.root, prefix=".tmp-"))
+        for rel in bundle.files:
+            (tmp / rel).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(self.src / rel, tmp / rel)
+            # a deploy must never change the files it shares with others
+            os.chmod(tmp / rel, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        try:
+            os.rename(tmp, path)
+        except OSError:  # pragma: no cover
+            # another process made it first
+            shutil.rmtree(tmp)
+            return path
+        log.info(f"Cached the runtime {path.name}")
+        return path
+
+    def prune(self, keep: Path) -> bool:
+        """Remove the versions other than `keep`, unless a deploy is linking.
+        Returns:
+            bool: Whether the cache was pruned, rather than in use.
+        """
+        with self._lock(exclusive=True) as locked:
+            if not locked:
+                return False
+            for old in self.root.iterdir():
+                if (
+                    old != keep
+                    and old.name != LOCK
+                    and not old.name.startswith(".tmp-")
+                ):
+                    shutil.rmtree(old, ignore_errors=True)
+        return True
+
+    def link_into(self, deploy_root: Path) -> Dict[str, int]:
+        """Add the runtime files to a deploy root, over any app files.
+        Returns:
+            Dict[str, int]: The number of files linked and copied, and the
+                bytes copied.
+        """
+        counts = {"linked": 0, "copied": 0, "copied_bytes": 0}
+        with self._lock(exclusive=False):
+            pristine = self.pristine()
+            for src in sorted(p for p in pristine.rglob("*") if p.is_file()):
+                dst = deploy_root / src.relative_to(pristine)
+                if dst.is_dir() and not dst.is_symlink():
+                    shutil.rmtree(dst)
+                elif dst.exists() or dst.is_symlink():
+                    dst.unlink()
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    os.link(src, dst)
+                    counts["linked"] += 1
+                except OSError:
+                    shutil.copy2(src, dst)
+                    counts["copied"] += 1
+                    counts["copied_bytes"] += src.stat().st_size
+        # a deploy still linking an old version keeps it, until the next one
+        self.prune(keep=pristine)
+        return counts
+
+
+runtime_cache = RuntimeCache()
@@ -1,5 +1,6 @@
 import os
 import sys
+import tempfile
 
 from pydantic import BaseSettings, Field
 
@@ -51,6 +52,46 @@ class _Env(BaseSettings):
         env="MODAL_TOKEN_SECRET",
         description="The modal token secret.",
     )
+    METRICS_TOKEN: str = Field(
+        "",
+        env="METRICS_TOKEN",
+        description="The bearer token /metrics requires, which is off without it.",
+    )
+    MODAL_DEPLOY_CONCURRENCY: int = Field(
+        2,
+        env="MODAL_DEPLOY_CONCURRENCY",
+        description="The maximum number of modal deploys running per process.",
+    )
+    MODAL_DEPLOY_TIMEOUT_SECONDS: float = Field(
+        900.0,
+        env="MODAL_DEPLOY_TIMEOUT_SECONDS",
+        description="How long a modal deploy may run before it is killed.",
+    )
+    MODAL_RECONCILE: bool = Field(
+        False,
+        env="MODAL_RECONCILE",
+        description="Periodically stop the Modal apps that no LLM uses.",
+    )
+    MODAL_RECONCILE_INTERVAL_SECONDS: float = Field(
+        3600.0,
+        env="MODAL_RECONCILE_INTERVAL_SECONDS",
+        description="How often the Modal apps are reconciled with the LLMs.",
+    )
+    MODAL_RECONCILE_CONCURRENCY: int = Field(
+        4,
+        env="MODAL_RECONCILE_CONCURRENCY",
+        description="The maximum number of Modal apps stopped at once.",
+    )
+    MODAL_RECONCILE_GRACE_SECONDS: float = Field(
+        1800.0,
+        env="MODAL_RECONCILE_GRACE_SECONDS",
+        description="How old an unused app must be to be stopped, sparing deploys.",
+    )
+    MODAL_RECONCILE_DRY_RUN: bool = Field(
+        False,
+        env="MODAL_RECONCILE_DRY_RUN",
+        description="Log the Modal apps the reconciler would stop, but keep them.",
+    )
     LOG_LEVEL: str = Field(
         "WARNING",
         env="LOG_LEVEL",
@@ -66,6 +107,21 @@ class _Env(BaseSettings):
         env="GH_APP_PRIVATE_KEY_PATH",
         description="The GitHub App private key path.",
     )
+    GH_APP_TOKEN_REFRESH_SECONDS: float = Field(
+        60.0,
+        env="GH_APP_TOKEN_REFRESH_SECONDS",
+        description="How long before they expire GitHub App tokens are replaced.",
+    )
+    GIT_MIRROR_ROOT: str = Field(
+        "/tmp/kookaburra-mirrors",
+        env="GIT_MIRROR_ROOT",
+        description="Where the bare mirrors of deployed repositories are kept.",
+    )
+    GIT_MIRROR_BUDGET_BYTES: int = Field(
+        5 * 1024 * 1024 * 1024,
+        env="GIT_MIRROR_BUDGET_BYTES",
+        description="The disk the mirrors may use before the oldest are evicted.",
+    )
     GH_CLIENT_ID: str = Field(
         "",
         env="GH_CLIENT_ID",
@@ -111,6 +167,322 @@ class _Env(BaseSettings):
         env="PSQL_POOL_PRE_PING",
         description="The PSQL database pre pool ping.",
     )
+    SMS_INGEST_MODE: str = Field(
+        "sync",
+        env="SMS_INGEST_MODE",
+        description="How inbound SMS are handled, either sync or queue.",
+    )
+    SMS_WORKERS: int = Field(
+        4,
+        env="SMS_WORKERS",
+        description="The number of SMS job workers to run per process.",
+    )
+    SMS_WORKER_POLL_SECONDS: float = Field(
+        1.0,
+        env="SMS_WORKER_POLL_SECONDS",
+        description="How long an idle SMS worker waits before polling again.",
+    )
+    SMS_JOB_MAX_ATTEMPTS: int = Field(
+        3,
+        env="SMS_JOB_MAX_ATTEMPTS",
+        description="The maximum number of attempts for an SMS job.",
+    )
+    SMS_JOB_RETRY_BACKOFF_SECONDS: float = Field(
+        5.0,
+        env="SMS_JOB_RETRY_BACKOFF_SECONDS",
+        description="The base backoff between SMS job attempts.",
+    )
+    SMS_JOB_TIMEOUT_SECONDS: float = Field(
+        330.0,
+        env="SMS_JOB_TIMEOUT_SECONDS",
+        description="How long an SMS job may run before it is reclaimed.",
+    )
+
+    LLM_ROUTING_CACHE_TTL_SECONDS: float = Field(
+        300.0,
+        env="LLM_ROUTING_CACHE_TTL_SECONDS",
+        description="How long a phone number to LLM mapping is cached.",
+    )
+    LLM_ROUTING_CACHE_NEGATIVE_TTL_SECONDS: float = Field(
+        30.0,
+        env="LLM_ROUTING_CACHE_NEGATIVE_TTL_SECONDS",
+        description="How long an unknown phone number is cached.",
+    )
+    CACHE_INVALIDATION_LISTEN: bool = Field(
+        True,
+        env="CACHE_INVALIDATION_LISTEN",
+        description="Listen for cache invalidations from other workers.",
+    )
+
+    GS_CHAT_HEAD_MAX_TURNS: int = Field(
+        20,
+        env="GS_CHAT_HEAD_MAX_TURNS",
+        description="Turns a chat head holds before compaction, past what reads need.",
+    )
+    GS_CHAT_SEGMENT_MAX_TURNS: int = Field(
+        500,
+        env="GS_CHAT_SEGMENT_MAX_TURNS",
+        description="The maximum number of turns in a compacted chat segment.",
+    )
+    GS_CHAT_WRITE_ATTEMPTS: int = Field(
+        5,
+        env="GS_CHAT_WRITE_ATTEMPTS",
+        description="How often a conflicting chat write is retried.",
+    )
+
+    GS_DOWNLOAD_CONCURRENCY: int = Field(
+        16,
+        env="GS_DOWNLOAD_CONCURRENCY",
+        description="The maximum number of concurrent GCS requests per process.",
+    )
+
+    GS_CHAT_HISTORY_MAX_TURNS: int = Field(
+        50,
+        env="GS_CHAT_HISTORY_MAX_TURNS",
+        description="The default number of turns of chat history sent to an LLM.",
+    )
+    GS_CHAT_HISTORY_MAX_TOKENS: int = Field(
+        2000,
+        env="GS_CHAT_HISTORY_MAX_TOKENS",
+        description="The default number of tokens of chat history sent to an LLM.",
+    )
+    TOKENIZER_ENCODING: str = Field(
+        "p50k_base",
+        env="TOKENIZER_ENCODING",
+        description="The tiktoken encoding used to count chat history tokens.",
+    )
+
+    HTTP_HTTP2: bool = Field(
+        True,
+        env="HTTP_HTTP2",
+        description="Use HTTP/2 for outbound requests.",
+    )
+    HTTP_MAX_CONNECTIONS_PER_HOST: int = Field(
+        20,
+        env="HTTP_MAX_CONNECTIONS_PER_HOST",
+        description="The maximum number of outbound connections per host.",
+    )
+    HTTP_MAX_KEEPALIVE_CONNECTIONS_PER_HOST: int = Field(
+        10,
+        env="HTTP_MAX_KEEPALIVE_CONNECTIONS_PER_HOST",
+        description="The maximum number of idle outbound connections per host.",
+    )
+    HTTP_MAX_HOSTS: int = Field(
+        256,
+        env="HTTP_MAX_HOSTS",
+        description="The number of hosts whose outbound clients are kept open.",
+    )
+    HTTP_KEEPALIVE_EXPIRY_SECONDS: float = Field(
+        60.0,
+        env="HTTP_KEEPALIVE_EXPIRY_SECONDS",
+        description="How long an idle outbound connection is kept open.",
+    )
+    HTTP_CONNECT_TIMEOUT_SECONDS: float = Field(
+        5.0,
+        env="HTTP_CONNECT_TIMEOUT_SECONDS",
+        description="The outbound connect timeout.",
+    )
+    HTTP_READ_TIMEOUT_SECONDS: float = Field(
+        300.0,
+        env="HTTP_READ_TIMEOUT_SECONDS",
+        description="The outbound read timeout.",
+    )
+    HTTP_WRITE_TIMEOUT_SECONDS: float = Field(
+        30.0,
+        env="HTTP_WRITE_TIMEOUT_SECONDS",
+        description="The outbound write timeout.",
+    )
+    HTTP_POOL_TIMEOUT_SECONDS: float = Field(
+        10.0,
+        env="HTTP_POOL_TIMEOUT_SECONDS",
+        description="How long to wait for a free outbound connection.",
+    )
+
+    LLM_RESPONSE_CACHE_TTL_SECONDS: float = Field(
+        3600.0,
+        env="LLM_RESPONSE_CACHE_TTL_SECONDS",
+        description="How long a cached LLM response is reused.",
+    )
+    LLM_RESPONSE_CACHE_MAX_BYTES: int = Field(
+        16 * 1024 * 1024,
+        env="LLM_RESPONSE_CACHE_MAX_BYTES",
+        description="The memory budget of the LLM response cache per process.",
+    )
+    LLM_RESPONSE_CACHE_HISTORY_TURNS: int = Field(
+        2,
+        env="LLM_RESPONSE_CACHE_HISTORY_TURNS",
+        description="The number of recent turns that are part of a cache key.",
+    )
+    LLM_TIMEOUT_SECONDS: float = Field(
+        300.0,
+        env="LLM_TIMEOUT_SECONDS",
+        description="The longest an LLM response is waited for.",
+    )
+    LLM_TIMEOUT_MIN_SECONDS: float = Field(
+        10.0,
+        env="LLM_TIMEOUT_MIN_SECONDS",
+        description="The shortest adaptive LLM timeout.",
+    )
+    LLM_TIMEOUT_P99_MULTIPLIER: float = Field(
+        3.0,
+        env="LLM_TIMEOUT_P99_MULTIPLIER",
+        description="The adaptive LLM timeout as a multiple of the p99 latency.",
+    )
+    LLM_LATENCY_WINDOW: int = Field(
+        100,
+        env="LLM_LATENCY_WINDOW",
+        description="The number of recent LLM latencies kept per LLM.",
+    )
+    LLM_LATENCY_MIN_SAMPLES: int = Field(
+        20,
+        env="LLM_LATENCY_MIN_SAMPLES",
+        description="The number of latencies needed before timeouts adapt.",
+    )
+    LLM_HEDGE: bool = Field(
+        False,
+        env="LLM_HEDGE",
+        description="Send a second LLM request once the first exceeds the p95.",
+    )
+    LLM_BREAKER_FAILURES: int = Field(
+        5,
+        env="LLM_BREAKER_FAILURES",
+        description="The consecutive LLM failures that open the circuit breaker.",
+    )
+    LLM_BREAKER_COOLDOWN_SECONDS: float = Field(
+        60.0,
+        env="LLM_BREAKER_COOLDOWN_SECONDS",
+        description="How long an open circuit breaker waits before a probe.",
+    )
+    LLM_FALLBACK_MESSAGE: str = Field(
+        "",
+        env="LLM_FALLBACK_MESSAGE",
+        description="The reply sent when an LLM fails, empty to raise instead.",
+    )
+    WARMUP_REQUESTS: int = Field(
+        3,
+        env="WARMUP_REQUESTS",
+        description="The number of warm-up requests sent after a deploy.",
+    )
+    WARMUP_TIMEOUT_SECONDS: float = Field(
+        300.0,
+        env="WARMUP_TIMEOUT_SECONDS",
+        description="How long a warm-up request may take, including a cold start.",
+    )
+    KEEP_WARM: bool = Field(
+        False,
+        env="KEEP_WARM",
+        description="Keep the Modal apps of active LLMs warm.",
+    )
+    KEEP_WARM_INTERVAL_SECONDS: float = Field(
+        45.0,
+        env="KEEP_WARM_INTERVAL_SECONDS",
+        description="How often active LLMs are pinged.",
+    )
+    KEEP_WARM_WINDOW_SECONDS: float = Field(
+        3600.0,
+        env="KEEP_WARM_WINDOW_SECONDS",
+        description="How long an LLM is kept warm after its last message.",
+    )
+    KEEP_WARM_MIN_HOURLY_MESSAGES: int = Field(
+        3,
+        env="KEEP_WARM_MIN_HOURLY_MESSAGES",
+        description="The messages seen in an hour of the day to keep it warm.",
+    )
+    KEEP_WARM_FORGET_SECONDS: float = Field(
+        7 * 24 * 3600.0,
+        env="KEEP_WARM_FORGET_SECONDS",
+        description="How long an idle LLM is still kept warm at its usual hours.",
+    )
+    ACTIVITY_FLUSH_SECONDS: float = Field(
+        30.0,
+        env="ACTIVITY_FLUSH_SECONDS",
+        description="How often the last activity of LLMs is written to the db.",
+    )
+    IDLE_STOP: bool = Field(
+        False,
+        env="IDLE_STOP",
+        description="Stop the Modal apps of LLMs idle for IDLE_STOP_DAYS.",
+    )
+    IDLE_STOP_DAYS: float = Field(
+        7.0,
+        env="IDLE_STOP_DAYS",
+        description="How long an LLM goes without SMS or deploys to be stopped.",
+    )
+    IDLE_POLL_SECONDS: float = Field(
+        600.0,
+        env="IDLE_POLL_SECONDS",
+        description="How often idle LLMs are looked for.",
+    )
+    REVIVE_TIMEOUT_SECONDS: float = Field(
+        1800.0,
+        env="REVIVE_TIMEOUT_SECONDS",
+        description="How long an SMS waits for its stopped LLM to be redeployed.",
+    )
+    REVIVE_POLL_SECONDS: float = Field(
+        10.0,
+        env="REVIVE_POLL_SECONDS",
+        description="How often an SMS checks whether its LLM has been redeployed.",
+    )
+    DEPLOY_WORKERS: int = Field(
+        1,
+        env="DEPLOY_WORKERS",
+        description="The number of deploy job workers to run per process.",
+    )
+    DEPLOY_WORKERS_IN_APP: bool = Field(
+        True,
+        env="DEPLOY_WORKERS_IN_APP",
+        description="Run the deploy workers in the web app, not only standalone.",
+    )
+    DEPLOY_WORKER_POLL_SECONDS: float = Field(
+        2.0,
+        env="DEPLOY_WORKER_POLL_SECONDS",
+        description="How long an idle deploy worker waits before polling again.",
+    )
+    DEPLOY_MAX_CONCURRENT: int = Field(
+        4,
+        env="DEPLOY_MAX_CONCURRENT",
+        description="The maximum number of deploys running across all workers.",
+    )
+    DEPLOY_MAX_CONCURRENT_PER_USER: int = Field(
+        1,
+        env="DEPLOY_MAX_CONCURRENT_PER_USER",
+        description="The maximum number of deploys running for one user.",
+    )
+    DEPLOY_JOB_TIMEOUT_SECONDS: float = Field(
+        1800.0,
+        env="DEPLOY_JOB_TIMEOUT_SECONDS",
+        description="How long a deploy job may run before it is reclaimed.",
+    )
+    DEPLOY_JOB_MAX_ATTEMPTS: int = Field(
+        2,
+        env="DEPLOY_JOB_MAX_ATTEMPTS",
+        description="The maximum number of attempts for a reclaimed deploy job.",
+    )
+    DEPLOY_JOB_MAX_LOG_BYTES: int = Field(
+        64 * 1024,
+        env="DEPLOY_JOB_MAX_LOG_BYTES",
+        description="The most recent deploy log output kept per job.",
+    )
+    DEPLOY_RUNTIME_CACHE_ROOT: str = Field(
+        os.path.join(tempfile.gettempdir(), "kookaburra-runtime"),
+        env="DEPLOY_RUNTIME_CACHE_ROOT",
+        description="Where the runtime is cached, on the filesystem of the deploys.",
+    )
+    DEPLOY_HEALTH_TIMEOUT_SECONDS: float = Field(
+        300.0,
+        env="DEPLOY_HEALTH_TIMEOUT_SECONDS",
+        description="How long a new version has to become ready before it fails.",
+    )
+    DEPLOY_DRAIN_SECONDS: float = Field(
+        600.0,
+        env="DEPLOY_DRAIN_SECONDS",
+        description="How long the previous version stays up, e.g. for a rollback.",
+    )
+    DEPLOY_DRAIN_POLL_SECONDS: float = Field(
+        30.0,
+        env="DEPLOY_DRAIN_POLL_SECONDS",
+        description="How often drained versions are looked for and stopped.",
+    )
 
     class Config:
         env_file = ".env.local"
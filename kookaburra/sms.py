@@ -0,0 +1,285 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional
+
+from fastapi import BackgroundTasks
+from sqlalchemy import and_, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from kookaburra.const import (
+    JOB_FAILED,
+    JOB_QUEUED,
+    JOB_RUNNING,
+    JOB_SUCCEEDED,
+    WAKING_UP_MESSAGE,
+)
+from kookaburra.db import psql_session
+from kookaburra.exc import KookaburraException
+from kookaburra.gs import gs_svc
+from kookaburra.idle import idle_svc
+from kookaburra.llm import llm_svc
+from kookaburra.log import log
+from kookaburra.metrics import metrics
+from kookaburra.models import Llm, SmsJob, SmsJobCreate
+from kookaburra.settings import env
+from kookaburra.twilio import twilio_svc
+from kookaburra.types import FallbackResponse
+from kookaburra.warmup import warmup_svc
+from kookaburra.worker import WorkerPool
+
+
+def _ms(start: float) -> int:
+    return int((time.perf_counter() - start) * 1000)
+
+
+class SmsService:
+    def __init__(self) -> None:
+        self.pool = WorkerPool(
+            name="sms",
+            size=env.SMS_WORKERS,
+            poll_seconds=env.SMS_WORKER_POLL_SECONDS,
+            work=self.process_next,
+        )
+
+    async def reply(
+        self,
+        llm: Llm,
+        body: Dict,
+        bgt: Optional[BackgroundTasks] = None,
+        on_sent: Optional[Callable[[], Awaitable[None]]] = None,
+    ) -> Dict[str, int]:
+        """Generate a reply to an inbound SMS and send it.
+        Args:
+            llm (Llm): The llm that owns the phone number.
+            body (Dict): The Twilio webhook body.
+            bgt (BackgroundTasks): If given, the chat is uploaded after the
+                response is sent, otherwise it is uploaded inline.
+            on_sent (Callable): Awaited as soon as the reply has been sent.
+        Returns:
+            Dict[str, int]: The time spent in each step, in milliseconds.
+        """
+        idle_svc.record_activity(llm)
+        timings = {}
+        start = time.perf_counter()
+        chat_history = await gs_svc.get_sms_chat_history(
+            llm,
+            body["From"],
+        )
+        timings["history_ms"] = _ms(start)
+
+        start = time.perf_counter()
+        response = await llm_svc.respond(
+            llm=llm,
+            message=body["Body"],
+            chat_history=chat_history,
+        )
+        timings["respond_ms"] = _ms(start)
+
+        start = time.perf_counter()
+        twilio_svc.send_message(
+            from_number=body["To"],
+            to_number=body["From"],
+            message=response.message,
+        )
+        timings["send_ms"] = _ms(start)
+        if on_sent is not None:
+            await on_sent()
+
+        if isinstance(response, FallbackResponse):
+            # the Llm didn't answer, its chat history stays as it was
+            pass
+        elif bgt is not None:
+            bgt.add_task(
+                gs_svc.upload_sms_chat,
+                llm,
+                body,
+                response,
+            )
+        else:
+            # the reply has already been sent, so a failed upload must not
+            # cause the job to be retried
+            try:
+                await gs_svc.upload_sms_chat(llm, body, response)
+            except Exception:  # pragma: no cover
+                log.exception(f"Could not upload chat for LLM {llm.id}")
+        return timings
+
+    def send_waking_up(self, to_number: str, from_number: str) -> None:
+        twilio_svc.send_message(
+            from_number=from_number,
+            to_number=to_number,
+            message=WAKING_UP_MESSAGE,
+        )
+        metrics.inc("sms_waking_up")
+
+    async def hold(self, job: SmsJob, llm: Llm, psql: AsyncSession) -> None:
+        """Hold a job until its stopped Llm has been redeployed.
+
+        Waiting isn't an attempt, the job fails only if the Llm doesn't wake
+        up within `REVIVE_TIMEOUT_SECONDS`.
+        """
+        now = datetime.utcnow()
+        await idle_svc.wake(llm_id=llm.id, psql=psql)
+        if job.waiting_since is None:
+            job.waiting_since = now
+            self.send_waking_up(to_number=job.from_number, from_number=job.to_number)
+        if now - job.waiting_since > timedelta(seconds=env.REVIVE_TIMEOUT_SECONDS):
+            job.status = JOB_FAILED
+            job.finished_at = now
+            job.last_error = f"LLM {llm.id} didn't wake up in time"
+        else:
+            job.status = JOB_QUEUED
+            job.attempts -= 1
+            job.run_after = now + timedelta(seconds=env.REVIVE_POLL_SECONDS)
+        psql.add(job)
+        await psql.commit()
+
+    async def enqueue(
+        self,
+        llm: Llm,
+        body: Dict,
+        psql: AsyncSession,
+    ) -> None:
+        """Persist an inbound SMS as a job, ignoring Twilio retries."""
+        now = datetime.utcnow()
+        job = SmsJob(
+            **SmsJobCreate(
+                llm_id=llm.id,
+                message_sid=body.get("MessageSid"),
+                from_number=body["From"],
+                to_number=body["To"],
+                body=body["Body"],
+            ).dict(),
+            created_at=now,
+            updated_at=now,
+            run_after=now,
+        )
+        await psql.execute(
+            insert(SmsJob)
+            .values(**job.dict())
+            .on_conflict_do_nothing(index_elements=["message_sid"])
+        )
+        await psql.commit()
+
+    async def claim(self, psql: AsyncSession) -> Optional[SmsJob]:
+        """Claim the next runnable job.
+
+        Jobs left running by a worker that died are reclaimed once they have
+        been running for twice the job timeout.
+        """
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=2 * env.SMS_JOB_TIMEOUT_SECONDS)
+        job = (
+            (
+                await psql.execute(
+                    select(SmsJob)
+                    .where(
+                        or_(
+                            and_(
+                                SmsJob.status == JOB_QUEUED,
+                                SmsJob.run_after <= now,
+                            ),
+                            and_(
+                                SmsJob.status == JOB_RUNNING,
+                                col(SmsJob.started_at) < stale,
+                            ),
+                        )
+                    )
+                    .order_by(SmsJob.run_after)
+                    .limit(1)
+                    .with_for_update(skip_locked=True)
+                )
+            )
+            .scalars()
+            .first()
+        )
+        if job is None:
+            await psql.rollback()
+            return None
+        job.status = JOB_RUNNING
+        job.started_at = now
+        job.attempts += 1
+        if job.queued_ms is None and job.created_at is not None:
+            job.queued_ms = int((now - job.created_at).total_seconds() * 1000)
+        psql.add(job)
+        await psql.commit()
+        return job
+
+    async def run(self, job: SmsJob, psql: AsyncSession) -> None:
+        llm = await llm_svc.get_by_id(llm_id=job.llm_id, psql=psql)
+
+        async def _sent() -> None:
+            job.sent_at = datetime.utcnow()
+            psql.add(job)
+            await psql.commit()
+
+        timings: Dict[str, int] = {}
+        try:
+            if llm is None:
+                raise KookaburraException(f"Could not find LLM {job.llm_id}")
+            if llm.idle_stopped_at is not None:
+                await self.hold(job=job, llm=llm, psql=psql)
+                return
+            # don't hold a connection, idle in a transaction, during the reply
+            await psql.commit()
+            if job.sent_at is None:
+                timings = await asyncio.wait_for(
+                    self.reply(
+                        llm=llm,
+                        body={
+                            "From": job.from_number,
+                            "To": job.to_number,
+                            "Body": job.body,
+                        },
+                        on_sent=_sent,
+                    ),
+                    timeout=env.SMS_JOB_TIMEOUT_SECONDS,
+                )
+        except Exception as e:
+            log.exception(f"SMS job {job.id} failed on attempt {job.attempts}")
+            job.last_error = repr(e)
+            if job.sent_at is not None:
+                # the reply went out, retrying would send it twice
+                job.status = JOB_SUCCEEDED
+                job.finished_at = datetime.utcnow()
+            elif llm is None or job.attempts >= env.SMS_JOB_MAX_ATTEMPTS:
+                job.status = JOB_FAILED
+                job.finished_at = datetime.utcnow()
+            else:
+                backoff = env.SMS_JOB_RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1)
+                job.status = JOB_QUEUED
+                job.run_after = datetime.utcnow() + timedelta(seconds=backoff)
+        else:
+            job.status = JOB_SUCCEEDED
+            job.finished_at = datetime.utcnow()
+            job.last_error = None
+            for k, v in timings.items():
+                setattr(job, k, v)
+        psql.add(job)
+        await psql.commit()
+
+    async def process_next(self) -> bool:
+        async with psql_session() as psql:
+            job = await self.claim(psql=psql)
+            if job is None:
+                return False
+            await self.run(job=job, psql=psql)
+            return True
+
+
+sms_svc = SmsService()
+
+
+async def _main() -> None:  # pragma: no cover
+    if env.KEEP_WARM:
+        warmup_svc.pool.start()
+    idle_svc.flush_pool.start()
+    await sms_svc.pool.run_forever()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    # run the SMS workers as a standalone process
+    asyncio.run(_main())
@@ -0,0 +1,28 @@
+from functools import lru_cache
+from typing import Any, Optional
+
+from kookaburra.log import log
+from kookaburra.settings import env
+
+
+@lru_cache(maxsize=1)
+def _encoding() -> Optional[Any]:
+    try:
+        import tiktoken
+    except ImportError:  # pragma: no cover
+        log.warning("tiktoken is not installed, token counts are estimated")
+        return None
+    return tiktoken.get_encoding(env.TOKENIZER_ENCODING)  # pragma: no cover
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    """Count the tokens in `text`.
+
+    Chat history is re-read for every message, so counts are cached per text.
+    Without tiktoken the count is estimated at four characters per token.
+    """
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))  # pragma: no cover
@@ -1,6 +1,6 @@
 import time
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
 from pydantic import BaseModel, EmailStr, Json, StrictInt, StrictStr, validator
 
@@ -9,12 +9,32 @@ class BaseResponse(BaseModel):
     message: StrictStr
 
 
+class ChatRequest(BaseModel):
+    message: StrictStr
+    chat_history: List[Tuple[str, str]] = []
+
+
 class HealthResponse(BaseResponse):
     message: StrictStr
     version: StrictStr
     time: datetime
 
 
+class Metric(BaseModel):
+    name: StrictStr
+    labels: Dict[str, str]
+    value: float
+
+
+class MetricsResponse(BaseModel):
+    metrics: List[Metric]
+
+
+class ModalApp(BaseModel):
+    name: StrictStr
+    created_at: float
+
+
 class Scope(BaseModel):
     type: StrictStr
     asgi: Optional[Dict]
@@ -86,5 +106,9 @@ class SMSResponse(BaseResponse):
     ...
 
 
+class FallbackResponse(BaseResponse):
+    ...
+
+
 class UploadContentResponse(BaseResponse):
     ...
@@ -4,6 +4,7 @@ from fastapi.templating import Jinja2Templates
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from kookaburra.db import psql_db
+from kookaburra.deploy_jobs import deploy_job_svc
 from kookaburra.llm import llm_svc
 from kookaburra.user import githubuser_svc
 from kookaburra.utils import _APIRoute
@@ -27,6 +28,7 @@ async def _index(
     psql: AsyncSession = Depends(psql_db),
 ) -> Response:
     llms = []
+    deploys = []
     waitlisted = True
     if request.user.is_authenticated:
         user = await githubuser_svc.get_by_name(
@@ -38,12 +40,18 @@ async def _index(
                 user=user,
                 psql=psql,
             )
+            deploys = await deploy_job_svc.list_for_user(
+                user=user,
+                psql=psql,
+                limit=10,
+            )
             waitlisted = bool(user.waitlisted)
     return templates.TemplateResponse(
         name="index.html",
         context={
             "request": request,
             "llms": llms,
+            "deploys": deploys,
             "waitlisted": waitlisted,
         },
     )
@@ -0,0 +1,150 @@
+import asyncio
+import statistics
+import time
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+import httpx
+from sqlalchemy import and_, or_
+from sqlmodel import col, select
+
+from kookaburra.const import WARMUP_HEADER
+from kookaburra.db import psql_session
+from kookaburra.exc import KookaburraException
+from kookaburra.http import http_clients
+from kookaburra.log import log
+from kookaburra.metrics import metrics
+from kookaburra.models import Llm
+from kookaburra.settings import env
+from kookaburra.worker import WorkerPool
+
+
+class WarmupService:
+    """WarmupService.
+
+    WarmupService sends synthetic requests to deployed Modal apps. After a
+    deploy they absorb the cold start, so the first real SMS doesn't, and the
+    keep-warm scheduler repeats them for Llms whose recent traffic suggests
+    another message is coming soon. The traffic is read from the database,
+    and each Llm is claimed by one process per interval, so every process
+    can run the scheduler. Warm-up requests only build the LLM in the Modal
+    app, they never call OpenAI.
+    """
+
+    def __init__(self) -> None:
+        self.pool = WorkerPool(
+            name="keep-warm",
+            size=1,
+            poll_seconds=env.KEEP_WARM_INTERVAL_SECONDS,
+            work=self.keep_warm,
+        )
+
+    async def _ping(self, modal_url: str) -> None:  # pragma: no cover
+        response = await http_clients.get(modal_url).post(
+            f"{modal_url.strip('/')}/hey",
+            json={"message": "", "chat_history": []},
+            headers={WARMUP_HEADER: "1"},
+            timeout=env.WARMUP_TIMEOUT_SECONDS,
+        )
+        response.raise_for_status()
+
+    async def ready(self, modal_url: str) -> None:  # pragma: no cover
+        """Wait until a freshly deployed version has built its LLM."""
+        deadline = time.monotonic() + env.DEPLOY_HEALTH_TIMEOUT_SECONDS
+        while True:
+            try:
+                response = await http_clients.get(modal_url).get(
+                    f"{modal_url.strip('/')}/ready",
+                    timeout=env.WARMUP_TIMEOUT_SECONDS,
+                )
+                if response.status_code == 200:
+                    return
+            except httpx.HTTPError as e:
+                log.info(f"{modal_url} isn't ready: {e!r}")
+            if time.monotonic() > deadline:
+                raise KookaburraException(
+                    f"{modal_url} wasn't ready after "
+                    f"{env.DEPLOY_HEALTH_TIMEOUT_SECONDS}s."
+                )
+            await asyncio.sleep(1)
+
+    async def warm(self, llm: Llm, modal_url: Optional[str] = None) -> Tuple[int, int]:
+        """Warm up a freshly deployed Llm.
+        Args:
+            modal_url (Optional[str]): The version to warm up, if it isn't
+                serving yet.
+        Returns:
+            Tuple[int, int]: The cold start latency, and the median latency
+                of the requests after it, in milliseconds.
+        """
+        latencies: List[int] = []
+        for _ in range(max(2, env.WARMUP_REQUESTS)):
+            start = time.perf_counter()
+            await self._ping(modal_url or llm.modal_url)
+            latencies.append(int((time.perf_counter() - start) * 1000))
+        cold_start_ms, warm_ms = latencies[0], int(statistics.median(latencies[1:]))
+        log.info(f"Warmed up LLM {llm.id}: cold {cold_start_ms}ms, warm {warm_ms}ms")
+        return cold_start_ms, warm_ms
+
+    async def claim_due(self, now: Optional[datetime] = None) -> List[Llm]:
+        """Claim the Llms to keep warm, that no process pinged this interval.
+
+        An Llm is kept warm if it had traffic recently, or if it usually gets
+        traffic at this hour of the day and hasn't been idle for long.
+        """
+        now = now or datetime.utcnow()
+        async with psql_session() as psql:
+            llms = (
+                (
+                    await psql.execute(
+                        select(Llm)
+                        .where(
+                            col(Llm.idle_stopped_at).is_(None),
+                            or_(
+                                col(Llm.warmed_at).is_(None),
+                                col(Llm.warmed_at)
+                                <= now
+                                - timedelta(seconds=env.KEEP_WARM_INTERVAL_SECONDS),
+                            ),
+                            or_(
+                                col(Llm.last_active_at)
+                                >= now
+                                - timedelta(seconds=env.KEEP_WARM_WINDOW_SECONDS),
+                                and_(
+                                    col(Llm.last_active_at)
+                                    >= now
+                                    - timedelta(seconds=env.KEEP_WARM_FORGET_SECONDS),
+                                    # postgres arrays start at 1
+                                    col(Llm.active_hours)[now.hour + 1]
+                                    >= env.KEEP_WARM_MIN_HOURLY_MESSAGES,
+                                ),
+                            ),
+                        )
+                        .with_for_update(skip_locked=True)
+                    )
+                )
+                .scalars()
+                .all()
+            )
+            for llm in llms:
+                llm.warmed_at = now
+                psql.add(llm)
+            await psql.commit()
+        return list(llms)
+
+    async def keep_warm(self) -> bool:
+        llms = await self.claim_due()
+        results = await asyncio.gather(
+            *[self._ping(llm.modal_url) for llm in llms],
+            return_exceptions=True,
+        )
+        for llm, result in zip(llms, results):
+            ok = not isinstance(result, BaseException)
+            metrics.inc("keep_warm_pings", llm_id=str(llm.id), ok=str(ok).lower())
+            if not ok:
+                log.warning(f"Could not keep LLM {llm.id} warm: {result!r}")
+        # always wait for the next interval
+        return False
+
+
+warmup_svc = WarmupService()
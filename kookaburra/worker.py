@@ -0,0 +1,68 @@
+import asyncio
+from typing import Awaitable, Callable, List
+
+from kookaburra.log import log
+
+
+class WorkerPool:
+    """WorkerPool.
+
+    WorkerPool runs `size` asyncio tasks that each call `work` in a loop.
+    `work` returns True if it did something, in which case it is called again
+    straight away, otherwise the worker sleeps for `poll_seconds` first.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        size: int,
+        poll_seconds: float,
+        work: Callable[[], Awaitable[bool]],
+    ) -> None:
+        self.name = name
+        self.size = size
+        self.poll_seconds = poll_seconds
+        self.work = work
+        self._stopping = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def running(self) -> bool:
+        return any(not t.done() for t in self._tasks)
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._stopping.clear()
+        self._tasks = [
+            asyncio.create_task(self._run(i), name=f"{self.name}-{i}")
+            for i in range(self.size)
+        ]
+        log.info(f"Started {self.size} {self.name} workers")
+
+    async def stop(self) -> None:
+        self._stopping.set()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        log.info(f"Stopped {self.name} workers")
+
+    async def run_forever(self) -> None:  # pragma: no cover
+        self.start()
+        await asyncio.gather(*self._tasks)
+
+    async def _run(self, i: int) -> None:  # pragma: no cover
+        while not self._stopping.is_set():
+            try:
+                did_work = await self.work()
+            except Exception:
+                log.exception(f"{self.name} worker {i} failed")
+                did_work = False
+            if did_work:
+                continue
+            try:
+                await asyncio.wait_for(
+                    self._stopping.wait(),
+                    timeout=self.poll_seconds,
+                )
+            except asyncio.TimeoutError:
+                pass
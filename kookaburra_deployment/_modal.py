@@ -1,71 +1,92 @@
+import importlib
 from pathlib import Path
-from typing import List
+from typing import Dict, List
 
 import modal
 from fastapi import FastAPI
 
-from kookaburra_deployment.main import app
+from kookaburra_deployment.bundle import Bundle
+from kookaburra_deployment.image import (
+    APT_INSTALL_FILE,
+    DEFAULT_PIP_INSTALL,
+    PYPROJECT_FILE,
+    REQUIREMENTS_FILE,
+    read_lines,
+)
+from kookaburra_deployment.index import INDEX_ROOT, build, volume_name
+from kookaburra_deployment.main import MOD_NAME, app
 
 stub = modal.Stub()
 
-DEFAULT_PIP_INSTALL = [
-    "fastapi",
-    "langchain",
-    "openai",
-]
-
 DEPLOY_ROOT = "kookaburra_deployment"
-DEFAULT_REQUIREMENTS_PATH = f"{DEPLOY_ROOT}/requirements.txt"
-DEFAULT_APT_INSTALL_PATH = f"{DEPLOY_ROOT}/apt_install.txt"
-DEFAULT_PYPROJECT_PATH = f"{DEPLOY_ROOT}/pyproject.toml"
-
-
-def _read_lines_from_file(path: str) -> list:
-    with open(path, "r") as f:
-        return [line.strip() for line in f.readlines()]
+DEFAULT_REQUIREMENTS_PATH = f"{DEPLOY_ROOT}/{REQUIREMENTS_FILE}"
+DEFAULT_APT_INSTALL_PATH = f"{DEPLOY_ROOT}/{APT_INSTALL_FILE}"
+DEFAULT_PYPROJECT_PATH = f"{DEPLOY_ROOT}/{PYPROJECT_FILE}"
 
 
 APT_PACKAGES_TO_INSTALL = []
 if Path(DEFAULT_APT_INSTALL_PATH).exists():
-    APT_PACKAGES_TO_INSTALL = _read_lines_from_file(DEFAULT_APT_INSTALL_PATH)
+    APT_PACKAGES_TO_INSTALL = read_lines(Path(DEFAULT_APT_INSTALL_PATH))
 
 
 def _make_mounts() -> List[modal.Mount]:
-    mounts = []
-    for path in Path(".").glob("**/*"):
-        if path.is_dir() and path.name not in ["__pycache__"]:
-            mounts.append(
-                modal.Mount(
-                    local_dir=path.absolute(),
-                    remote_dir=f"/root/{path}".replace(DEPLOY_ROOT, ""),
-                )
-            )
-    return mounts
+    # one mount of the deploy root, without ignored files, see bundle.py
+    if not Path(DEPLOY_ROOT).is_dir():
+        return []
+    bundle = Bundle(Path(DEPLOY_ROOT))
+    return [
+        modal.Mount(
+            local_dir=Path(DEPLOY_ROOT).absolute(),
+            remote_dir="/root",
+            condition=bundle.includes,
+            recursive=True,
+        )
+    ]
 
 
+# the base layer comes first and is the same for every app, so it is built
+# once and shared, the layers below it are only rebuilt when the app's
+# dependency files change
+image = modal.Image.debian_slim().pip_install(DEFAULT_PIP_INSTALL)
+if APT_PACKAGES_TO_INSTALL:
+    image = image.apt_install(APT_PACKAGES_TO_INSTALL)
 if Path(DEFAULT_REQUIREMENTS_PATH).exists():
-    image = (
-        modal.Image.debian_slim()
-        .apt_install(APT_PACKAGES_TO_INSTALL)
-        .pip_install(DEFAULT_PIP_INSTALL)
-        .pip_install_from_requirements(
-            requirements_txt=DEFAULT_REQUIREMENTS_PATH,
-        )
+    image = image.pip_install_from_requirements(
+        requirements_txt=DEFAULT_REQUIREMENTS_PATH,
     )
 elif Path(DEFAULT_PYPROJECT_PATH).exists():
-    image = (
-        modal.Image.debian_slim()
-        .apt_install(APT_PACKAGES_TO_INSTALL)
-        .pip_install(DEFAULT_PIP_INSTALL)
-        .pip_install_from_pyproject(
-            pyproject_toml=DEFAULT_PYPROJECT_PATH,
-        )
+    image = image.pip_install_from_pyproject(
+        pyproject_toml=DEFAULT_PYPROJECT_PATH,
     )
-else:
-    image = (
-        modal.Image.debian_slim()
-        .apt_install(APT_PACKAGES_TO_INSTALL)
-        .pip_install(DEFAULT_PIP_INSTALL)
+
+
+# vector indexes and cached embeddings, see kookaburra_deployment/index.py
+index_volume = modal.SharedVolume().persist(volume_name())
+
+
+@stub.function(
+    image=image,
+    secret=modal.Secret.from_name("kb-openai-api-key"),
+    mounts=_make_mounts(),
+    shared_volumes={INDEX_ROOT: index_volume},
+    timeout=30 * 60,
+)
+def build_index() -> Dict:
+    _kb = importlib.import_module(MOD_NAME)
+    if not hasattr(_kb, "get_documents"):
+        return {}
+    if hasattr(_kb, "get_embeddings"):
+        embeddings = _kb.get_embeddings()
+    else:
+        from langchain.embeddings import OpenAIEmbeddings
+
+        embeddings = OpenAIEmbeddings()
+    return build(
+        documents=_kb.get_documents(),
+        embeddings=embeddings,
+        root=Path(INDEX_ROOT),
+        dtype=getattr(_kb, "KOOKABURRA_INDEX_DTYPE", "float32"),
+        n_lists=getattr(_kb, "KOOKABURRA_INDEX_LISTS", None),
     )
 
 
@@ -73,6 +94,7 @@ else:
     image=image,
     secret=modal.Secret.from_name("kb-openai-api-key"),
     mounts=_make_mounts(),
+    shared_volumes={INDEX_ROOT: index_volume},
 )
 def _api() -> FastAPI:
     return app
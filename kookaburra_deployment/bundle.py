@@ -0,0 +1,154 @@
+"""The files of an app that are uploaded to Modal.
+
+Only the standard library is used, so the deploy service can import this
+without the app's dependencies.
+
+Ignore rules are a subset of .gitignore: blank lines and lines starting
+with # are skipped, a trailing / only matches directories, a pattern with a
+/ in it is matched against the path from the root, any other pattern
+against each file or directory name, and a leading ! includes a path again.
+"""
+import fnmatch
+import hashlib
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+IGNORE_FILE = ".kookaburraignore"
+DEFAULT_IGNORE = [
+    ".git/",
+    ".hg/",
+    ".svn/",
+    "__pycache__/",
+    "*.py[cod]",
+    ".venv/",
+    "venv/",
+    "node_modules/",
+    ".mypy_cache/",
+    ".pytest_cache/",
+    ".ruff_cache/",
+    ".ipynb_checkpoints/",
+    "*.egg-info/",
+    ".DS_Store",
+    ".env",
+    ".env.*",
+]
+# uploaded, but changing only these doesn't need a redeploy
+NOT_RUNTIME = [
+    "README*",
+    "LICENSE*",
+    "CHANGELOG*",
+    "CONTRIBUTING*",
+    ".github/*",
+    IGNORE_FILE,
+]
+_CHUNK = 1024 * 1024
+
+
+def _file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Bundle:
+    """Bundle.
+
+    Bundle lists the files under `root` that aren't ignored, with their size
+    and content hash. Ignored directories are never walked, so a .venv or a
+    .git doesn't slow down a deploy.
+    """
+
+    def __init__(self, root: Path, ignore: Optional[List[str]] = None) -> None:
+        self.root = Path(root)
+        self.rules: List[Tuple[bool, bool, str]] = []
+        for line in [*DEFAULT_IGNORE, *(ignore or []), *self._read_ignore_file()]:
+            self._add_rule(line)
+        self._files: Optional[Dict[str, Tuple[int, str]]] = None
+
+    def _read_ignore_file(self) -> List[str]:
+        path = self.root / IGNORE_FILE
+        if not path.exists():
+            return []
+        return path.read_text().splitlines()
+
+    def _add_rule(self, line: str) -> None:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            return
+        include = line.startswith("!")
+        line = line.lstrip("!")
+        dir_only = line.endswith("/")
+        self.rules.append((include, dir_only, line.strip("/")))
+
+    def ignored(self, path: str, is_dir: bool = False) -> bool:
+        """Whether `path`, relative to the root, is ignored. The last match wins."""
+        name = path.rsplit("/", 1)[-1]
+        ignored = False
+        for include, dir_only, pattern in self.rules:
+            if dir_only and not is_dir:
+                continue
+            target = path if "/" in pattern else name
+            if fnmatch.fnmatchcase(target, pattern):
+                ignored = not include
+        return ignored
+
+    @property
+    def files(self) -> Dict[str, Tuple[int, str]]:
+        """The size and sha256 of each file, by path relative to the root."""
+        if self._files is None:
+            self._files = {}
+            for dirpath, dirnames, filenames in os.walk(self.root):
+                rel = Path(dirpath).relative_to(self.root).as_posix()
+                prefix = "" if rel == "." else f"{rel}/"
+                dirnames[:] = sorted(
+                    d for d in dirnames if not self.ignored(prefix + d, is_dir=True)
+                )
+                for filename in sorted(filenames):
+                    path = prefix + filename
+                    if self.ignored(path):
+                        continue
+                    full = self.root / path
+                    self._files[path] = (full.stat().st_size, _file_hash(full))
+        return self._files
+
+    @property
+    def size(self) -> int:
+        return sum(size for size, _ in self.files.values())
+
+    def _digest(self, skip: List[str]) -> str:
+        digest = hashlib.sha256()
+        for path, (_, sha) in sorted(self.files.items()):
+            if any(fnmatch.fnmatchcase(path, pattern) for pattern in skip):
+                continue
+            digest.update(f"{path}\0{sha}\n".encode("utf8"))
+        return digest.hexdigest()
+
+    @property
+    def digest(self) -> str:
+        """A hash of every path and its content, the same for the same tree."""
+        return self._digest(skip=[])
+
+    @property
+    def runtime_digest(self) -> str:
+        """Like `digest`, without the files the app doesn't run, e.g. README.md."""
+        return self._digest(skip=NOT_RUNTIME)
+
+    def includes(self, path: str) -> bool:
+        """Whether an absolute or root relative path is in the bundle."""
+        full = Path(path)
+        if full.is_absolute():
+            try:
+                full = full.relative_to(self.root.absolute())
+            except ValueError:
+                return False
+        return full.as_posix() in self.files
+
+    def summary(self) -> Dict:
+        return {
+            "files": len(self.files),
+            "bytes": self.size,
+            "digest": self.digest,
+        }
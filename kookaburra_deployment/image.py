@@ -0,0 +1,38 @@
+"""The layers of the image a deployed app runs in.
+
+Modal caches image layers by their definition, so every app shares the base
+layer of pinned default packages, and an app's own dependency layers are
+only rebuilt when its dependency files change. Only the standard library is
+used, so the deploy service can compute the dependency digest.
+"""
+import hashlib
+from pathlib import Path
+from typing import List
+
+# pinned, so the base layer is the same for every app until they are bumped
+DEFAULT_PIP_INSTALL = [
+    "fastapi==0.95.1",
+    "langchain==0.0.166",
+    "numpy==1.24.3",
+    "openai==0.27.6",
+]
+REQUIREMENTS_FILE = "requirements.txt"
+PYPROJECT_FILE = "pyproject.toml"
+APT_INSTALL_FILE = "apt_install.txt"
+DEPS_FILES = [APT_INSTALL_FILE, REQUIREMENTS_FILE, PYPROJECT_FILE]
+
+
+def read_lines(path: Path) -> List[str]:
+    return [line.strip() for line in path.read_text().splitlines() if line.strip()]
+
+
+def deps_digest(root: Path) -> str:
+    """A hash of everything the dependency layers are built from."""
+    digest = hashlib.sha256()
+    digest.update("\n".join(DEFAULT_PIP_INSTALL).encode("utf8"))
+    for name in DEPS_FILES:
+        path = Path(root) / name
+        digest.update(f"\0{name}\0".encode("utf8"))
+        if path.exists():
+            digest.update(path.read_bytes())
+    return digest.hexdigest()
@@ -0,0 +1,388 @@
+"""Vector indexes built at deploy time.
+
+An app opts in by defining `get_documents()` in its kookaburra.py, and
+optionally `get_embeddings()`, which defaults to `OpenAIEmbeddings()`. The
+deploy runs `build_index` once per commit, which embeds only the documents
+that changed since the last deploy and writes the normalized embeddings as
+a content-hashed artifact. `load_index()` memory-maps the artifact of its
+own commit at container start, so nothing is embedded on a cold start, and
+the version serving while another one is deployed, or rolled back to, keeps
+its index.
+
+The matrix is stored as float32, or as float16 to halve its size, with
+`KOOKABURRA_INDEX_DTYPE = "float16"`. Large corpora are split into IVF
+lists, clusters of similar rows stored contiguously, so a query only scores
+the few lists closest to it. `KOOKABURRA_INDEX_LISTS` sets the number of
+lists, 0 to always search exhaustively.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# where the app's own shared volume is mounted
+INDEX_ROOT = "/kb-index"
+KB_JSON = "_kb.json"
+# the artifact of each deployed commit is named in current-{sha}.json,
+# current.json is the one pointer of indexes built before that
+CURRENT = "current.json"
+POINTER_PREFIX = "current-"
+EMBED_BATCH_SIZE = 256
+# rows scored at once by an exhaustive search, bounds the memory it needs
+SEARCH_BLOCK_ROWS = 8192
+# corpora at least this big are partitioned when the number of lists is auto
+IVF_MIN_ROWS = 50000
+IVF_TRAIN_ITERATIONS = 10
+
+
+def get_kb() -> Dict:
+    """The llm id, commit sha, and the commits whose indexes must be kept,
+    written into the deploy root."""
+    path = Path(__file__).parent / KB_JSON
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text())
+
+
+def volume_name() -> str:
+    # one volume per app, so apps can't read each other's documents
+    return f"kb-index-{get_kb().get('llm_id', 'local')}"
+
+
+def _pointer(root: Path, sha: str) -> Path:
+    return root / f"{POINTER_PREFIX}{sha}.json"
+
+
+def _hash(*parts: str) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def document_hash(document: Any) -> str:
+    return _hash(
+        document.page_content,
+        json.dumps(document.metadata, sort_keys=True, default=str),
+    )
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+def _top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """The best `k` scores of each row, and their columns, best first."""
+    k = min(k, scores.shape[1])
+    if k == 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(scores.dtype), empty.astype(np.int64)
+    columns = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    best = np.take_along_axis(scores, columns, axis=1)
+    order = np.argsort(-best, axis=1)
+    return (
+        np.take_along_axis(best, order, axis=1),
+        np.take_along_axis(columns, order, axis=1),
+    )
+
+
+def _train_lists(
+    matrix: np.ndarray,
+    n_lists: int,
+    seed: int = 0,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Spherical k-means.
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The centroids, and the list of each row.
+    """
+    rng = np.random.default_rng(seed)
+    sample = matrix[
+        rng.choice(len(matrix), min(len(matrix), 256 * n_lists), replace=False)
+    ]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+    for _ in range(IVF_TRAIN_ITERATIONS):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        for i in range(n_lists):
+            members = sample[assignments == i]
+            # reseed empty lists with a random row
+            centroids[i] = (
+                members.sum(axis=0)
+                if len(members)
+                else sample[rng.integers(len(sample))]
+            )
+        centroids = _normalize(centroids)
+    assignments = np.concatenate(
+        [
+            np.argmax(matrix[i : i + SEARCH_BLOCK_ROWS] @ centroids.T, axis=1)
+            for i in range(0, len(matrix), SEARCH_BLOCK_ROWS)
+        ]
+    )
+    return centroids.astype(np.float32), assignments
+
+
+class Index:
+    """Index.
+
+    Index is a read-only matrix of normalized embeddings, memory-mapped from
+    disk, and the documents they belong to, in the same order. With IVF
+    lists, the rows of list i are `offsets[i]:offsets[i + 1]`.
+    """
+
+    def __init__(
+        self,
+        key: str,
+        model: str,
+        matrix: np.ndarray,
+        documents: List[Dict],
+        centroids: Optional[np.ndarray] = None,
+        offsets: Optional[np.ndarray] = None,
+    ) -> None:
+        self.key = key
+        self.model = model
+        self.matrix = matrix
+        self.documents = documents
+        self.centroids = centroids
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def _rows(self, start: int, stop: int) -> np.ndarray:
+        # float16 is only for storage, numpy multiplies float32 much faster
+        return np.asarray(self.matrix[start:stop], dtype=np.float32)
+
+    def _search_exhaustive(
+        self,
+        queries: np.ndarray,
+        k: int,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        scores = np.empty((len(queries), 0), dtype=np.float32)
+        ids = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self), SEARCH_BLOCK_ROWS):
+            block_scores, block_ids = _top_k(
+                queries @ self._rows(start, start + SEARCH_BLOCK_ROWS).T, k
+            )
+            scores, best = _top_k(np.hstack([scores, block_scores]), k)
+            ids = np.take_along_axis(np.hstack([ids, block_ids + start]), best, 1)
+        return scores, ids
+
+    def _search_lists(
+        self,
+        queries: np.ndarray,
+        k: int,
+        n_probe: int,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        assert self.centroids is not None and self.offsets is not None
+        _, probes = _top_k(queries @ self.centroids.T, n_probe)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for q, lists in enumerate(probes):
+            ranges = [(self.offsets[i], self.offsets[i + 1]) for i in sorted(lists)]
+            rows = np.concatenate([np.arange(a, b) for a, b in ranges])
+            candidates = np.vstack([self._rows(a, b) for a, b in ranges])
+            best_scores, best = _top_k(queries[q : q + 1] @ candidates.T, k)
+            scores[q, : best.shape[1]] = best_scores[0]
+            ids[q, : best.shape[1]] = rows[best[0]]
+        return scores, ids
+
+    def search(
+        self,
+        queries: np.ndarray,
+        k: int = 4,
+        n_probe: int = 8,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Find the `k` rows most similar to each query.
+
+        Queries are scored as a batch, with one matrix product per block of
+        rows, or per query over the `n_probe` closest lists.
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: The cosine similarities and the
+                row ids, best first, with an id of -1 where a query has fewer
+                than `k` candidates.
+        """
+        queries = _normalize(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        if self.centroids is None:
+            return self._search_exhaustive(queries, k)
+        return self._search_lists(queries, k, n_probe)
+
+
+def _prune(root: Path, shas: List[str]) -> None:
+    """Remove what the indexes of the commits `shas` don't use.
+
+    That is the pointers of other commits, the artifacts no pointer names,
+    and the cached embeddings of documents no kept artifact has.
+    """
+    keys = set()
+    for path in root.glob(f"{POINTER_PREFIX}*.json"):
+        if path.name[len(POINTER_PREFIX) : -len(".json")] in shas:
+            keys.add(json.loads(path.read_text())["key"])
+        else:
+            path.unlink()
+    if (root / CURRENT).exists():
+        # a kept commit without a pointer was deployed before them
+        if all(_pointer(root, sha).exists() for sha in shas):
+            (root / CURRENT).unlink()
+        else:
+            keys.add(json.loads((root / CURRENT).read_text())["key"])
+    for path in root.iterdir():
+        if (
+            path.is_file()
+            and not path.name.startswith(CURRENT.split(".")[0])
+            and path.name.split(".")[0] not in keys
+        ):
+            path.unlink()
+    metas = [json.loads((root / f"{key}.json").read_text()) for key in keys]
+    # artifacts built before their hashes were stored keep every embedding
+    if not all("hashes" in meta for meta in metas):
+        return
+    used = {(_hash(meta["model"])[:16], h) for meta in metas for h in meta["hashes"]}
+    for path in (root / "embeddings").glob("*/*.npy"):
+        if (path.parent.name, path.name[: -len(".npy")]) not in used:
+            path.unlink()
+
+
+def build(
+    documents: List[Any],
+    embeddings: Any,
+    root: Path,
+    dtype: str = "float32",
+    n_lists: Optional[int] = None,
+    sha: Optional[str] = None,
+    keep: Optional[List[str]] = None,
+) -> Dict:
+    """Build the index for `documents`.
+
+    Embeddings are cached per document content and embedding model, so a
+    deploy only pays for the documents that changed.
+    Args:
+        dtype (str): float32, or float16 to halve the size of the matrix.
+        n_lists (Optional[int]): The number of IVF lists, None for the square
+            root of the number of rows if there are at least IVF_MIN_ROWS,
+            or 0 for none.
+        sha (Optional[str]): The commit the index is for, by default the one
+            in _kb.json.
+        keep (Optional[List[str]]): The commits of the versions still up,
+            whose indexes are kept, by default the ones in _kb.json.
+    Returns:
+        Dict: The artifact key, and how many embeddings were computed and
+            reused.
+    """
+    if not documents:
+        raise ValueError("get_documents() returned no documents.")
+    if dtype not in ("float32", "float16"):
+        raise ValueError(f"Unsupported index dtype {dtype}.")
+    if n_lists is None:
+        n_lists = int(np.sqrt(len(documents))) if len(documents) >= IVF_MIN_ROWS else 0
+    n_lists = min(n_lists, len(documents))
+    kb = get_kb()
+    commit = sha or str(kb.get("sha", "local"))
+    kept: List[str] = kb.get("keep", []) if keep is None else keep
+    model = str(getattr(embeddings, "model", type(embeddings).__name__))
+    cache = root / "embeddings" / _hash(model)[:16]
+    cache.mkdir(parents=True, exist_ok=True)
+    hashes = [document_hash(d) for d in documents]
+
+    missing = sorted({h for h in hashes if not (cache / f"{h}.npy").exists()})
+    texts = {h: d.page_content for h, d in zip(hashes, documents)}
+    for i in range(0, len(missing), EMBED_BATCH_SIZE):
+        batch = missing[i : i + EMBED_BATCH_SIZE]
+        vectors = embeddings.embed_documents([texts[h] for h in batch])
+        for h, vector in zip(batch, vectors):
+            with open(cache / f"{h}.npy.tmp", "wb") as f:
+                np.save(f, np.asarray(vector, dtype=np.float32))
+            os.replace(cache / f"{h}.npy.tmp", cache / f"{h}.npy")
+
+    key = _hash(model, dtype, str(n_lists), *hashes)[:32]
+    if not (root / f"{key}.json").exists():
+        matrix = _normalize(np.stack([np.load(cache / f"{h}.npy") for h in hashes]))
+        order = np.arange(len(documents))
+        if n_lists:
+            centroids, assignments = _train_lists(matrix, n_lists)
+            # store each list contiguously, so probing it is one sequential read
+            order = np.argsort(assignments, kind="stable")
+            offsets = np.searchsorted(assignments[order], np.arange(n_lists + 1))
+            matrix = matrix[order]
+            with open(root / f"{key}.ivf.npz.tmp", "wb") as f:
+                np.savez(f, centroids=centroids, offsets=offsets)
+            os.replace(root / f"{key}.ivf.npz.tmp", root / f"{key}.ivf.npz")
+        _write_atomic(root / f"{key}.vecs", matrix.astype(dtype).tobytes())
+        _write_atomic(
+            root / f"{key}.json",
+            json.dumps(
+                {
+                    "model": model,
+                    "dtype": dtype,
+                    "count": matrix.shape[0],
+                    "dim": matrix.shape[1],
+                    "lists": n_lists,
+                    "hashes": sorted(set(hashes)),
+                    "documents": [
+                        {
+                            "page_content": documents[i].page_content,
+                            "metadata": documents[i].metadata,
+                        }
+                        for i in order
+                    ],
+                },
+                default=str,
+            ).encode("utf8"),
+        )
+    # point this commit at the new artifact only once it is complete
+    _write_atomic(
+        _pointer(root, commit),
+        json.dumps({"key": key, "sha": commit}).encode("utf8"),
+    )
+    _prune(root, shas=[commit, *kept])
+    return {
+        "key": key,
+        "count": len(documents),
+        "lists": n_lists,
+        "embedded": len(missing),
+        "reused": len(set(hashes)) - len(missing),
+    }
+
+
+def load_index(
+    root: Optional[Path] = None,
+    sha: Optional[str] = None,
+) -> Optional[Index]:
+    """Memory-map the index of a commit, by default the deployed one, or None
+    if it hasn't been built."""
+    root = root or Path(INDEX_ROOT)
+    commit = sha or str(get_kb().get("sha", "local"))
+    pointer = _pointer(root, commit)
+    if not pointer.exists():
+        pointer = root / CURRENT
+    if not pointer.exists():
+        return None
+    key = json.loads(pointer.read_text())["key"]
+    meta = json.loads((root / f"{key}.json").read_text())
+    matrix = np.memmap(
+        root / f"{key}.vecs",
+        dtype=meta["dtype"],
+        mode="r",
+        shape=(meta["count"], meta["dim"]),
+    )
+    centroids, offsets = None, None
+    if meta.get("lists"):
+        with np.load(root / f"{key}.ivf.npz") as ivf:
+            centroids, offsets = ivf["centroids"], ivf["offsets"]
+    return Index(
+        key=key,
+        model=meta["model"],
+        matrix=matrix,
+        documents=meta["documents"],
+        centroids=centroids,
+        offsets=offsets,
+    )
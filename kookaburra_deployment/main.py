@@ -1,14 +1,106 @@
+import asyncio
+import functools
 import importlib
-from typing import List, Tuple, Union
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import (
+    Any,
+    AsyncIterator,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
+from uuid import UUID
 
-from fastapi import Body, FastAPI, HTTPException
+from fastapi import Body, FastAPI, Header, HTTPException, Response, status
+from fastapi.responses import StreamingResponse
 from langchain import OpenAI
-from langchain.chains import ChatVectorDBChain
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.chains import ChatVectorDBChain, ConversationalRetrievalChain
 from pydantic import BaseModel, validator
+from starlette.concurrency import run_in_threadpool
 
 app = FastAPI()
+log = logging.getLogger(__name__)
 MOD_NAME = "kookaburra_deployment.kookaburra"
 DEFAULT_REQUEST_PATH = "/sms"
+WARMUP_HEADER = "X-Kookaburra-Warmup"
+# user modules that set this to True get a fresh LLM for every request
+PER_REQUEST_ATTR = "KOOKABURRA_PER_REQUEST"
+
+# requests running inference at once, and waiting for a turn, per container
+MAX_IN_FLIGHT = int(os.getenv("KOOKABURRA_MAX_IN_FLIGHT", "4"))
+MAX_QUEUED = int(os.getenv("KOOKABURRA_MAX_QUEUED", "16"))
+# use the native async LangChain calls where a chain supports them
+USE_ASYNC = os.getenv("KOOKABURRA_ASYNC", "1") == "1"
+
+_LLM = Union[OpenAI, ChatVectorDBChain, ConversationalRetrievalChain]
+_CHAINS = (ChatVectorDBChain, ConversationalRetrievalChain)
+_llm: Optional[_LLM] = None
+_llm_lock = asyncio.Lock()
+# the background build, and why it last failed
+_build_task: Optional[asyncio.Task] = None
+_build_error: Optional[str] = None
+# blocking LangChain calls run here, never on the event loop
+_executor = ThreadPoolExecutor(
+    max_workers=MAX_IN_FLIGHT,
+    thread_name_prefix="inference",
+)
+
+
+class Limiter:
+    """Limiter.
+
+    Limiter caps the number of requests running inference at once. Requests
+    over the cap wait in a bounded queue, and are rejected with a 429 when
+    the queue is full, so the caller can retry elsewhere instead of piling
+    up behind slow OpenAI calls.
+    """
+
+    def __init__(self, max_in_flight: int, max_queued: int) -> None:
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+        self.completed = 0
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+
+    def check(self) -> None:
+        """Reject the request if there is no room for it in the queue."""
+        if self._semaphore.locked() and self.queued >= self.max_queued:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests.",
+                headers={"Retry-After": "1"},
+            )
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """Wait for a turn. Callers `check` first, before they respond."""
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            self._semaphore.release()
+
+
+limiter = Limiter(max_in_flight=MAX_IN_FLIGHT, max_queued=MAX_QUEUED)
 
 
 class HeyResponse(BaseModel):
@@ -19,6 +111,20 @@ class HeyResponse(BaseModel):
         return v.strip()
 
 
+class ReadyResponse(BaseModel):
+    ready: bool
+    error: Optional[str] = None
+
+
+class MetricsResponse(BaseModel):
+    in_flight: int
+    queued: int
+    max_in_flight: int
+    max_queued: int
+    rejected: int
+    completed: int
+
+
 class Message(BaseModel):
     message: str
     chat_history: List[Tuple[str, str]] = []
@@ -28,23 +134,247 @@ class Message(BaseModel):
         return v.strip()
 
 
+@functools.lru_cache(maxsize=None)
+def _per_request() -> bool:
+    # read once, the user module doesn't change for the life of the container
+    _kb = importlib.import_module(MOD_NAME)
+    return bool(getattr(_kb, PER_REQUEST_ATTR, False))
+
+
+async def get_llm() -> _LLM:
+    """Get the LLM, building it once for the life of the container.
+
+    Building can be slow, e.g. computing embeddings for a vector store, so it
+    runs in a thread, and the lock makes concurrent requests wait for the
+    same build instead of starting their own.
+    """
+    global _llm
+    _kb = importlib.import_module(MOD_NAME)
+    if _per_request():
+        return await run_in_threadpool(_kb.get_llm)
+    if _llm is None:
+        async with _llm_lock:
+            if _llm is None:
+                _llm = await run_in_threadpool(_kb.get_llm)
+    return _llm
+
+
+async def _build() -> None:
+    global _build_error
+    try:
+        await get_llm()
+    except Exception as e:
+        # the next request, or readiness check, tries again
+        log.exception("Could not build the LLM")
+        _build_error = repr(e)
+    else:
+        _build_error = None
+
+
+def _start_build() -> None:
+    """Build the LLM in the background, unless a build is running."""
+    global _build_task
+    if _build_task is None or _build_task.done():
+        _build_task = asyncio.create_task(_build())
+
+
+@app.on_event("startup")
+async def startup() -> None:
+    # start building straight away, without holding up the container start
+    _start_build()
+
+
+@app.get("/ready", response_model=ReadyResponse)
+async def ready(response: Response) -> ReadyResponse:
+    is_ready = _llm is not None or _per_request()
+    if not is_ready:
+        # a deploy only polls this, so a failed build is retried from here
+        _start_build()
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return ReadyResponse(ready=is_ready, error=None if is_ready else _build_error)
+
+
+@app.get("/metrics", response_model=MetricsResponse)
+async def metrics() -> MetricsResponse:
+    return MetricsResponse(
+        in_flight=limiter.in_flight,
+        queued=limiter.queued,
+        max_in_flight=limiter.max_in_flight,
+        max_queued=limiter.max_queued,
+        rejected=limiter.rejected,
+        completed=limiter.completed,
+    )
+
+
+async def _in_thread(fn: Any, *args: Any) -> Any:
+    return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+
+
+class _TokenQueue(BaseCallbackHandler):
+    """_TokenQueue.
+
+    _TokenQueue collects the tokens LangChain streams, from the event loop or
+    from an inference thread. The LLM runs under the first `skip_chains`
+    chains the top chain starts are not streamed, e.g. the question a
+    conversational chain condenses from the chat history.
+    """
+
+    def __init__(self, skip_chains: int = 0) -> None:
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.streamed = False
+        self._loop = asyncio.get_running_loop()
+        self._skip_chains = skip_chains
+        # run id -> parent run id, of the chains started
+        self._parents: Dict[UUID, Optional[UUID]] = {}
+        self._skipped: Set[UUID] = set()
+
+    def on_chain_start(
+        self,
+        serialized: Dict[str, Any],
+        inputs: Dict[str, Any],
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ) -> None:
+        top = [r for r, parent in self._parents.items() if parent is None]
+        children = [r for r, parent in self._parents.items() if parent in top]
+        self._parents[run_id] = parent_run_id
+        if parent_run_id in self._skipped or (
+            parent_run_id in top and len(children) < self._skip_chains
+        ):
+            self._skipped.add(run_id)
+
+    def on_llm_start(
+        self,
+        serialized: Dict[str, Any],
+        prompts: List[str],
+        *,
+        run_id: UUID,
+        parent_run_id: Optional[UUID] = None,
+        **kwargs: Any,
+    ) -> None:
+        if parent_run_id in self._skipped:
+            self._skipped.add(run_id)
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any) -> None:
+        if run_id not in self._skipped:
+            self.streamed = True
+            self._loop.call_soon_threadsafe(self.queue.put_nowait, token)
+
+
+async def _complete(
+    llm: OpenAI,
+    prompt: str,
+    callbacks: Optional[Sequence[BaseCallbackHandler]] = None,
+) -> str:
+    kwargs = {"callbacks": callbacks} if callbacks else {}
+    if USE_ASYNC:
+        result = await llm.agenerate([prompt], **kwargs)
+        return result.generations[0][0].text
+    return await _in_thread(functools.partial(llm, prompt, **kwargs))
+
+
+async def _chain(
+    llm: Union[ChatVectorDBChain, ConversationalRetrievalChain],
+    inputs: Dict,
+    callbacks: Optional[Sequence[BaseCallbackHandler]] = None,
+) -> Dict:
+    kwargs = {"callbacks": callbacks} if callbacks else {}
+    # a ChatVectorDBChain has no async retrieval, and only finds out after it
+    # condensed the question, so it never tries
+    if USE_ASYNC and not isinstance(llm, ChatVectorDBChain):
+        return await llm.acall(inputs, **kwargs)
+    return await _in_thread(functools.partial(llm, inputs, **kwargs))
+
+
+async def _generate(
+    llm: _LLM,
+    message: Message,
+    callbacks: Optional[Sequence[BaseCallbackHandler]] = None,
+) -> str:
+    if isinstance(llm, (OpenAI)):
+        return await _complete(llm, message.message, callbacks)
+    elif isinstance(llm, _CHAINS):
+        return (
+            await _chain(
+                llm,
+                {
+                    "question": message.message,
+                    "chat_history": message.chat_history,
+                },
+                callbacks,
+            )
+        )["answer"]
+    raise HTTPException(f"Unsupported LLM type {type(llm)}.")
+
+
 @app.post("/hey", response_model=HeyResponse)
 async def hey(
     message: Message = Body(...),
+    warmup: bool = Header(False, alias=WARMUP_HEADER),
 ) -> HeyResponse:
-    _kb = importlib.import_module(MOD_NAME)
-    llm: Union[OpenAI, ChatVectorDBChain] = _kb.get_llm()
-    _in: str = message.message
-    _out: str
-    if isinstance(llm, (OpenAI)):
-        _out = llm(_in)
-    elif isinstance(llm, ChatVectorDBChain):
-        _out = llm(
-            {
-                "question": _in,
-                "chat_history": message.chat_history,
-            }
-        )["answer"]
-    else:
-        raise HTTPException(f"Unsupported LLM type {type(llm)}.")
+    # a full container rejects before building a per-request LLM
+    limiter.check()
+    llm = await get_llm()
+    if warmup:
+        # the container is up and the LLM is built, don't call it
+        return HeyResponse(message="")
+    async with limiter.slot():
+        _out = await _generate(llm, message)
     return HeyResponse(message=_out)
+
+
+def _sse(data: Dict, event: Optional[str] = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+async def _events(llm: _LLM, message: Message) -> AsyncIterator[str]:
+    # only the answer is streamed, not the question condensed from the history
+    skip_chains = 1 if isinstance(llm, _CHAINS) and message.chat_history else 0
+    handler = _TokenQueue(skip_chains=skip_chains)
+    task: Optional[asyncio.Task] = None
+    try:
+        async with limiter.slot():
+            task = asyncio.create_task(_generate(llm, message, [handler]))
+            while True:
+                get = asyncio.ensure_future(handler.queue.get())
+                await asyncio.wait({get, task}, return_when=asyncio.FIRST_COMPLETED)
+                if not get.done():
+                    get.cancel()
+                    break
+                yield _sse({"token": get.result()})
+            while not handler.queue.empty():
+                yield _sse({"token": handler.queue.get_nowait()})
+            _out = task.result()
+        if not handler.streamed:
+            # the LLM doesn't stream, send the whole answer at once
+            yield _sse({"token": _out})
+        yield _sse({"message": _out.strip()}, event="end")
+    except Exception as e:
+        log.exception("Could not stream a response")
+        yield _sse({"detail": str(e)}, event="error")
+    finally:
+        if task is not None and not task.done():
+            # the client went away
+            task.cancel()
+
+
+@app.post("/hey/stream")
+async def hey_stream(
+    message: Message = Body(...),
+) -> StreamingResponse:
+    """Stream the response as server-sent events.
+
+    Each token is sent as a `data: {"token": ...}` event, followed by an
+    `end` event with the whole message, or an `error` event.
+    """
+    # checked once, a 429 can't be sent once the stream has started
+    limiter.check()
+    llm = await get_llm()
+    return StreamingResponse(
+        _events(llm, message),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
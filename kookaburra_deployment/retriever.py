@@ -0,0 +1,108 @@
+from pathlib import Path
+from typing import Any, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+
+from kookaburra_deployment.index import Index, load_index
+
+READ_ONLY = (
+    "MemmapVectorStore is read-only, its index is built at deploy time by "
+    "kookaburra_deployment.index.build."
+)
+
+
+class MemmapVectorStore(VectorStore):
+    """MemmapVectorStore.
+
+    MemmapVectorStore is a read-only LangChain vector store over the index
+    built at deploy time, e.g.
+
+        from kookaburra_deployment.retriever import MemmapVectorStore
+
+        def get_llm():
+            vectorstore = MemmapVectorStore.load(OpenAIEmbeddings())
+            return ChatVectorDBChain.from_llm(OpenAI(), vectorstore)
+
+    Documents are added by `get_documents()` at deploy time, not at runtime.
+    """
+
+    def __init__(self, index: Index, embedding: Embeddings, n_probe: int = 8) -> None:
+        self.index = index
+        self.embedding = embedding
+        self.n_probe = n_probe
+
+    @classmethod
+    def load(
+        cls,
+        embedding: Embeddings,
+        root: Optional[Path] = None,
+        n_probe: int = 8,
+    ) -> "MemmapVectorStore":
+        index = load_index(root)
+        if index is None:
+            raise ValueError("The index hasn't been built, define get_documents().")
+        return cls(index=index, embedding=embedding, n_probe=n_probe)
+
+    def similarity_search_by_vector_with_score(
+        self,
+        embedding: List[float],
+        k: int = 4,
+    ) -> List[Tuple[Document, float]]:
+        scores, ids = self.index.search(
+            np.asarray([embedding]), k=k, n_probe=self.n_probe
+        )
+        return [
+            (Document(**self.index.documents[i]), float(score))
+            for score, i in zip(scores[0], ids[0])
+            if i >= 0
+        ]
+
+    def similarity_search_with_score(
+        self,
+        query: str,
+        k: int = 4,
+        **kwargs: Any,
+    ) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(
+            self.embedding.embed_query(query), k=k
+        )
+
+    def similarity_search_by_vector(
+        self,
+        embedding: List[float],
+        k: int = 4,
+        **kwargs: Any,
+    ) -> List[Document]:
+        return [
+            doc
+            for doc, _ in self.similarity_search_by_vector_with_score(embedding, k=k)
+        ]
+
+    def similarity_search(
+        self,
+        query: str,
+        k: int = 4,
+        **kwargs: Any,
+    ) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k)]
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        raise TypeError(READ_ONLY)
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        **kwargs: Any,
+    ) -> "MemmapVectorStore":
+        raise TypeError(READ_ONLY)
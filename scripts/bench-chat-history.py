@@ -0,0 +1,118 @@
+"""Benchmark chat history reads against a local fake GCS server.
+
+usage:
+    ./scripts/run-fake-gcs.sh
+    STORAGE_EMULATOR_HOST=http://localhost:4443 \
+        python scripts/bench-chat-history.py [--turns 1 10 100 1000]
+
+Prints the median latency of get_sms_chat_history for conversations of
+increasing length, stored as per-message objects and read one at a time,
+as per-message objects read concurrently, and as segments. Every turn is
+read, unless --window is set, in which case the default history budgets
+(GS_CHAT_HISTORY_MAX_TURNS and GS_CHAT_HISTORY_MAX_TOKENS) apply.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+from unittest import mock
+from uuid import uuid4
+
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+
+from kookaburra.const import BUCKET_NAME
+from kookaburra.gs import gs_svc
+from kookaburra.models import Llm
+
+
+def _llm() -> Llm:
+    return Llm(
+        id=uuid4(),
+        phone_number="+15555555555",
+        modal_url="https://example.com",
+        clone_url="https://github.com",
+    )
+
+
+def _turns(n: int) -> List[dict]:
+    return [{"_in": f"in {i}", "_out": f"out {i}", "timestamp": i} for i in range(n)]
+
+
+async def _median_ms(fn: Callable, repeat: int) -> float:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--window", action="store_true", help="read within the default budgets"
+    )
+    args = parser.parse_args()
+
+    assert os.getenv("STORAGE_EMULATOR_HOST"), "STORAGE_EMULATOR_HOST is not set"
+    client = storage.Client(project="kookaburra", credentials=AnonymousCredentials())
+    bucket = client.bucket(BUCKET_NAME)
+    if not bucket.exists():
+        client.create_bucket(BUCKET_NAME)
+
+    print(f"{'turns':>8} {'sequential':>12} {'concurrent':>12} {'segmented':>12}")
+    with mock.patch.object(gs_svc, "_gs", return_value=client):
+        for n in args.turns:
+            # the defaults would cut longer conversations short
+            budget = {} if args.window else {"max_turns": n, "max_tokens": sys.maxsize}
+            legacy, segmented = _llm(), _llm()
+            prefix = gs_svc._prefix(str(legacy.id), legacy.phone_number)
+            with ThreadPoolExecutor(max_workers=16) as pool:
+                list(
+                    pool.map(
+                        lambda t: bucket.blob(
+                            f"{prefix}/{t['timestamp']}/chat.json"
+                        ).upload_from_string(json.dumps(t)),
+                        _turns(n),
+                    )
+                )
+            prefix = gs_svc._prefix(str(segmented.id), segmented.phone_number)
+            head = gs_svc._build(bucket, prefix, _turns(n), *gs_svc._budget())
+            gs_svc._write_head(bucket, prefix, head, 0)
+
+            with mock.patch.object(
+                gs_svc, "_executor", ThreadPoolExecutor(max_workers=1)
+            ):
+                sequential = await _median_ms(
+                    lambda: gs_svc.get_sms_chat_history(
+                        legacy, legacy.phone_number, **budget
+                    ),
+                    args.repeat,
+                )
+            concurrent = await _median_ms(
+                lambda: gs_svc.get_sms_chat_history(
+                    legacy, legacy.phone_number, **budget
+                ),
+                args.repeat,
+            )
+            segments = await _median_ms(
+                lambda: gs_svc.get_sms_chat_history(
+                    segmented, segmented.phone_number, **budget
+                ),
+                args.repeat,
+            )
+            timings = [f"{t:>10.1f}ms" for t in (sequential, concurrent, segments)]
+            print(f"{n:>8}", *timings)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,163 @@
+"""Benchmark the memory-mapped retriever against an in-memory vector store.
+
+usage:
+    PYTHONPATH=. python scripts/bench-retriever.py [--rows 10000 100000] [--dim 1536]
+
+Builds an index of random clustered embeddings for each corpus size, then
+prints the query latency and the resident memory of each store, each
+measured in a fresh process:
+
+    in-memory   every embedding held in RAM as a float64 matrix, like the
+                in-memory stores apps build in get_llm() today, or FAISS
+                if it is installed
+
+Memory is reported after loading, and after the queries, when the pages
+of the memory-mapped matrix that were read are resident too. Run from the
+repo root with PYTHONPATH=. so kookaburra_deployment can be imported.
+    float32     the memory-mapped float32 matrix, searched exhaustively
+    float16     the memory-mapped float16 matrix, searched exhaustively
+    ivf         the memory-mapped float32 matrix, split into IVF lists
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from kookaburra_deployment.index import build, load_index
+
+
+class _Document:
+    def __init__(self, i: int) -> None:
+        self.page_content = f"document {i}"
+        self.metadata = {"i": i}
+
+
+class _Embeddings:
+    model = "bench"
+
+    def __init__(self, matrix: np.ndarray) -> None:
+        self.matrix = matrix
+
+    def embed_documents(self, texts: List[str]) -> List[np.ndarray]:
+        return [self.matrix[int(t.split()[1])] for t in texts]
+
+
+def _rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def _corpus(rows: int, dim: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(max(1, rows // 200), dim))
+    return (
+        centers[rng.integers(len(centers), size=rows)]
+        + 0.3 * rng.normal(size=(rows, dim))
+    ).astype(np.float32)
+
+
+def _queries(matrix: np.ndarray, n: int) -> np.ndarray:
+    rng = np.random.default_rng(1)
+    picked = matrix[rng.integers(len(matrix), size=n)]
+    return picked + 0.05 * rng.normal(size=picked.shape)
+
+
+def _measure(store: str, root: str, rows: int, dim: int, n: int, k: int) -> Dict:
+    queries = _queries(_corpus(rows, dim), n)
+    base = _rss_mb()
+    start = time.perf_counter()
+    if store == "in-memory":
+        matrix = np.asarray(_corpus(rows, dim), dtype=np.float64)
+        try:
+            import faiss
+
+            index = faiss.IndexFlatIP(dim)
+            index.add(
+                (matrix / np.linalg.norm(matrix, axis=1, keepdims=True)).astype(
+                    np.float32
+                )
+            )
+
+            def search(q: np.ndarray) -> None:
+                index.search(q.astype(np.float32), k)
+
+        except ImportError:
+
+            def search(q: np.ndarray) -> None:
+                scores = (matrix @ q.T).T / np.linalg.norm(matrix, axis=1)
+                np.argsort(-scores, axis=1)[:, :k]
+
+    else:
+        idx = load_index(Path(root) / store)
+        assert idx is not None
+
+        def search(q: np.ndarray) -> None:
+            idx.search(q, k=k)
+
+    load_ms = (time.perf_counter() - start) * 1000
+    load_rss_mb = _rss_mb() - base
+    samples = []
+    for q in queries:
+        start = time.perf_counter()
+        search(q[None, :])
+        samples.append((time.perf_counter() - start) * 1000)
+    start = time.perf_counter()
+    search(queries)
+    batch_ms = (time.perf_counter() - start) * 1000
+    return {
+        "store": store,
+        "load_ms": round(load_ms, 1),
+        "p50_ms": round(statistics.median(samples), 2),
+        "p95_ms": round(sorted(samples)[int(0.95 * len(samples))], 2),
+        "batch_ms_per_query": round(batch_ms / len(queries), 3),
+        "load_rss_mb": round(load_rss_mb, 1),
+        "rss_mb": round(_rss_mb() - base, 1),
+    }
+
+
+def _run(args: tuple) -> Dict:
+    return _measure(*args)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=4)
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as root:
+            embeddings = _Embeddings(_corpus(rows, args.dim))
+            documents = [_Document(i) for i in range(rows)]
+            for store, kwargs in [
+                ("float32", {"n_lists": 0}),
+                ("float16", {"dtype": "float16", "n_lists": 0}),
+                ("ivf", {"n_lists": max(1, int(np.sqrt(rows)))}),
+            ]:
+                (Path(root) / store).mkdir()
+                build(documents, embeddings, Path(root) / store, **kwargs)
+            del embeddings
+            print(f"rows={rows} dim={args.dim}")
+            # a fresh process per store, so memory use isn't shared
+            with multiprocessing.get_context("spawn").Pool(
+                1, maxtasksperchild=1
+            ) as pool:
+                for store in ["in-memory", "float32", "float16", "ivf"]:
+                    result = pool.apply(
+                        _run, ((store, root, rows, args.dim, args.queries, args.k),)
+                    )
+                    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
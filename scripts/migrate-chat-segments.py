@@ -0,0 +1,53 @@
+"""Rewrite per-message chat objects into segmented conversations.
+
+usage: python scripts/migrate-chat-segments.py [--dry-run] [--delete-legacy]
+"""
+
+import argparse
+import asyncio
+from typing import Set
+
+from kookaburra.const import CHAT_LEGACY
+from kookaburra.gs import gs_svc
+
+
+def get_legacy_prefixes() -> Set[str]:
+    """Find every {llm.id}/{phone_hash} that still has per-message objects"""
+    bucket = gs_svc._bucket()
+    prefixes = set()
+    for blob in bucket.list_blobs():
+        parts = blob.name.split("/")
+        if len(parts) == 4 and parts[3] == CHAT_LEGACY:
+            prefixes.add("/".join(parts[:2]))
+    return prefixes
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--delete-legacy", action="store_true")
+    args = parser.parse_args()
+
+    prefixes = sorted(get_legacy_prefixes())
+    print(f"Found {len(prefixes)} conversations to migrate.")
+    if args.dry_run:
+        for prefix in prefixes:
+            print(prefix)
+        return
+
+    bucket = gs_svc._bucket()
+    turns = 0
+    for prefix in prefixes:
+        turns += (
+            await gs_svc.migrate_legacy_chat(
+                bucket=bucket,
+                prefix=prefix,
+                delete_legacy=args.delete_legacy,
+            )
+            or 0
+        )
+    print(f"Migrated {turns} turns in {len(prefixes)} conversations.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
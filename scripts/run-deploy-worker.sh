@@ -0,0 +1,3 @@
+#!/bin/sh -x
+
+DEPLOY_WORKERS_IN_APP=false python -m kookaburra.deploy_jobs ${@}
@@ -0,0 +1,5 @@
+#!/bin/sh -ex
+
+docker run -d --rm --name kb-gcs \
+    -p 4443:4443 \
+    fsouza/fake-gcs-server -scheme http -port 4443 ${@}
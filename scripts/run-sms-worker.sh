@@ -0,0 +1,3 @@
+#!/bin/sh -x
+
+SMS_INGEST_MODE=queue python -m kookaburra.sms ${@}
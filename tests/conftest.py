@@ -9,6 +9,8 @@ from sqlalchemy.orm import sessionmaker
 from sqlmodel import SQLModel
 from sqlmodel.ext.asyncio.session import AsyncSession
 
+from kookaburra.breaker import breakers
+from kookaburra.cache import routing_cache
 from kookaburra.db import async_psql_engine
 from kookaburra.main import app as server_app
 
@@ -46,6 +48,18 @@ async def async_db_session() -> AsyncGenerator:
     await async_psql_engine.dispose()
 
 
+@pytest.fixture(
+    scope="function",
+    autouse=True,
+)
+def clear_caches() -> Generator:
+    routing_cache.invalidate()
+    breakers.reset()
+    yield
+    routing_cache.invalidate()
+    breakers.reset()
+
+
 @pytest.fixture(
     scope="session",
     autouse=True,
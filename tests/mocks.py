@@ -1,4 +1,6 @@
-from typing import List, Mapping
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
 
 
 class MockGithubEmail:
@@ -76,26 +78,55 @@ class MockAsyncOAuth2Client:
 
 
 class MockGoogleCloudStorageBlob:
-    @staticmethod
-    def download_as_string() -> str:
-        return '{"_in": "message", "_out": "message", "timestamp": 0}'
+    def __init__(self, bucket: "MockGoogleCloudStorageBucket", name: str) -> None:
+        self.bucket = bucket
+        self.name = name
 
-    @staticmethod
-    def upload_from_string(data: str) -> None:
-        pass
+    @property
+    def generation(self) -> int:
+        return self.bucket.objects.get(self.name, (b"", 0))[1]
+
+    def download_as_bytes(self) -> bytes:
+        if self.name not in self.bucket.objects:
+            raise NotFound(self.name)
+        self.bucket.downloads += 1
+        return self.bucket.objects[self.name][0]
+
+    def upload_from_string(
+        self,
+        data: str,
+        content_type: Optional[str] = None,
+        if_generation_match: Optional[int] = None,
+    ) -> None:
+        if if_generation_match is not None and if_generation_match != self.generation:
+            raise PreconditionFailed(self.name)
+        self.bucket.generation += 1
+        self.bucket.objects[self.name] = (data.encode("utf8"), self.bucket.generation)
+
+    def delete(self) -> None:
+        self.bucket.objects.pop(self.name)
 
 
 class MockGoogleCloudStorageBucket:
-    @staticmethod
-    def list_blobs(prefix: str) -> List:
-        return [MockGoogleCloudStorageBlob(), MockGoogleCloudStorageBlob()]
+    def __init__(self) -> None:
+        self.objects: Dict[str, Tuple[bytes, int]] = {}
+        self.generation = 0
+        self.downloads = 0
 
-    @staticmethod
-    def blob(path: str) -> MockGoogleCloudStorageBlob:
-        return MockGoogleCloudStorageBlob()
+    def list_blobs(self, prefix: str = "") -> List:
+        return [
+            MockGoogleCloudStorageBlob(self, name)
+            for name in sorted(self.objects)
+            if name.startswith(prefix)
+        ]
+
+    def blob(self, name: str) -> MockGoogleCloudStorageBlob:
+        return MockGoogleCloudStorageBlob(self, name)
 
 
 class MockGoogleCloudStorageClient:
-    @staticmethod
-    def get_bucket(bucket_or_name: str) -> MockGoogleCloudStorageBucket:
-        return MockGoogleCloudStorageBucket()
+    def __init__(self) -> None:
+        self._bucket = MockGoogleCloudStorageBucket()
+
+    def bucket(self, bucket_name: str) -> MockGoogleCloudStorageBucket:
+        return self._bucket
@@ -0,0 +1,153 @@
+import base64
+import json
+import time
+from datetime import datetime, timedelta
+from unittest import mock
+
+from httpx import AsyncClient
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from kookaburra.const import API_V0
+from kookaburra.exc import KookaburraException
+from kookaburra.llm import llm_svc
+from kookaburra.metrics import metrics
+from kookaburra.models import GitHubUser, GitHubUserCreate, Llm
+from kookaburra.types import GitHubUserAuthToken
+from kookaburra.utils import _encrypt
+
+
+async def _llm(psql: AsyncSession) -> Llm:
+    user = GitHubUser(
+        **GitHubUserCreate(username="user", emails=["user@example.com"]).dict()
+    )
+    psql.add(user)
+    await psql.commit()
+    return await llm_svc.create(
+        clone_url="https://github.com/user/app.git",
+        psql=psql,
+        user=user,
+        phone_number="+15555555555",
+    )
+
+
+def _auth_token() -> str:
+    return _encrypt(
+        base64.b64encode(
+            json.dumps(
+                GitHubUserAuthToken(
+                    display_name="user",
+                    emails=["user@example.com"],
+                    raw_data={"login": "user"},
+                    expiry=time.time() + 30,
+                ).dict()
+            ).encode("utf8")
+        )
+    ).decode()
+
+
+async def test_cutover(async_db_session: AsyncSession) -> None:
+    llm = await _llm(async_db_session)
+    blue, green = f"{llm.id}-b", f"{llm.id}-g"
+
+    # the first deploy has nothing to drain
+    assert await llm_svc.next_app_name(llm, async_db_session) == blue
+    await llm_svc.cutover(llm, blue, "sha1", async_db_session)
+    assert (llm.app_name, llm.deployed_sha) == (blue, "sha1")
+    assert llm.modal_url == f"https://kookaburracodes--{blue}--api.modal.run/"
+    assert llm.previous_app_name is None
+
+    cutovers = metrics.get("deploy_cutovers")
+    assert await llm_svc.next_app_name(llm, async_db_session) == green
+    await llm_svc.cutover(llm, green, "sha2", async_db_session)
+    assert (llm.app_name, llm.deployed_sha) == (green, "sha2")
+    assert (llm.previous_app_name, llm.previous_sha) == (blue, "sha1")
+    assert llm.drain_until is not None and llm.drain_until > datetime.utcnow()
+    assert metrics.get("deploy_cutovers") == cutovers + 1
+
+    # deploying to the draining slot replaces the version in it
+    assert await llm_svc.next_app_name(llm, async_db_session) == blue
+    assert llm.previous_app_name is None
+    assert llm.drain_until is None
+
+
+@mock.patch("kookaburra.llm.deploy_svc.stop_modal_app")
+async def test_cutover_legacy_app(
+    mock_stop: mock.MagicMock,
+    async_db_session: AsyncSession,
+) -> None:
+    llm = await _llm(async_db_session)
+    llm.deployed_sha = "sha0"
+    # an app deployed before blue/green drains under its old name
+    await llm_svc.cutover(llm, f"{llm.id}-b", "sha1", async_db_session)
+    assert llm.previous_app_name == str(llm.id)
+
+    # a push that lands while a version drains stops that version right away
+    await llm_svc.cutover(llm, f"{llm.id}-g", "sha2", async_db_session)
+    mock_stop.assert_called_once_with(str(llm.id))
+    assert llm.previous_app_name == f"{llm.id}-b"
+
+
+async def test_rollback(
+    server: AsyncClient,
+    async_db_session: AsyncSession,
+) -> None:
+    llm = await _llm(async_db_session)
+    cookies = {"kb_auth_token": _auth_token()}
+    url = f"{API_V0}/llm/{llm.id}/rollback"
+
+    response = await server.post(url)
+    assert response.status_code == 403
+    response = await server.post(
+        f"{API_V0}/llm/00000000-0000-4000-8000-000000000000/rollback",
+        cookies=cookies,
+    )
+    assert response.status_code == 400
+
+    await llm_svc.cutover(llm, f"{llm.id}-b", "sha1", async_db_session)
+    response = await server.post(url, cookies=cookies)
+    assert response.status_code == 400
+    assert response.json() == {"detail": "There is no version to roll back to."}
+
+    await llm_svc.cutover(llm, f"{llm.id}-g", "sha2", async_db_session)
+    response = await server.post(url, cookies=cookies)
+    assert response.status_code == 200
+    await async_db_session.refresh(llm)
+    assert (llm.app_name, llm.deployed_sha) == (f"{llm.id}-b", "sha1")
+    assert (llm.previous_app_name, llm.previous_sha) == (f"{llm.id}-g", "sha2")
+    assert llm.modal_url == f"https://kookaburracodes--{llm.id}-b--api.modal.run/"
+    # the rolled back tree is deployed again when it is pushed again
+    assert llm.tree_hash is None
+
+
+@mock.patch("kookaburra.llm.deploy_svc.stop_modal_app")
+async def test_stop_drained(
+    mock_stop: mock.MagicMock,
+    async_db_session: AsyncSession,
+) -> None:
+    llm = await _llm(async_db_session)
+    await llm_svc.cutover(llm, f"{llm.id}-b", "sha1", async_db_session)
+    await llm_svc.cutover(llm, f"{llm.id}-g", "sha2", async_db_session)
+    assert await llm_svc.stop_drained() is False
+
+    # a failed stop is retried later
+    llm.drain_until = datetime.utcnow() - timedelta(seconds=1)
+    async_db_session.add(llm)
+    await async_db_session.commit()
+    mock_stop.side_effect = KookaburraException("modal is down")
+    assert await llm_svc.stop_drained() is True
+    await async_db_session.refresh(llm)
+    assert llm.previous_app_name == f"{llm.id}-b"
+    assert llm.drain_until > datetime.utcnow()
+
+    llm.drain_until = datetime.utcnow() - timedelta(seconds=1)
+    async_db_session.add(llm)
+    await async_db_session.commit()
+    mock_stop.side_effect = None
+    stopped = metrics.get("modal_app_stops", ok="true")
+    assert await llm_svc.stop_drained() is True
+    mock_stop.assert_called_with(f"{llm.id}-b")
+    await async_db_session.refresh(llm)
+    assert llm.previous_app_name is None
+    assert llm.drain_until is None
+    assert metrics.get("modal_app_stops", ok="true") == stopped + 1
+    assert await llm_svc.stop_drained() is False
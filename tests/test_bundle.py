@@ -0,0 +1,62 @@
+import tempfile
+from pathlib import Path
+
+from kookaburra_deployment.bundle import IGNORE_FILE, Bundle
+from kookaburra_deployment.image import REQUIREMENTS_FILE, deps_digest
+
+
+def test_bundle() -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        for path in [
+            "kookaburra.py",
+            "docs/a.md",
+            "docs/b.md",
+            "data/big.bin",
+            "data/keep.txt",
+            ".git/HEAD",
+            "__pycache__/kookaburra.cpython-311.pyc",
+            ".venv/lib/site.py",
+            "notes/.env",
+        ]:
+            (root / path).parent.mkdir(parents=True, exist_ok=True)
+            (root / path).write_text(path)
+        (root / IGNORE_FILE).write_text("# large files\ndata/\n!keep.txt\n*.md\n")
+
+        bundle = Bundle(root)
+        assert sorted(bundle.files) == [IGNORE_FILE, "kookaburra.py"]
+        assert bundle.summary()["files"] == 2
+        assert bundle.size == len("kookaburra.py") + (root / IGNORE_FILE).stat().st_size
+        assert bundle.includes(str(root / "kookaburra.py"))
+        assert bundle.includes("kookaburra.py")
+        assert not bundle.includes(str(root / "docs/a.md"))
+        assert not bundle.includes("/elsewhere/kookaburra.py")
+
+        # a file, not a directory, named like a directory rule is kept
+        assert not bundle.ignored("data", is_dir=False)
+        assert bundle.ignored("data", is_dir=True)
+
+        # the digest only changes with the content
+        digest = bundle.digest
+        assert Bundle(root).digest == digest
+        (root / "kookaburra.py").write_text("changed")
+        assert Bundle(root).digest != digest
+
+        assert sorted(Bundle(root, ignore=["*.py"]).files) == [IGNORE_FILE]
+
+        # changing only the readme doesn't need a redeploy
+        runtime_digest = Bundle(root).runtime_digest
+        (root / "README.txt").write_text("# app")
+        assert Bundle(root).runtime_digest == runtime_digest
+        assert Bundle(root).digest != Bundle(root, ignore=["README.txt"]).digest
+
+
+def test_deps_digest() -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        digest = deps_digest(root)
+        # code changes don't change the dependency layers
+        (root / "kookaburra.py").write_text("print('hello')")
+        assert deps_digest(root) == digest
+        (root / REQUIREMENTS_FILE).write_text("requests\n")
+        assert deps_digest(root) != digest
@@ -0,0 +1,144 @@
+import json
+from unittest import mock
+from uuid import uuid4
+
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from kookaburra.cache import (
+    ResponseCache,
+    RoutingCache,
+    cache_invalidator,
+    routing_cache,
+)
+from kookaburra.const import CACHE_ROUTING
+from kookaburra.llm import llm_svc
+from kookaburra.metrics import metrics
+from kookaburra.models import GitHubUser, GitHubUserCreate, Llm
+
+
+def test_routing_cache() -> None:
+    cache = RoutingCache(ttl=60, negative_ttl=60)
+    llm = Llm(
+        phone_number="+15555555555",
+        modal_url="https://example.com",
+        clone_url="https://github.com",
+    )
+    hits = metrics.get("routing_cache_hits")
+    misses = metrics.get("routing_cache_misses")
+
+    assert cache.get("+15555555555") == (False, None)
+    cache.set("+15555555555", llm)
+    cache.set("+15555555554", None)
+    assert cache.get("+15555555555") == (True, llm)
+    assert cache.get("+15555555554") == (True, None)
+
+    cache.invalidate("+15555555555")
+    assert cache.get("+15555555555") == (False, None)
+    assert cache.get("+15555555554") == (True, None)
+    cache.invalidate()
+    assert cache.get("+15555555554") == (False, None)
+
+    assert metrics.get("routing_cache_hits") == hits + 3
+    assert metrics.get("routing_cache_misses") == misses + 3
+
+
+def test_routing_cache_expiry() -> None:
+    cache = RoutingCache(ttl=60, negative_ttl=-1)
+    cache.set("+15555555554", None)
+    assert cache.get("+15555555554") == (False, None)
+
+
+def test_cache_invalidator_notification() -> None:
+    routing_cache.set("+15555555555", None)
+    cache_invalidator._on_notify(
+        mock.MagicMock(),
+        0,
+        "kookaburra_cache",
+        json.dumps({"kind": CACHE_ROUTING, "key": "+15555555555"}),
+    )
+    assert routing_cache.get("+15555555555") == (False, None)
+
+
+async def test_routing_cache_invalidated_on_create(
+    async_db_session: AsyncSession,
+) -> None:
+    async with async_db_session.begin():
+        ghuser_create = GitHubUserCreate(
+            username="user",
+            emails=["user@example.com"],
+        )
+        user = GitHubUser(**ghuser_create.dict())
+        async_db_session.add(user)
+        await async_db_session.commit()
+        assert user.id is not None
+
+    assert (
+        await llm_svc.get_llm_by_phone_number(
+            phone_number="+15555555555", psql=async_db_session
+        )
+        is None
+    )
+    assert routing_cache.get("+15555555555") == (True, None)
+
+    llm = await llm_svc.create(
+        clone_url="https://github.com",
+        psql=async_db_session,
+        user=user,
+        phone_number="+15555555555",
+    )
+    _llm = await llm_svc.get_llm_by_phone_number(
+        phone_number="+15555555555", psql=async_db_session
+    )
+    assert _llm is not None
+    assert _llm.id == llm.id
+
+
+def test_response_cache() -> None:
+    cache = ResponseCache(ttl=60, max_bytes=1024, history_turns=1)
+    llm = Llm(
+        id=uuid4(),
+        phone_number="+15555555555",
+        modal_url="https://example.com",
+        clone_url="https://github.com",
+        deployed_sha="a",
+    )
+    key = cache.key(llm, "Hours?", [("hi", "hello")])
+    assert cache.get(key) is None
+    cache.set(key, "9 to 5")
+    assert cache.get(cache.key(llm, "  hours ", [("x", "y"), ("HI", "hello")])) == (
+        "9 to 5"
+    )
+    assert cache.get(cache.key(llm, "hours", [("hi", "hey")])) is None
+    assert metrics.get("llm_response_cache_hit_ratio", llm_id=str(llm.id)) == 1 / 3
+
+    # a new deploy changes the key
+    llm.deployed_sha = "b"
+    assert cache.get(cache.key(llm, "hours?", [("hi", "hello")])) is None
+
+    cache.invalidate(str(llm.id))
+    assert cache.size == 0
+
+
+def test_response_cache_eviction() -> None:
+    cache = ResponseCache(ttl=60, max_bytes=1024, history_turns=0)
+    llm = Llm(
+        id=uuid4(),
+        phone_number="+15555555555",
+        modal_url="https://example.com",
+        clone_url="https://github.com",
+    )
+    keys = [cache.key(llm, str(i), []) for i in range(5)]
+    for key in keys:
+        cache.set(key, "x" * 200)
+    # the oldest entries are evicted to stay within budget
+    assert cache.size <= 1024
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[-1]) == "x" * 200
+    # responses larger than the budget are not cached
+    cache.set(keys[0], "x" * 2048)
+    assert cache.get(keys[0]) is None
+
+    expired = ResponseCache(ttl=-1, max_bytes=1024, history_turns=0)
+    expired.set(keys[0], "x")
+    assert expired.get(keys[0]) is None
+    assert expired.size == 0
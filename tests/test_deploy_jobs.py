@@ -0,0 +1,280 @@
+import base64
+import json
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict
+from unittest import mock
+from uuid import uuid4
+
+from httpx import AsyncClient
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from kookaburra.const import (
+    API_V0,
+    JOB_FAILED,
+    JOB_RUNNING,
+    JOB_SUCCEEDED,
+    JOB_SUPERSEDED,
+)
+from kookaburra.deploy_jobs import deploy_job_svc
+from kookaburra.models import DeployJob, GitHubUser, GitHubUserCreate
+from kookaburra.recorder import DeployRecorder
+from kookaburra.settings import env
+from kookaburra.types import GitHubUserAuthToken
+from kookaburra.utils import _encrypt
+
+
+def _push(full_name: str = "user/app", sha: str = "abc1234") -> Dict:
+    return {
+        "ref": "refs/heads/main",
+        "after": sha,
+        "pusher": {"name": "user"},
+        "repository": {
+            "full_name": full_name,
+            "clone_url": f"https://github.com/{full_name}.git",
+            "default_branch": "main",
+        },
+    }
+
+
+async def _user(psql: AsyncSession, username: str = "user") -> GitHubUser:
+    async with psql.begin():
+        user = GitHubUser(
+            **GitHubUserCreate(
+                username=username,
+                emails=[f"{username}@example.com"],
+                waitlisted=False,
+            ).dict(),
+        )
+        psql.add(user)
+        await psql.commit()
+    return user
+
+
+def _auth_token(username: str = "user") -> str:
+    return _encrypt(
+        base64.b64encode(
+            json.dumps(
+                GitHubUserAuthToken(
+                    display_name=username,
+                    emails=[f"{username}@example.com"],
+                    raw_data={"login": username},
+                    expiry=time.time() + 30,
+                ).dict()
+            ).encode("utf8")
+        )
+    ).decode()
+
+
+async def _handle_push(recorder: DeployRecorder, **kwargs: Any) -> None:
+    with recorder.stage("clone") as stage:
+        recorder.log("cloned")
+        stage["bytes"] = 1024
+
+
+async def test_gh_webhook_push(
+    server: AsyncClient, async_db_session: AsyncSession
+) -> None:
+    await _user(async_db_session)
+    res = await server.post(
+        f"{API_V0}/wh/gh",
+        json=_push(),
+        headers={"X-GitHub-Event": "push"},
+    )
+    assert res.status_code == 202
+    job = (await async_db_session.execute(select(DeployJob))).scalars().one()
+    assert (job.full_name, job.ref, job.sha) == (
+        "user/app",
+        "refs/heads/main",
+        "abc1234",
+    )
+    assert job.payload == _push()
+
+    res = await server.post(
+        f"{API_V0}/wh/gh",
+        json=_push(),
+        headers={"X-GitHub-Event": "ping"},
+    )
+    assert res.status_code == 200
+
+
+@mock.patch(
+    "kookaburra.deploy_jobs.gh_svc.handle_push",
+    side_effect=_handle_push,
+)
+async def test_deploy_job_succeeded(
+    mock_handle_push: mock.MagicMock,
+    async_db_session: AsyncSession,
+) -> None:
+    user = await _user(async_db_session)
+    await deploy_job_svc.enqueue(user=user, request=_push(), psql=async_db_session)
+    assert await deploy_job_svc.process_next() is True
+    assert await deploy_job_svc.process_next() is False
+
+    job = (await async_db_session.execute(select(DeployJob))).scalars().one()
+    assert job.status == JOB_SUCCEEDED
+    assert job.attempts == 1
+    assert job.finished_at is not None
+    assert "clone_ms" in job.stages
+    assert job.stages["clone_bytes"] == 1024
+    assert "cloned" in job.log
+    assert mock_handle_push.call_args.kwargs["request"] == _push()
+
+
+@mock.patch(
+    "kookaburra.deploy_jobs.gh_svc.handle_push",
+    side_effect=Exception("modal is down"),
+)
+async def test_deploy_job_failed(
+    mock_handle_push: mock.MagicMock,
+    async_db_session: AsyncSession,
+) -> None:
+    user = await _user(async_db_session)
+    await deploy_job_svc.enqueue(user=user, request=_push(), psql=async_db_session)
+    assert await deploy_job_svc.process_next() is True
+    # a failed deploy isn't retried
+    assert await deploy_job_svc.process_next() is False
+
+    job = (await async_db_session.execute(select(DeployJob))).scalars().one()
+    assert job.status == JOB_FAILED
+    assert "modal is down" in job.last_error
+
+
+async def test_deploy_job_no_user(async_db_session: AsyncSession) -> None:
+    user = GitHubUser(id=uuid4(), username="gone", emails=[])
+    await deploy_job_svc.enqueue(user=user, request=_push(), psql=async_db_session)
+    assert await deploy_job_svc.process_next() is True
+
+    job = (await async_db_session.execute(select(DeployJob))).scalars().one()
+    assert job.status == JOB_FAILED
+
+
+@mock.patch.object(env, "DEPLOY_MAX_CONCURRENT", 2)
+@mock.patch.object(env, "DEPLOY_MAX_CONCURRENT_PER_USER", 1)
+async def test_deploy_job_limits(async_db_session: AsyncSession) -> None:
+    user = await _user(async_db_session)
+    other = await _user(async_db_session, username="other")
+    third = await _user(async_db_session, username="third")
+    for u, full_name in [
+        (user, "user/a"),
+        (user, "user/b"),
+        (other, "other/a"),
+        (third, "third/a"),
+    ]:
+        await deploy_job_svc.enqueue(
+            user=u, request=_push(full_name=full_name), psql=async_db_session
+        )
+
+    first = await deploy_job_svc.claim(psql=async_db_session)
+    assert first is not None and first.githubuser_id == user.id
+    # the user's second deploy waits for the first, the other user's doesn't
+    second = await deploy_job_svc.claim(psql=async_db_session)
+    assert second is not None and second.githubuser_id == other.id
+    # every deploy slot is taken
+    assert await deploy_job_svc.claim(psql=async_db_session) is None
+
+
+@mock.patch(
+    "kookaburra.deploy_jobs.gh_svc.post_commit_status",
+    side_effect=[None, Exception("GitHub is down")],
+)
+async def test_deploy_job_superseded(
+    mock_post_commit_status: mock.MagicMock,
+    async_db_session: AsyncSession,
+) -> None:
+    user = await _user(async_db_session)
+    for sha in ["a" * 7, "b" * 7, "c" * 7]:
+        await deploy_job_svc.enqueue(
+            user=user, request=_push(sha=sha), psql=async_db_session
+        )
+    other = await deploy_job_svc.enqueue(
+        user=user, request=_push(full_name="user/other"), psql=async_db_session
+    )
+
+    # only the latest push is deployed
+    job = await deploy_job_svc.claim(psql=async_db_session)
+    assert job is not None and job.sha == "c" * 7
+    jobs = (
+        (
+            await async_db_session.execute(
+                select(DeployJob)
+                .where(DeployJob.full_name == "user/app")
+                .order_by(DeployJob.sha)
+            )
+        )
+        .scalars()
+        .all()
+    )
+    assert [j.status for j in jobs] == [JOB_SUPERSEDED, JOB_SUPERSEDED, JOB_RUNNING]
+    assert [c.kwargs["sha"] for c in mock_post_commit_status.call_args_list] == [
+        "a" * 7,
+        "b" * 7,
+    ]
+    assert mock_post_commit_status.call_args.kwargs["state"] == "error"
+
+    # a new push waits for the running deploy of its repo
+    await deploy_job_svc.enqueue(
+        user=user, request=_push(sha="d" * 7), psql=async_db_session
+    )
+    with mock.patch.object(env, "DEPLOY_MAX_CONCURRENT_PER_USER", 2):
+        assert await deploy_job_svc.claim(psql=async_db_session) == other
+        assert await deploy_job_svc.claim(psql=async_db_session) is None
+
+
+@mock.patch.object(env, "DEPLOY_JOB_MAX_ATTEMPTS", 1)
+async def test_deploy_job_reclaimed(async_db_session: AsyncSession) -> None:
+    user = await _user(async_db_session)
+    job = await deploy_job_svc.enqueue(
+        user=user, request=_push(), psql=async_db_session
+    )
+    # left running by a worker that died
+    job.status = JOB_RUNNING
+    job.attempts = 1
+    job.started_at = datetime.utcnow() - timedelta(
+        seconds=3 * env.DEPLOY_JOB_TIMEOUT_SECONDS
+    )
+    async_db_session.add(job)
+    await async_db_session.commit()
+
+    assert await deploy_job_svc.process_next() is True
+    await async_db_session.refresh(job)
+    assert job.status == JOB_FAILED
+    assert job.attempts == 2
+    assert job.last_error is not None
+    assert "Gave up" in job.last_error
+
+
+def test_deploy_recorder_output() -> None:
+    recorder = DeployRecorder(max_bytes=64)
+    for i in range(10):
+        recorder.log(f"line {i}")
+    assert len(recorder.output.encode("utf8")) <= 64
+    assert recorder.output.endswith("line 9")
+
+
+async def test_deploys(server: AsyncClient, async_db_session: AsyncSession) -> None:
+    res = await server.get(f"{API_V0}/deploys")
+    assert res.status_code == 403
+    res = await server.get(f"{API_V0}/deploys/{uuid4()}")
+    assert res.status_code == 403
+
+    user = await _user(async_db_session)
+    job = await deploy_job_svc.enqueue(
+        user=user, request=_push(), psql=async_db_session
+    )
+    cookies = {"kb_auth_token": _auth_token()}
+    res = await server.get(f"{API_V0}/deploys", cookies=cookies)
+    assert res.status_code == 200
+    assert [d["id"] for d in res.json()] == [str(job.id)]
+    assert "log" not in res.json()[0]
+
+    res = await server.get(f"{API_V0}/deploys/{job.id}", cookies=cookies)
+    assert res.status_code == 200
+    assert res.json()["log"] == ""
+    res = await server.get(f"{API_V0}/deploys/{uuid4()}", cookies=cookies)
+    assert res.status_code == 400
+
+    res = await server.get("/", cookies=cookies)
+    assert res.status_code == 200
+    assert "user/app@abc1234" in res.text
@@ -0,0 +1,55 @@
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+from kookaburra.deployment import run_command
+from kookaburra.exc import KookaburraException
+
+
+async def test_run_command(tmp_path: Path) -> None:
+    output = await run_command(
+        [
+            sys.executable,
+            "-c",
+            "import os, sys; print(os.getcwd()); print('oops', file=sys.stderr)",
+        ],
+        timeout=10,
+        cwd=str(tmp_path),
+    )
+    assert output.splitlines() == [str(tmp_path), "oops"]
+
+    with pytest.raises(KookaburraException) as e:
+        await run_command(
+            [sys.executable, "-c", "print('no token'); exit(3)"],
+            timeout=10,
+        )
+    assert "exited with 3" in str(e.value)
+    assert "no token" in str(e.value)
+
+
+async def test_run_command_timeout() -> None:
+    start = time.perf_counter()
+    with pytest.raises(KookaburraException) as e:
+        await run_command(
+            [
+                sys.executable,
+                "-c",
+                "import time; print('deploying', flush=True); time.sleep(30)",
+            ],
+            timeout=0.5,
+        )
+    assert time.perf_counter() - start < 10
+    assert "timed out" in str(e.value)
+    assert "deploying" in str(e.value)
+
+    # a cancelled deploy is killed too
+    task = asyncio.create_task(
+        run_command([sys.executable, "-c", "import time; time.sleep(30)"], timeout=30)
+    )
+    await asyncio.sleep(0.5)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
@@ -0,0 +1,206 @@
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, List
+from unittest import mock
+
+import pytest
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from kookaburra.const import KB_JSON
+from kookaburra.deployment import deploy_svc
+from kookaburra.gh import gh_svc
+from kookaburra.llm import llm_svc
+from kookaburra.models import GitHubUser, GitHubUserCreate, Llm
+from kookaburra.recorder import DeployRecorder
+from kookaburra_deployment.index import build
+from tests.test_index import FakeEmbeddings, _docs, _texts
+
+
+def _push(sha: str, ref: str = "refs/heads/main") -> Dict:
+    return {
+        "ref": ref,
+        "after": sha,
+        "repository": {
+            "full_name": "user/app",
+            "clone_url": "https://github.com/user/app.git",
+            "default_branch": "main",
+        },
+    }
+
+
+async def _user(psql: AsyncSession) -> GitHubUser:
+    user = GitHubUser(
+        **GitHubUserCreate(username="user", emails=["user@example.com"]).dict()
+    )
+    psql.add(user)
+    await psql.commit()
+    return user
+
+
+class _Deploy:
+    """Stand-ins for everything handle_push calls over the network, recording
+    the order of the steps."""
+
+    def __init__(self) -> None:
+        self.app = "def get_llm(): ..."
+        self.steps: List[str] = []
+        self.kb: List[Dict] = []
+        self.statuses: List[str] = []
+        self._cutover = llm_svc.cutover
+
+    async def clone_repo(self, request: Dict, to_path: str) -> Dict:
+        os.makedirs(to_path)
+        Path(to_path, "kookaburra.py").write_text(self.app)
+        return {"bytes": len(self.app)}
+
+    async def modal_deploy(self, tmpdir: str, app_name: str) -> str:
+        self.steps.append(f"deploy {app_name}")
+        kb_json = next(Path(tmpdir).glob(f"*/{KB_JSON}"))
+        self.kb.append(json.loads(kb_json.read_text()))
+        return "deployed"
+
+    async def ready(self, modal_url: str) -> None:
+        self.steps.append(f"ready {modal_url}")
+
+    async def warm(self, llm: Llm, modal_url: str) -> Any:
+        self.steps.append(f"warm {modal_url}")
+        return 1000, 100
+
+    async def cutover(self, **kwargs: Any) -> None:
+        self.steps.append(f"cutover {kwargs['app_name']}")
+        await self._cutover(**kwargs)
+
+    async def post_commit_status(self, state: str, description: str, **_: Any) -> None:
+        self.statuses.append(f"{state}: {description}")
+
+
+def _steps(app_name: str) -> List[str]:
+    modal_url = deploy_svc.get_modal_url(app_name=app_name)
+    return [
+        f"deploy {app_name}",
+        f"ready {modal_url}",
+        f"warm {modal_url}",
+        f"cutover {app_name}",
+    ]
+
+
+@pytest.fixture
+def deploy() -> Any:
+    _deploy = _Deploy()
+    with mock.patch.object(
+        gh_svc, "clone_repo", side_effect=_deploy.clone_repo
+    ), mock.patch.object(
+        gh_svc, "post_commit_status", side_effect=_deploy.post_commit_status
+    ), mock.patch(
+        "kookaburra.gh.runtime_cache.link_into", return_value={"copied_bytes": 0}
+    ), mock.patch(
+        "kookaburra.gh.twilio_svc.provision_phone_number",
+        return_value="+15555555555",
+    ), mock.patch(
+        "kookaburra.gh.deploy_svc.modal_deploy", side_effect=_deploy.modal_deploy
+    ), mock.patch(
+        "kookaburra.gh.deploy_svc.build_index", return_value={}
+    ), mock.patch(
+        "kookaburra.gh.warmup_svc.ready", side_effect=_deploy.ready
+    ), mock.patch(
+        "kookaburra.gh.warmup_svc.warm", side_effect=_deploy.warm
+    ), mock.patch(
+        "kookaburra.gh.llm_svc.cutover", side_effect=_deploy.cutover
+    ):
+        yield _deploy
+
+
+async def test_handle_push(deploy: _Deploy, async_db_session: AsyncSession) -> None:
+    user = await _user(async_db_session)
+    await gh_svc.handle_push(request=_push("sha1"), psql=async_db_session, user=user)
+    llm = await llm_svc.get_by_clone_url(
+        clone_url="https://github.com/user/app.git", psql=async_db_session
+    )
+    assert llm is not None
+    blue, green = f"{llm.id}-b", f"{llm.id}-g"
+    # the new version is healthy and warm before traffic moves over
+    assert deploy.steps == _steps(blue)
+    assert deploy.kb == [{"llm_id": str(llm.id), "sha": "sha1", "keep": []}]
+    assert deploy.statuses == ["pending: Deploying...", "success: Deployed!"]
+    assert (llm.app_name, llm.deployed_sha) == (blue, "sha1")
+    assert (llm.cold_start_ms, llm.warm_ms) == (1000, 100)
+
+    deploy.app = "def get_llm(): ...  # v2"
+    deploy.steps.clear()
+    await gh_svc.handle_push(request=_push("sha2"), psql=async_db_session, user=user)
+    assert deploy.steps == _steps(green)
+    # the serving version keeps its index while the new one is deployed
+    assert deploy.kb[-1]["keep"] == ["sha1"]
+    await async_db_session.refresh(llm)
+    assert (llm.app_name, llm.previous_app_name) == (green, blue)
+
+    # a push that doesn't change the tree isn't deployed
+    deploy.steps.clear()
+    await gh_svc.handle_push(request=_push("sha3"), psql=async_db_session, user=user)
+    assert deploy.steps == []
+    assert deploy.statuses[-1] == "success: No changes to deploy."
+    await async_db_session.refresh(llm)
+    # it still serves the commit that was deployed
+    assert (llm.app_name, llm.deployed_sha) == (green, "sha2")
+
+    # only the default branch is deployed
+    await gh_svc.handle_push(
+        request=_push("sha4", ref="refs/heads/feature"),
+        psql=async_db_session,
+        user=user,
+    )
+    assert deploy.steps == []
+
+
+async def test_handle_push_unchanged_keeps_index(
+    deploy: _Deploy, async_db_session: AsyncSession, tmp_path: Path
+) -> None:
+    user = await _user(async_db_session)
+    embeddings = FakeEmbeddings()
+    for sha in ["sha1", "sha2"]:
+        deploy.app = f"def get_llm(): ...  # {sha}"
+        await gh_svc.handle_push(request=_push(sha), psql=async_db_session, user=user)
+        build(_docs(sha), embeddings, tmp_path, sha=sha, keep=deploy.kb[-1]["keep"])
+    # sha3 doesn't change the tree, sha2 keeps serving
+    await gh_svc.handle_push(request=_push("sha3"), psql=async_db_session, user=user)
+
+    deploy.app = "def get_llm(): ...  # sha4"
+    await gh_svc.handle_push(request=_push("sha4"), psql=async_db_session, user=user)
+    # sha1 drained from the slot sha4 is deployed to
+    assert deploy.kb[-1]["keep"] == ["sha2"]
+    build(_docs("sha4"), embeddings, tmp_path, sha="sha4", keep=deploy.kb[-1]["keep"])
+    # the draining version still finds its index
+    assert _texts(tmp_path, "sha2") == ["sha2"]
+    assert _texts(tmp_path, "sha1") is None
+
+
+async def test_handle_push_failure(
+    deploy: _Deploy, async_db_session: AsyncSession
+) -> None:
+    user = await _user(async_db_session)
+    await gh_svc.handle_push(request=_push("sha1"), psql=async_db_session, user=user)
+    llm = await llm_svc.get_by_clone_url(
+        clone_url="https://github.com/user/app.git", psql=async_db_session
+    )
+    assert llm is not None
+
+    deploy.app = "def get_llm(): ...  # v2"
+    deploy.steps.clear()
+    recorder = DeployRecorder(max_bytes=1 << 16)
+    with mock.patch(
+        "kookaburra.gh.warmup_svc.ready", side_effect=TimeoutError("not ready")
+    ):
+        with pytest.raises(TimeoutError):
+            await gh_svc.handle_push(
+                request=_push("sha2"),
+                psql=async_db_session,
+                user=user,
+                recorder=recorder,
+            )
+    # the serving version is left alone
+    assert deploy.steps == [f"deploy {llm.id}-g"]
+    assert deploy.statuses[-1] == "failure: Failed to deploy."
+    assert "not ready" in recorder.output
+    await async_db_session.refresh(llm)
+    assert (llm.app_name, llm.deployed_sha) == (f"{llm.id}-b", "sha1")
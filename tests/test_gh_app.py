@@ -0,0 +1,110 @@
+import asyncio
+import time
+from collections import Counter
+from pathlib import Path
+from unittest import mock
+
+import httpx
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from kookaburra.exc import KookaburraException
+from kookaburra.gh_app import GitHubAppAuth
+from kookaburra.settings import env
+
+INSTALLATIONS = [
+    [{"id": 1, "account": {"login": "user"}}],
+    [{"id": 2, "account": {"login": "other"}}],
+]
+
+
+@pytest.fixture
+def private_key(tmp_path: Path) -> str:
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    path = tmp_path / "app.pem"
+    path.write_bytes(
+        key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.TraditionalOpenSSL,
+            encryption_algorithm=serialization.NoEncryption(),
+        )
+    )
+    return str(path)
+
+
+class MockGitHub:
+    def __init__(self) -> None:
+        self.calls: Counter = Counter()
+        self.installations = INSTALLATIONS
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        # yield to the event loop, like a real request would
+        await asyncio.sleep(0)
+        assert request.headers["Authorization"].startswith("Bearer ")
+        path = request.url.path
+        self.calls[path] += 1
+        if path == "/app/installations":
+            page = int(request.url.params.get("page", 1))
+            headers = {}
+            if page < len(self.installations):
+                next_url = f"{request.url.copy_with(query=None)}?page={page + 1}"
+                headers["Link"] = f'<{next_url}>; rel="next"'
+            return httpx.Response(
+                200, json=self.installations[page - 1], headers=headers
+            )
+        if path == "/app/installations/3/access_tokens":
+            return httpx.Response(404, json={"message": "Not Found"})
+        return httpx.Response(
+            201,
+            json={
+                "token": f"token-{self.calls[path]}",
+                "expires_at": time.strftime(
+                    "%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 3600)
+                ),
+            },
+        )
+
+
+async def test_gh_app_auth(private_key: str) -> None:
+    github = MockGitHub()
+    client = httpx.AsyncClient(transport=httpx.MockTransport(github))
+    with mock.patch.object(env, "GH_APP_PRIVATE_KEY_PATH", private_key), mock.patch(
+        "kookaburra.gh_app.http_clients.get", return_value=client
+    ):
+        auth = GitHubAppAuth()
+        now = time.time()
+        app_jwt = auth.app_jwt(now)
+        assert auth.app_jwt(now + 60) == app_jwt
+        assert auth.app_jwt(now + 600) != app_jwt
+
+        # the installations are listed once, across both pages
+        assert await auth.installation_id("other") == 2
+        assert await auth.installation_id("user") == 1
+        assert github.calls["/app/installations"] == 2
+
+        # concurrent deploys share one token
+        token, same = await asyncio.gather(
+            auth.installation_token("user/app"),
+            auth.installation_token("user/other-app"),
+        )
+        assert same == token
+        assert await auth.installation_token("user/app") == token
+        assert github.calls["/app/installations/1/access_tokens"] == 1
+        # replaced once it is about to expire
+        assert await auth.installation_token("user/app", now=now + 3590) != token
+
+        # a missing account lists the installations again
+        with pytest.raises(KookaburraException):
+            await auth.installation_id("nobody")
+        assert github.calls["/app/installations"] == 4
+
+        # an uninstalled app is forgotten
+        github.installations = [[{"id": 3, "account": {"login": "gone"}}]]
+        with pytest.raises(KookaburraException):
+            await auth.installation_token("gone/app")
+        assert "gone" not in auth._installations
+
+        auth.reset()
+        assert auth._jwt is None
+    await client.aclose()
@@ -0,0 +1,218 @@
+import json
+from unittest import mock
+from uuid import uuid4
+
+import pytest
+from google.api_core.exceptions import PreconditionFailed
+
+from kookaburra.exc import KookaburraException
+from kookaburra.gs import _head_size, gs_svc
+from kookaburra.models import Llm
+from kookaburra.settings import env
+from kookaburra.types import BaseResponse
+from tests.mocks import MockGoogleCloudStorageClient
+
+
+def _llm() -> Llm:
+    return Llm(
+        id=uuid4(),
+        phone_number="+15555555555",
+        modal_url="https://example.com",
+        clone_url="https://github.com",
+    )
+
+
+async def _send(llm: Llm, i: int) -> None:
+    await gs_svc.upload_sms_chat(
+        llm,
+        {"From": "+15555555554", "Body": f"in {i}"},
+        BaseResponse(message=f"out {i}"),
+    )
+
+
+@mock.patch.object(env, "GS_CHAT_HEAD_MAX_TURNS", 2)
+@mock.patch.object(env, "GS_CHAT_SEGMENT_MAX_TURNS", 6)
+@mock.patch.object(env, "GS_CHAT_HISTORY_MAX_TURNS", 3)
+async def test_chat_segments() -> None:
+    client = MockGoogleCloudStorageClient()
+    llm = _llm()
+    with mock.patch("kookaburra.gs.GsService._gs", return_value=client):
+        for i in range(20):
+            with mock.patch("time.time", return_value=i):
+                await _send(llm, i)
+
+        bucket = client._bucket
+        segments = [n for n in bucket.objects if "/segments/" in n]
+        head = json.loads(
+            bucket.objects[[n for n in bucket.objects if n.endswith("head.json")][0]][0]
+        )
+        # obsolete segments are removed once they have been merged
+        assert sorted(segments) == sorted(s["name"] for s in head["segments"])
+        assert all(s["count"] <= 6 for s in head["segments"])
+        # the turns a read needs stay in the head
+        assert 3 <= len(head["turns"]) <= 3 + 2
+
+        bucket.downloads = 0
+        history = await gs_svc.get_sms_chat_history(llm, "+15555555554")
+        assert history == [(f"in {i}", f"out {i}") for i in range(17, 20)]
+        assert bucket.downloads == 1
+
+        bucket.downloads = 0
+        history = await gs_svc.get_sms_chat_history(llm, "+15555555554", max_turns=100)
+        assert history == [(f"in {i}", f"out {i}") for i in range(20)]
+        assert bucket.downloads == 1 + len(head["segments"])
+
+
+@mock.patch.object(env, "GS_CHAT_HEAD_MAX_TURNS", 2)
+async def test_chat_legacy() -> None:
+    client = MockGoogleCloudStorageClient()
+    llm = _llm()
+    prefix = gs_svc._prefix(str(llm.id), "+15555555554")
+    for i in range(5):
+        client._bucket.blob(f"{prefix}/{i}/chat.json").upload_from_string(
+            json.dumps({"_in": f"in {i}", "_out": f"out {i}", "timestamp": i})
+        )
+    with mock.patch("kookaburra.gs.GsService._gs", return_value=client):
+        expected = [(f"in {i}", f"out {i}") for i in range(5)]
+        assert await gs_svc.get_sms_chat_history(llm, "+15555555554") == expected
+
+        assert await gs_svc.migrate_legacy_chat(client._bucket, prefix) == 5
+        assert await gs_svc.migrate_legacy_chat(client._bucket, prefix) == 5
+        with mock.patch("time.time", return_value=5):
+            await _send(llm, 5)
+        assert (
+            await gs_svc.migrate_legacy_chat(client._bucket, prefix, delete_legacy=True)
+            == 6
+        )
+        assert await gs_svc.migrate_legacy_chat(client._bucket, prefix) is None
+
+        expected.append(("in 5", "out 5"))
+        assert await gs_svc.get_sms_chat_history(llm, "+15555555554") == expected
+
+
+async def test_chat_write_conflict() -> None:
+    client = MockGoogleCloudStorageClient()
+    llm = _llm()
+    with mock.patch("kookaburra.gs.GsService._gs", return_value=client):
+        await _send(llm, 0)
+        read_head = gs_svc._read_head
+
+        def _stale_read_head(*args: object) -> object:
+            head, generation = read_head(*args)  # type: ignore
+            if _stale_read_head.calls == 0:  # type: ignore
+                generation -= 1
+            _stale_read_head.calls += 1  # type: ignore
+            return head, generation
+
+        _stale_read_head.calls = 0  # type: ignore
+        with mock.patch.object(gs_svc, "_read_head", _stale_read_head):
+            await _send(llm, 1)
+        history = await gs_svc.get_sms_chat_history(llm, "+15555555554")
+        assert len(history) == 2
+
+
+@mock.patch.object(env, "GS_CHAT_HEAD_MAX_TURNS", 2)
+@mock.patch.object(env, "GS_CHAT_HISTORY_MAX_TURNS", 0)
+async def test_chat_compact_conflict() -> None:
+    client = MockGoogleCloudStorageClient()
+    llm = _llm()
+    prefix = gs_svc._prefix(str(llm.id), "+15555555554")
+    with mock.patch("kookaburra.gs.GsService._gs", return_value=client):
+        for i in range(2):
+            with mock.patch("time.time", return_value=i):
+                await _send(llm, i)
+        write_head = gs_svc._write_head
+
+        def _raced_write_head(*args: object) -> None:
+            if not _raced_write_head.raced:  # type: ignore
+                _raced_write_head.raced = True  # type: ignore
+                # another message compacts the same turns in the same millisecond
+                gs_svc._append(
+                    client._bucket,
+                    prefix,
+                    {"_in": "in 3", "_out": "", "timestamp": 2000},
+                    *gs_svc._budget(),
+                )
+            write_head(*args)  # type: ignore
+
+        _raced_write_head.raced = False  # type: ignore
+        with mock.patch.object(gs_svc, "_write_head", _raced_write_head), mock.patch(
+            "time.time", return_value=2
+        ):
+            await _send(llm, 2)
+        history = await gs_svc.get_sms_chat_history(llm, "+15555555554", max_turns=10)
+        assert len(history) == 4
+
+
+@mock.patch.object(env, "GS_CHAT_HEAD_MAX_TURNS", 2)
+@mock.patch.object(env, "GS_CHAT_SEGMENT_MAX_TURNS", 3)
+@mock.patch.object(env, "GS_CHAT_HISTORY_MAX_TURNS", 2)
+async def test_chat_history_window() -> None:
+    client = MockGoogleCloudStorageClient()
+    llm = _llm()
+    with mock.patch("kookaburra.gs.GsService._gs", return_value=client):
+        for i in range(11):
+            with mock.patch("time.time", return_value=i):
+                await _send(llm, i)
+
+        bucket = client._bucket
+        bucket.downloads = 0
+        history = await gs_svc.get_sms_chat_history(
+            llm, "+15555555554", max_turns=2, max_tokens=1000
+        )
+        assert history == [("in 9", "out 9"), ("in 10", "out 10")]
+        # only the head was read
+        assert bucket.downloads == 1
+
+        bucket.downloads = 0
+        history = await gs_svc.get_sms_chat_history(
+            llm, "+15555555554", max_turns=4, max_tokens=1000
+        )
+        assert history == [(f"in {i}", f"out {i}") for i in range(7, 11)]
+        assert bucket.downloads == 2
+
+        # each turn is estimated at 4 tokens
+        history = await gs_svc.get_sms_chat_history(
+            llm, "+15555555554", max_turns=10, max_tokens=9
+        )
+        assert history == [("in 9", "out 9"), ("in 10", "out 10")]
+
+        llm.history_max_turns = 0
+        assert await gs_svc.get_sms_chat_history(llm, "+15555555554") == []
+
+
+def test_head_size() -> None:
+    turns = [{"_in": "x" * 5, "_out": ""} for _ in range(10)]
+    with mock.patch("kookaburra.gs.count_tokens", side_effect=len):
+        assert _head_size(turns, max_turns=3, max_tokens=100) == 3
+        # the turn over the token budget tells the reader to stop
+        assert _head_size(turns, max_turns=10, max_tokens=12) == 3
+        assert _head_size(turns[:2], max_turns=10, max_tokens=100) == 2
+        assert _head_size(turns, max_turns=0, max_tokens=100) == 0
+
+
+async def test_chat_history_window_legacy() -> None:
+    client = MockGoogleCloudStorageClient()
+    llm = _llm()
+    prefix = gs_svc._prefix(str(llm.id), "+15555555554")
+    for i in range(20):
+        client._bucket.blob(f"{prefix}/{i}/chat.json").upload_from_string(
+            json.dumps({"_in": f"in {i}", "_out": f"out {i}", "timestamp": i})
+        )
+    with mock.patch("kookaburra.gs.GsService._gs", return_value=client):
+        client._bucket.downloads = 0
+        history = await gs_svc.get_sms_chat_history(
+            llm, "+15555555554", max_turns=3, max_tokens=1000
+        )
+        assert history == [(f"in {i}", f"out {i}") for i in range(17, 20)]
+        assert client._bucket.downloads == 3
+
+
+async def test_chat_write_conflicts() -> None:
+    client = MockGoogleCloudStorageClient()
+    with mock.patch("kookaburra.gs.GsService._gs", return_value=client):
+        with mock.patch.object(
+            gs_svc, "_write_head", side_effect=PreconditionFailed("head.json")
+        ):
+            with pytest.raises(KookaburraException):
+                await _send(_llm(), 0)
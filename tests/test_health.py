@@ -1,9 +1,11 @@
 import os
+from unittest import mock
 
 from httpx import AsyncClient
 
 from kookaburra import __version__
 from kookaburra.const import API_V0
+from kookaburra.settings import env
 
 
 async def test_tz() -> None:
@@ -15,3 +17,22 @@ async def test_healthcheck(server: AsyncClient) -> None:
     assert response.status_code == 200
     assert response.json()["message"] == "🪶"
     assert response.json()["version"] == __version__
+
+
+async def test_metrics(server: AsyncClient) -> None:
+    # off without a token
+    response = await server.get(f"{API_V0}/metrics")
+    assert response.status_code == 403
+
+    with mock.patch.object(env, "METRICS_TOKEN", "token"):
+        response = await server.get(f"{API_V0}/metrics")
+        assert response.status_code == 403
+        response = await server.get(
+            f"{API_V0}/metrics", headers={"Authorization": "Bearer wrong"}
+        )
+        assert response.status_code == 403
+        response = await server.get(
+            f"{API_V0}/metrics", headers={"Authorization": "Bearer token"}
+        )
+    assert response.status_code == 200
+    assert isinstance(response.json()["metrics"], list)
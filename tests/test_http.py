@@ -0,0 +1,99 @@
+import asyncio
+from typing import AsyncIterator
+from unittest import mock
+
+import httpx
+import pytest
+
+from kookaburra.http import http_clients
+from kookaburra.metrics import metrics
+from kookaburra.settings import env
+
+
+async def _content() -> AsyncIterator[bytes]:
+    yield b'{"message": "hello world!"}'
+
+
+def _handler(request: httpx.Request) -> httpx.Response:
+    # a streamed body, like a real transport would return
+    return httpx.Response(200, content=_content())
+
+
+@mock.patch(
+    "kookaburra.http.HttpClients._transport",
+    return_value=httpx.MockTransport(_handler),
+)
+async def test_http_clients(mock_transport: mock.MagicMock) -> None:
+    client = http_clients.get("https://kookaburracodes--a--api.modal.run/")
+    assert client is http_clients.get("https://kookaburracodes--a--api.modal.run/hey")
+    assert client is not http_clients.get("https://kookaburracodes--b--api.modal.run/")
+
+    host = "kookaburracodes--a--api.modal.run"
+    requests = metrics.get("http_requests", host=host)
+    async with client.stream(
+        "POST", "https://kookaburracodes--a--api.modal.run/hey"
+    ) as response:
+        assert metrics.get("http_pool_in_flight", host=host) == 1
+        await response.aread()
+    assert response.json() == {"message": "hello world!"}
+    assert metrics.get("http_pool_in_flight", host=host) == 0
+    assert metrics.get("http_requests", host=host) == requests + 1
+
+    await http_clients.close()
+    assert client.is_closed
+    assert http_clients.get("https://kookaburracodes--a--api.modal.run/") is not client
+    await http_clients.close()
+
+
+def _error_handler(request: httpx.Request) -> httpx.Response:
+    raise httpx.ConnectError("connection refused", request=request)
+
+
+@mock.patch.object(env, "HTTP_MAX_CONNECTIONS_PER_HOST", 1)
+async def test_http_clients_saturation() -> None:
+    host = "kookaburracodes--c--api.modal.run"
+    with mock.patch(
+        "kookaburra.http.HttpClients._transport",
+        return_value=httpx.MockTransport(_handler),
+    ):
+        client = http_clients.get(f"https://{host}/")
+    async with client.stream("POST", f"https://{host}/hey"):
+        async with client.stream("POST", f"https://{host}/hey"):
+            assert metrics.get("http_pool_saturation", host=host) == 2
+    assert metrics.get("http_pool_waits", host=host) == 1
+
+    host = "kookaburracodes--d--api.modal.run"
+    with mock.patch(
+        "kookaburra.http.HttpClients._transport",
+        return_value=httpx.MockTransport(_error_handler),
+    ):
+        client = http_clients.get(f"https://{host}/")
+    with pytest.raises(httpx.ConnectError):
+        await client.post(f"https://{host}/hey")
+    assert metrics.get("http_pool_in_flight", host=host) == 0
+    await http_clients.close()
+
+
+@mock.patch.object(env, "HTTP_MAX_HOSTS", 2)
+@mock.patch(
+    "kookaburra.http.HttpClients._transport",
+    return_value=httpx.MockTransport(_handler),
+)
+async def test_http_clients_evicted(mock_transport: mock.MagicMock) -> None:
+    a = http_clients.get("https://kookaburracodes--e--api.modal.run/")
+    b = http_clients.get("https://kookaburracodes--f--api.modal.run/")
+    assert http_clients.get("https://kookaburracodes--e--api.modal.run/") is a
+    evicted = metrics.get("http_clients_evicted")
+
+    # the least recently used client is closed, unless it is busy
+    async with b.stream("POST", "https://kookaburracodes--f--api.modal.run/hey"):
+        http_clients.get("https://kookaburracodes--g--api.modal.run/")
+        await asyncio.sleep(0)
+        assert a.is_closed
+        assert not b.is_closed
+        assert metrics.get("http_clients_evicted") == evicted + 1
+        http_clients.get("https://kookaburracodes--h--api.modal.run/")
+        assert http_clients.get("https://kookaburracodes--f--api.modal.run/") is b
+    assert metrics.get("http_clients_evicted") == evicted + 2
+    assert b.timeout.write == env.HTTP_WRITE_TIMEOUT_SECONDS
+    await http_clients.close()
@@ -0,0 +1,288 @@
+import urllib.parse
+from datetime import datetime, timedelta
+from typing import Tuple
+from unittest import mock
+
+import pytest
+from httpx import AsyncClient
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from kookaburra.const import (
+    API_V0,
+    JOB_FAILED,
+    JOB_QUEUED,
+    JOB_SUCCEEDED,
+    SMS_INGEST_QUEUE,
+    WAKING_UP_MESSAGE,
+)
+from kookaburra.exc import KookaburraException
+from kookaburra.idle import IdleService, idle_svc
+from kookaburra.llm import llm_svc
+from kookaburra.metrics import metrics
+from kookaburra.models import DeployJob, GitHubUser, GitHubUserCreate, Llm, SmsJob
+from kookaburra.settings import env
+from kookaburra.sms import sms_svc
+from kookaburra.types import BaseResponse
+
+IDLE = datetime.utcnow() - timedelta(days=env.IDLE_STOP_DAYS + 1)
+
+
+def _push(sha: str) -> dict:
+    return {
+        "ref": "refs/heads/main",
+        "after": sha,
+        "repository": {
+            "full_name": "user/app",
+            "clone_url": "https://github.com/user/app.git",
+            "default_branch": "main",
+        },
+    }
+
+
+async def _deployed(psql: AsyncSession) -> Tuple[GitHubUser, Llm]:
+    user = GitHubUser(
+        **GitHubUserCreate(username="user", emails=["user@example.com"]).dict()
+    )
+    psql.add(user)
+    await psql.commit()
+    llm = await llm_svc.create(
+        clone_url="https://github.com/user/app.git",
+        psql=psql,
+        user=user,
+        phone_number="+15555555555",
+    )
+    await llm_svc.cutover(llm, f"{llm.id}-b", "sha1", psql)
+    await llm_svc.cutover(llm, f"{llm.id}-g", "sha2", psql)
+    for sha in ["sha1", "sha2"]:
+        psql.add(
+            DeployJob(
+                githubuser_id=user.id,
+                full_name="user/app",
+                ref="refs/heads/main",
+                sha=sha,
+                payload=_push(sha),
+                status=JOB_SUCCEEDED,
+            )
+        )
+    llm.last_active_at = IDLE
+    psql.add(llm)
+    await psql.commit()
+    return user, llm
+
+
+async def test_flush(async_db_session: AsyncSession) -> None:
+    _, llm = await _deployed(async_db_session)
+    svc = IdleService()
+    assert await svc.flush() is False
+
+    now = datetime.utcnow()
+    svc.record_activity(llm, now=now - timedelta(minutes=1))
+    svc.record_activity(llm, now=now)
+    with mock.patch("kookaburra.idle.psql_session", side_effect=Exception("down")):
+        with pytest.raises(Exception):
+            await svc.flush()
+    # kept for the next flush
+    assert svc._pending == {llm.id: now}
+
+    flushed = metrics.get("llm_activity_flushed")
+    assert await svc.flush() is False
+    assert svc._pending == {}
+    assert metrics.get("llm_activity_flushed") == flushed + 1
+    await async_db_session.refresh(llm)
+    assert llm.last_active_at == now
+    # messages per hour of the day add up across flushes
+    assert llm.active_hours is not None and sum(llm.active_hours) == 2
+    svc.record_activity(llm, now=now)
+    await svc.flush()
+    await async_db_session.refresh(llm)
+    assert llm.active_hours is not None and len(llm.active_hours) == 24
+    assert sum(llm.active_hours) == 3
+    assert llm.active_hours[now.hour] >= 2
+
+    # older activity from another process doesn't go back in time
+    svc.record_activity(llm, now=now - timedelta(hours=1))
+    await svc.flush()
+    await async_db_session.refresh(llm)
+    assert llm.last_active_at == now
+
+
+@mock.patch("kookaburra.reconciler.deploy_svc.stop_modal_app")
+async def test_stop_idle(
+    mock_stop: mock.MagicMock,
+    async_db_session: AsyncSession,
+) -> None:
+    _, llm = await _deployed(async_db_session)
+    # an llm that can't be revived is left running
+    legacy = Llm(
+        phone_number="+15555555556",
+        modal_url="https://example.org",
+        clone_url="https://github.com/user/legacy.git",
+        githubuser_id=llm.githubuser_id,
+        deployed_sha="sha0",
+        created_at=IDLE,
+    )
+    async_db_session.add(legacy)
+    await async_db_session.commit()
+
+    mock_stop.side_effect = KookaburraException("modal is down")
+    assert await idle_svc.stop_idle() is False
+    await async_db_session.refresh(llm)
+    assert llm.idle_stopped_at is None
+
+    mock_stop.reset_mock(side_effect=True)
+    assert await idle_svc.stop_idle() is True
+    assert {c.args[0] for c in mock_stop.call_args_list} == {
+        f"{llm.id}-g",
+        f"{llm.id}-b",
+    }
+    await async_db_session.refresh(llm)
+    assert llm.idle_stopped_at is not None
+    assert llm.previous_app_name is None
+    assert llm.tree_hash is None
+    assert await idle_svc.stop_idle() is False
+
+
+async def test_wake(async_db_session: AsyncSession) -> None:
+    _, llm = await _deployed(async_db_session)
+    assert await idle_svc.wake(llm.id, async_db_session) is False
+    await async_db_session.commit()
+
+    await llm_svc.mark_idle(llm, async_db_session)
+    assert await idle_svc.wake(llm.id, async_db_session) is True
+    job = (
+        (
+            await async_db_session.execute(
+                select(DeployJob).where(DeployJob.status == JOB_QUEUED)
+            )
+        )
+        .scalars()
+        .one()
+    )
+    # the commit the llm served, not the latest deploy job
+    assert job.payload == _push("sha2")
+    # one revival at a time
+    assert await idle_svc.wake(llm.id, async_db_session) is False
+    await async_db_session.commit()
+
+    # the revival deploys to the slot that isn't stopped, and nothing drains
+    app_name = await llm_svc.next_app_name(llm, async_db_session)
+    await llm_svc.cutover(llm, app_name, "sha2", async_db_session)
+    assert llm.app_name == f"{llm.id}-b"
+    assert llm.previous_app_name is None
+    assert llm.idle_stopped_at is None
+    assert llm.waking_at is None
+
+    await llm_svc.mark_idle(llm, async_db_session)
+    await async_db_session.execute(DeployJob.__table__.delete())  # type: ignore
+    with pytest.raises(KookaburraException):
+        await idle_svc.wake(llm.id, async_db_session)
+    await async_db_session.rollback()
+
+
+@mock.patch("kookaburra.sms.twilio_svc.send_message")
+@mock.patch(
+    "kookaburra.sms.SmsService.reply",
+    return_value={"respond_ms": 1},
+)
+async def test_sms_hold(
+    mock_reply: mock.MagicMock,
+    mock_twilio: mock.MagicMock,
+    async_db_session: AsyncSession,
+) -> None:
+    _, llm = await _deployed(async_db_session)
+    await llm_svc.mark_idle(llm, async_db_session)
+    await sms_svc.enqueue(
+        llm=llm,
+        body={"From": "+15555555554", "To": llm.phone_number, "Body": "hi"},
+        psql=async_db_session,
+    )
+
+    assert await sms_svc.process_next() is True
+    mock_twilio.assert_called_once_with(
+        from_number=llm.phone_number,
+        to_number="+15555555554",
+        message=WAKING_UP_MESSAGE,
+    )
+    mock_reply.assert_not_called()
+    job = (await async_db_session.execute(select(SmsJob))).scalars().one()
+    assert job.status == JOB_QUEUED
+    assert job.attempts == 0
+    assert job.waiting_since is not None
+
+    # still waking up, "waking up" is sent once
+    job.run_after = datetime.utcnow()
+    async_db_session.add(job)
+    await async_db_session.commit()
+    assert await sms_svc.process_next() is True
+    mock_twilio.assert_called_once()
+    assert (
+        len(
+            (
+                await async_db_session.execute(
+                    select(DeployJob).where(DeployJob.status == JOB_QUEUED)
+                )
+            )
+            .scalars()
+            .all()
+        )
+        == 1
+    )
+
+    # answered once it is redeployed
+    await llm_svc.cutover(llm, f"{llm.id}-b", "sha2", async_db_session)
+    job.run_after = datetime.utcnow()
+    async_db_session.add(job)
+    await async_db_session.commit()
+    assert await sms_svc.process_next() is True
+    mock_reply.assert_called_once()
+    await async_db_session.refresh(job)
+    assert job.status == JOB_SUCCEEDED
+    assert job.attempts == 1
+
+
+@mock.patch("kookaburra.sms.twilio_svc.send_message")
+async def test_sms_hold_timeout(
+    mock_twilio: mock.MagicMock,
+    async_db_session: AsyncSession,
+) -> None:
+    _, llm = await _deployed(async_db_session)
+    await llm_svc.mark_idle(llm, async_db_session)
+    await sms_svc.enqueue(
+        llm=llm,
+        body={"From": "+15555555554", "To": llm.phone_number, "Body": "hi"},
+        psql=async_db_session,
+    )
+    job = (await async_db_session.execute(select(SmsJob))).scalars().one()
+    job.waiting_since = datetime.utcnow() - timedelta(
+        seconds=env.REVIVE_TIMEOUT_SECONDS + 1
+    )
+    async_db_session.add(job)
+    await async_db_session.commit()
+    assert await sms_svc.process_next() is True
+    mock_twilio.assert_not_called()
+    await async_db_session.refresh(job)
+    assert job.status == JOB_FAILED
+    assert job.last_error is not None
+    assert "didn't wake up" in job.last_error
+
+
+@mock.patch("kookaburra.api.sms_svc.reply")
+async def test_sms_stopped_llm_is_queued(
+    mock_reply: mock.MagicMock,
+    server: AsyncClient,
+    async_db_session: AsyncSession,
+) -> None:
+    _, llm = await _deployed(async_db_session)
+    await llm_svc.mark_idle(llm, async_db_session)
+    body = {"From": "+15555555554", "To": llm.phone_number, "Body": "hi"}
+    data = "&".join(f"{k}={urllib.parse.quote(v)}" for k, v in body.items())
+
+    # even when inbound SMS are answered inline
+    assert env.SMS_INGEST_MODE != SMS_INGEST_QUEUE
+    response = await server.post(f"{API_V0}/sms", data=data)  # type: ignore
+    assert response.status_code == 200
+    assert response.json() == BaseResponse(message="🪶").dict()
+    mock_reply.assert_not_called()
+    job = (await async_db_session.execute(select(SmsJob))).scalars().one()
+    assert (job.llm_id, job.status, job.body) == (llm.id, JOB_QUEUED, "hi")
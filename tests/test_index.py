@@ -0,0 +1,211 @@
+import hashlib
+import json
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import pytest
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+
+from kookaburra_deployment import index as index_module
+from kookaburra_deployment.index import (
+    CURRENT,
+    _normalize,
+    _top_k,
+    build,
+    document_hash,
+    load_index,
+)
+
+
+class FakeEmbeddings(Embeddings):
+    """Random, but the same vector for the same text."""
+
+    model = "fake"
+
+    def __init__(self, dim: int = 8) -> None:
+        self.dim = dim
+        self.embedded: List[str] = []
+
+    def embed_query(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf8")).digest()[:4], "big")
+        return list(np.random.default_rng(seed).normal(size=self.dim))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.embedded.extend(texts)
+        return [self.embed_query(text) for text in texts]
+
+
+def _docs(*texts: str) -> List[Document]:
+    return [
+        Document(page_content=text, metadata={"i": i}) for i, text in enumerate(texts)
+    ]
+
+
+def _texts(root: Path, sha: str) -> Optional[List[str]]:
+    index = load_index(root, sha=sha)
+    if index is None:
+        return None
+    return [d["page_content"] for d in index.documents]
+
+
+def test_build_pins_each_commit(tmp_path: Path) -> None:
+    embeddings = FakeEmbeddings()
+    first = build(_docs("a", "bb"), embeddings, tmp_path, sha="sha1", keep=[])
+    second = build(_docs("a", "ccc"), embeddings, tmp_path, sha="sha2", keep=["sha1"])
+    # the serving version keeps its index while the next one is deployed
+    assert _texts(tmp_path, "sha1") == ["a", "bb"]
+    assert _texts(tmp_path, "sha2") == ["a", "ccc"]
+
+    # sha2 failed its health check, so the next deploy still keeps sha1
+    build(_docs("dddd"), embeddings, tmp_path, sha="sha3", keep=["sha1"])
+    assert _texts(tmp_path, "sha1") == ["a", "bb"]
+    assert _texts(tmp_path, "sha3") == ["dddd"]
+    assert _texts(tmp_path, "sha2") is None
+    assert not (tmp_path / f"{second['key']}.json").exists()
+    assert sorted(p.name for p in tmp_path.glob("current*")) == [
+        "current-sha1.json",
+        "current-sha3.json",
+    ]
+    # cached embeddings no kept index uses are pruned too
+    assert len(list((tmp_path / "embeddings").glob("*/*.npy"))) == 3
+
+    build(_docs("a", "bb"), embeddings, tmp_path, sha="sha4", keep=["sha3"])
+    assert not (tmp_path / "current-sha1.json").exists()
+    assert (tmp_path / f"{first['key']}.json").exists()
+    assert len(list((tmp_path / "embeddings").glob("*/*.npy"))) == 3
+
+
+def test_build_keeps_legacy_index(tmp_path: Path) -> None:
+    embeddings = FakeEmbeddings()
+    legacy = build(_docs("a", "bb"), embeddings, tmp_path, sha="sha0", keep=[])
+    # an index built before per-commit pointers
+    (tmp_path / "current-sha0.json").rename(tmp_path / CURRENT)
+    meta = json.loads((tmp_path / f"{legacy['key']}.json").read_text())
+    del meta["hashes"]
+    (tmp_path / f"{legacy['key']}.json").write_text(json.dumps(meta))
+
+    build(_docs("ccc"), embeddings, tmp_path, sha="sha1", keep=["sha0"])
+    assert _texts(tmp_path, "sha0") == ["a", "bb"]
+    assert len(list((tmp_path / "embeddings").glob("*/*.npy"))) == 3
+
+    build(_docs("ccc"), embeddings, tmp_path, sha="sha2", keep=["sha1"])
+    assert not (tmp_path / CURRENT).exists()
+    assert not (tmp_path / f"{legacy['key']}.json").exists()
+    assert len(list((tmp_path / "embeddings").glob("*/*.npy"))) == 1
+    assert _texts(tmp_path, "sha0") is None
+
+
+def test_document_hash() -> None:
+    a, b = _docs("a", "a")
+    # the same text with other metadata is another document
+    assert document_hash(a) != document_hash(b)
+    assert document_hash(a) == document_hash(
+        Document(page_content="a", metadata={"i": 0})
+    )
+
+
+def test_top_k() -> None:
+    scores = np.array([[0.1, 0.9, 0.5, 0.7], [0.4, 0.3, 0.2, 0.1]])
+    best, columns = _top_k(scores, 2)
+    assert columns.tolist() == [[1, 3], [0, 1]]
+    assert best.tolist() == [[0.9, 0.7], [0.4, 0.3]]
+    # k is capped at the number of columns
+    assert _top_k(scores, 10)[1].shape == (2, 4)
+    best, columns = _top_k(scores, 0)
+    assert best.shape == columns.shape == (2, 0)
+    assert columns.dtype == np.int64
+
+
+def test_build_embeds_changed_documents(tmp_path: Path) -> None:
+    embeddings = FakeEmbeddings()
+    texts = [f"document {i}" for i in range(10)]
+    built = build(_docs(*texts), embeddings, tmp_path, sha="sha1", keep=[])
+    assert (built["embedded"], built["reused"]) == (10, 0)
+
+    embeddings.embedded.clear()
+    texts[3] = "changed"
+    built = build(_docs(*texts), embeddings, tmp_path, sha="sha2", keep=["sha1"])
+    assert (built["embedded"], built["reused"]) == (1, 9)
+    assert embeddings.embedded == ["changed"]
+
+    # the same documents are the same artifact
+    assert (
+        build(_docs(*texts), embeddings, tmp_path, sha="sha3", keep=["sha2"])["key"]
+        == built["key"]
+    )
+
+    with pytest.raises(ValueError):
+        build([], embeddings, tmp_path, sha="sha4")
+    with pytest.raises(ValueError):
+        build(_docs("a"), embeddings, tmp_path, dtype="int8", sha="sha4")
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16"])
+def test_search(tmp_path: Path, dtype: str) -> None:
+    embeddings = FakeEmbeddings()
+    texts = [f"document {i}" for i in range(200)]
+    documents = _docs(*texts)
+    matrix = _normalize(np.array(embeddings.embed_documents(texts)))
+    queries = np.array([embeddings.embed_query(f"query {i}") for i in range(5)])
+    exact = np.argsort(-(_normalize(queries) @ matrix.T), axis=1)[:, :3]
+
+    build(documents, embeddings, tmp_path, dtype=dtype, n_lists=0, sha="flat")
+    flat = load_index(tmp_path, sha="flat")
+    assert flat is not None and flat.centroids is None
+    assert flat.matrix.dtype == np.dtype(dtype)
+    scores, ids = flat.search(queries, k=3)
+    assert ids.tolist() == exact.tolist()
+    assert np.all(np.diff(scores, axis=1) <= 0)
+    assert [flat.documents[i]["page_content"] for i in ids[0]] == [
+        texts[i] for i in exact[0]
+    ]
+    # fewer rows than k are padded
+    scores, ids = flat.search(queries[0], k=300)
+    assert ids.shape == (1, 200)
+
+    build(documents, embeddings, tmp_path, dtype=dtype, n_lists=8, sha="ivf")
+    ivf = load_index(tmp_path, sha="ivf")
+    assert ivf is not None and ivf.centroids is not None and ivf.offsets is not None
+    assert ivf.centroids.shape == (8, embeddings.dim)
+    # every row is in exactly one list, stored contiguously
+    assert ivf.offsets[0] == 0 and ivf.offsets[-1] == len(texts)
+    assert np.all(np.diff(ivf.offsets) >= 0)
+    assert sorted(d["page_content"] for d in ivf.documents) == sorted(texts)
+    lists = np.argmax(
+        np.asarray(ivf.matrix, dtype=np.float32) @ ivf.centroids.T, axis=1
+    )
+    assert np.all(np.diff(lists) >= 0)
+
+    # probing every list finds what the exhaustive search finds
+    scores, ids = ivf.search(queries, k=3, n_probe=8)
+    assert [[ivf.documents[i]["page_content"] for i in row] for row in ids] == [
+        [texts[i] for i in row] for row in exact
+    ]
+    # a query with fewer candidates than k is padded with -1
+    scores, ids = ivf.search(queries[:1], k=len(texts), n_probe=1)
+    nearest = int(np.argmax(_normalize(queries[:1]) @ ivf.centroids.T))
+    size = ivf.offsets[nearest + 1] - ivf.offsets[nearest]
+    assert np.all(ids[0, :size] >= 0)
+    assert np.all(ids[0, size:] == -1)
+    assert np.all(np.isneginf(scores[0, size:]))
+
+
+def test_search_blocks(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    embeddings = FakeEmbeddings()
+    texts = [f"document {i}" for i in range(50)]
+    queries = np.array([embeddings.embed_query(f"query {i}") for i in range(3)])
+    build(_docs(*texts), embeddings, tmp_path, n_lists=0, sha="sha1")
+    index = load_index(tmp_path, sha="sha1")
+    assert index is not None
+    expected = index.search(queries, k=5)
+    # the best rows of each block are merged into the best rows overall
+    monkeypatch.setattr(index_module, "SEARCH_BLOCK_ROWS", 7)
+    scores, ids = index.search(queries, k=5)
+    assert ids.tolist() == expected[1].tolist()
+    assert np.allclose(scores, expected[0])
+
+
+def test_load_index_missing(tmp_path: Path) -> None:
+    assert load_index(tmp_path, sha="sha1") is None
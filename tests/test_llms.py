@@ -1,16 +1,26 @@
+import asyncio
 import base64
 import json
 import time
+from typing import Any, AsyncIterator
 from unittest import mock
 from uuid import uuid4
 
+import httpx
+import pytest
 from httpx import AsyncClient
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-from kookaburra.const import API_V0
+from kookaburra.breaker import breakers
+from kookaburra.const import API_V0, BREAKER_CLOSED, BREAKER_OPEN
+from kookaburra.exc import KookaburraException
+from kookaburra.http import http_clients
 from kookaburra.llm import llm_svc
+from kookaburra.metrics import metrics
 from kookaburra.models import GitHubUser, GitHubUserCreate, Llm, LLMCreate
-from kookaburra.types import GitHubUserAuthToken
+from kookaburra.reconciler import modal_reconciler
+from kookaburra.settings import env
+from kookaburra.types import BaseResponse, GitHubUserAuthToken
 from kookaburra.utils import _encrypt
 
 
@@ -20,12 +30,14 @@ async def test_get_llm_no_user(server: AsyncClient) -> None:
     assert response.json() == {"detail": "Please sign up!"}
 
 
+@mock.patch("kookaburra.reconciler.deploy_svc.stop_modal_app")
 @mock.patch(
     "kookaburra.llm.twilio_svc.release_phone_number",
     return_value=None,
 )
 async def test_delete_llm(
     mock_release_phone_number: mock.MagicMock,
+    mock_stop_modal_app: mock.MagicMock,
     server: AsyncClient,
     async_db_session: AsyncSession,
 ) -> None:
@@ -49,6 +61,9 @@ async def test_delete_llm(
         llm = Llm(**llm_Create.dict())
         async_db_session.add(llm)
         await async_db_session.commit()
+    llm.app_name, llm.previous_app_name = f"{llm.id}-b", f"{llm.id}-g"
+    async_db_session.add(llm)
+    await async_db_session.commit()
 
     kb_auth_token = _encrypt(
         base64.b64encode(
@@ -67,6 +82,13 @@ async def test_delete_llm(
         f"{API_V0}/llm/{llm.id}", cookies={"kb_auth_token": kb_auth_token}
     )
     assert response.status_code == 200
+    # the app is stopped with the llm, after the response
+    await modal_reconciler.close()
+    # only the apps the llm records, not its legacy name
+    assert {c.args[0] for c in mock_stop_modal_app.call_args_list} == {
+        f"{llm.id}-b",
+        f"{llm.id}-g",
+    }
 
 
 @mock.patch(
@@ -176,10 +198,304 @@ async def test_create_llm(
     assert llm is not None
     assert llm.id is not None
     assert llm.phone_number == "+15555555555"
-    assert llm.modal_url == f"https://kookaburracodes--{llm.id}--api.modal.run/"
+    assert llm.modal_url == f"https://kookaburracodes--{llm.id}-b--api.modal.run/"
     assert llm.clone_url == "https://github.com"
 
     _llm = await llm_svc.get_by_clone_url(
         clone_url="https://github.com", psql=async_db_session
     )
     assert _llm == llm
+
+
+async def test_update_llm(
+    server: AsyncClient,
+    async_db_session: AsyncSession,
+) -> None:
+    async with async_db_session.begin():
+        ghuser_create = GitHubUserCreate(
+            username="user",
+            emails=["user@example.com"],
+        )
+        user = GitHubUser(**ghuser_create.dict())
+        async_db_session.add(user)
+        await async_db_session.commit()
+        assert user.id is not None
+
+    llm = await llm_svc.create(
+        clone_url="https://github.com",
+        psql=async_db_session,
+        user=user,
+        phone_number="+15555555555",
+    )
+    assert llm.history_max_turns is None
+
+    kb_auth_token = _encrypt(
+        base64.b64encode(
+            json.dumps(
+                GitHubUserAuthToken(
+                    display_name="user",
+                    emails=["user@example.com"],
+                    raw_data={"login": "user"},
+                    expiry=time.time() + 30,
+                ).dict()
+            ).encode("utf8")
+        )
+    ).decode()
+
+    response = await server.patch(
+        f"{API_V0}/llm/{llm.id}",
+        json={"history_max_turns": 10, "history_max_tokens": 500},
+        cookies={"kb_auth_token": kb_auth_token},
+    )
+    assert response.status_code == 200
+    await async_db_session.refresh(llm)
+    assert llm.history_max_turns == 10
+    assert llm.history_max_tokens == 500
+
+    response = await server.patch(
+        f"{API_V0}/llm/{llm.id}",
+        json={"history_max_turns": -1},
+        cookies={"kb_auth_token": kb_auth_token},
+    )
+    assert response.status_code == 422
+
+    response = await server.patch(
+        f"{API_V0}/llm/{uuid4()}",
+        json={"history_max_turns": 10},
+        cookies={"kb_auth_token": kb_auth_token},
+    )
+    assert response.status_code == 400
+
+    response = await server.patch(
+        f"{API_V0}/llm/{llm.id}",
+        json={"history_max_turns": 10},
+    )
+    assert response.status_code == 403
+
+
+@mock.patch(
+    "kookaburra.llm.LlmService._respond",
+    return_value=BaseResponse(message="9 to 5"),
+)
+async def test_respond_cache(
+    mock_respond: mock.MagicMock,
+    async_db_session: AsyncSession,
+) -> None:
+    async with async_db_session.begin():
+        ghuser_create = GitHubUserCreate(
+            username="user",
+            emails=["user@example.com"],
+        )
+        user = GitHubUser(**ghuser_create.dict())
+        async_db_session.add(user)
+        await async_db_session.commit()
+        assert user.id is not None
+
+    llm = await llm_svc.create(
+        clone_url="https://github.com",
+        psql=async_db_session,
+        user=user,
+        phone_number="+15555555555",
+    )
+    await llm_svc.respond(llm=llm, message="hours?")
+    await llm_svc.respond(llm=llm, message="hours?")
+    assert mock_respond.call_count == 2
+
+    llm.response_cache_enabled = True
+    await llm_svc.cutover(llm, f"{llm.id}-b", "a", async_db_session)
+    for _ in range(3):
+        response = await llm_svc.respond(llm=llm, message="Hours?")
+        assert response.message == "9 to 5"
+    assert mock_respond.call_count == 3
+
+    # a redeploy invalidates the cache
+    await llm_svc.cutover(llm, f"{llm.id}-g", "b", async_db_session)
+    await llm_svc.respond(llm=llm, message="hours?")
+    assert mock_respond.call_count == 4
+
+
+@mock.patch.object(env, "LLM_BREAKER_FAILURES", 2)
+@mock.patch.object(env, "LLM_BREAKER_COOLDOWN_SECONDS", 0.05)
+@mock.patch.object(env, "LLM_FALLBACK_MESSAGE", "Sorry, try again later.")
+@mock.patch("kookaburra.llm.LlmService._respond")
+async def test_respond_breaker(mock_respond: mock.MagicMock) -> None:
+    llm = Llm(
+        id=uuid4(),
+        phone_number="+15555555555",
+        modal_url="https://example.com",
+        clone_url="https://github.com",
+    )
+    health = breakers.get(str(llm.id))
+    mock_respond.side_effect = Exception("this is an exception")
+    for _ in range(2):
+        response = await llm_svc.respond(llm=llm, message="hours?")
+        assert response.message == env.LLM_FALLBACK_MESSAGE
+    assert health.state == BREAKER_OPEN
+    assert mock_respond.call_count == 2
+
+    # while open, the backend is not called at all
+    await llm_svc.respond(llm=llm, message="hours?")
+    assert mock_respond.call_count == 2
+    assert metrics.get("llm_fallbacks", llm_id=str(llm.id)) == 3
+
+    # a failed probe opens the circuit again
+    time.sleep(0.05)
+    await llm_svc.respond(llm=llm, message="hours?")
+    assert mock_respond.call_count == 3
+    assert health.state == BREAKER_OPEN
+
+    # a cancelled probe opens the circuit again, instead of blocking the next
+    time.sleep(0.05)
+    mock_respond.side_effect = asyncio.CancelledError
+    with pytest.raises(asyncio.CancelledError):
+        await llm_svc.respond(llm=llm, message="hours?")
+    assert health.state == BREAKER_OPEN
+
+    # a successful probe closes it
+    time.sleep(0.05)
+    mock_respond.side_effect = None
+    mock_respond.return_value = BaseResponse(message="9 to 5")
+    response = await llm_svc.respond(llm=llm, message="hours?")
+    assert response.message == "9 to 5"
+    assert health.state == BREAKER_CLOSED
+
+    with mock.patch.object(env, "LLM_FALLBACK_MESSAGE", ""):
+        mock_respond.side_effect = Exception("this is an exception")
+        with pytest.raises(KookaburraException):
+            await llm_svc.respond(llm=llm, message="hours?")
+
+
+@mock.patch.object(env, "LLM_HEDGE", True)
+@mock.patch.object(env, "LLM_LATENCY_MIN_SAMPLES", 2)
+@mock.patch.object(env, "LLM_TIMEOUT_MIN_SECONDS", 0.1)
+@mock.patch.object(env, "LLM_TIMEOUT_P99_MULTIPLIER", 5.0)
+@mock.patch.object(env, "LLM_FALLBACK_MESSAGE", "Sorry, try again later.")
+@mock.patch("kookaburra.llm.LlmService._respond")
+async def test_respond_hedge(mock_respond: mock.MagicMock) -> None:
+    llm = Llm(
+        id=uuid4(),
+        phone_number="+15555555555",
+        modal_url="https://example.com",
+        clone_url="https://github.com",
+    )
+    delays = [0.01, 0.01, 1.0, 0.01, 0.01, 1.0, 1.0]
+
+    async def respond(*args: Any) -> BaseResponse:
+        delay = delays.pop(0)
+        await asyncio.sleep(delay)
+        return BaseResponse(message=str(delay))
+
+    mock_respond.side_effect = respond
+    for _ in range(2):
+        await llm_svc.respond(llm=llm, message="hours?")
+    health = breakers.get(str(llm.id))
+    assert health.hedge_after() is not None
+    assert health.timeout() == 0.1
+
+    # the slow request is hedged and the fast one wins
+    response = await llm_svc.respond(llm=llm, message="hours?")
+    assert response.message == "0.01"
+    assert metrics.get("llm_hedges", llm_id=str(llm.id)) == 1
+
+    # a fast first request is not hedged
+    response = await llm_svc.respond(llm=llm, message="hours?")
+    assert metrics.get("llm_hedges", llm_id=str(llm.id)) == 1
+
+    # both requests are slow, so the adaptive timeout kicks in
+    response = await llm_svc.respond(llm=llm, message="hours?")
+    assert response.message == env.LLM_FALLBACK_MESSAGE
+    assert metrics.get("llm_timeouts", llm_id=str(llm.id)) == 1
+
+
+async def _events() -> AsyncIterator[bytes]:
+    yield b'data: {"token": "9 to "}\n\n'
+    yield b'data: {"token": "5"}\n\n'
+    yield b'event: end\ndata: {"message": "9 to 5"}\n\n'
+
+
+def _stream_handler(request: httpx.Request) -> httpx.Response:
+    if json.loads(request.content)["message"] == "busy?":
+        return httpx.Response(429, json={"detail": "Too many requests."})
+    if json.loads(request.content)["message"] == "broken?":
+        return httpx.Response(500, json={"detail": "Internal server error."})
+    return httpx.Response(
+        200,
+        content=_events(),
+        headers={"content-type": "text/event-stream"},
+    )
+
+
+@mock.patch(
+    "kookaburra.http.HttpClients._transport",
+    return_value=httpx.MockTransport(_stream_handler),
+)
+async def test_chat_llm(
+    mock_transport: mock.MagicMock,
+    server: AsyncClient,
+    async_db_session: AsyncSession,
+) -> None:
+    async with async_db_session.begin():
+        ghuser_create = GitHubUserCreate(
+            username="user",
+            emails=["user@example.com"],
+        )
+        user = GitHubUser(**ghuser_create.dict())
+        async_db_session.add(user)
+        await async_db_session.commit()
+        assert user.id is not None
+
+    llm = await llm_svc.create(
+        clone_url="https://github.com",
+        psql=async_db_session,
+        user=user,
+        phone_number="+15555555555",
+    )
+    kb_auth_token = _encrypt(
+        base64.b64encode(
+            json.dumps(
+                GitHubUserAuthToken(
+                    display_name="user",
+                    emails=["user@example.com"],
+                    raw_data={"login": "user"},
+                    expiry=time.time() + 30,
+                ).dict()
+            ).encode("utf8")
+        )
+    ).decode()
+
+    response = await server.post(
+        f"{API_V0}/llm/{llm.id}/chat",
+        json={"message": "hours?", "chat_history": [["hi", "hello"]]},
+        cookies={"kb_auth_token": kb_auth_token},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.text == b"".join([e async for e in _events()]).decode()
+
+    response = await server.post(
+        f"{API_V0}/llm/{llm.id}/chat",
+        json={"message": "busy?"},
+        cookies={"kb_auth_token": kb_auth_token},
+    )
+    assert response.status_code == 429
+
+    response = await server.post(
+        f"{API_V0}/llm/{llm.id}/chat",
+        json={"message": "broken?"},
+        cookies={"kb_auth_token": kb_auth_token},
+    )
+    assert response.status_code == 502
+
+    response = await server.post(
+        f"{API_V0}/llm/{uuid4()}/chat",
+        json={"message": "hours?"},
+        cookies={"kb_auth_token": kb_auth_token},
+    )
+    assert response.status_code == 400
+
+    response = await server.post(
+        f"{API_V0}/llm/{llm.id}/chat",
+        json={"message": "hours?"},
+    )
+    assert response.status_code == 403
+    await http_clients.close()
@@ -0,0 +1,126 @@
+import asyncio
+import time
+from typing import Any
+from unittest import mock
+from uuid import uuid4
+
+from sqlalchemy import text
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from kookaburra.const import MODAL_RECONCILE_LOCK
+from kookaburra.exc import KookaburraException
+from kookaburra.metrics import metrics
+from kookaburra.models import GitHubUser, GitHubUserCreate, Llm
+from kookaburra.reconciler import ModalReconciler
+from kookaburra.settings import env
+from kookaburra.types import ModalApp
+
+OLD = time.time() - env.MODAL_RECONCILE_GRACE_SECONDS - 60
+
+
+async def _llms(psql: AsyncSession) -> list[Llm]:
+    user = GitHubUser(
+        **GitHubUserCreate(username="user", emails=["user@example.com"]).dict()
+    )
+    psql.add(user)
+    await psql.commit()
+    legacy = Llm(
+        phone_number="+15555555555",
+        modal_url="https://example.com",
+        clone_url="https://github.com/user/legacy.git",
+        githubuser_id=user.id,
+    )
+    slotted = Llm(
+        phone_number="+15555555556",
+        modal_url="https://example.org",
+        clone_url="https://github.com/user/slotted.git",
+        githubuser_id=user.id,
+    )
+    psql.add(legacy)
+    psql.add(slotted)
+    await psql.commit()
+    slotted.app_name = f"{slotted.id}-g"
+    slotted.previous_app_name = f"{slotted.id}-b"
+    psql.add(slotted)
+    await psql.commit()
+    return [legacy, slotted]
+
+
+def test_orphans() -> None:
+    reconciler = ModalReconciler()
+    orphan, young = str(uuid4()), f"{uuid4()}-b"
+    apps = [
+        ModalApp(name=orphan, created_at=OLD),
+        ModalApp(name="in-use", created_at=OLD),
+        # maybe a deploy waiting for its cutover
+        ModalApp(name=young, created_at=time.time()),
+        # not kookaburra's
+        ModalApp(name="someone-elses-app", created_at=OLD),
+    ]
+    assert reconciler.orphans(apps, {"in-use"}) == [orphan]
+
+
+async def test_reconcile(async_db_session: AsyncSession) -> None:
+    legacy, slotted = await _llms(async_db_session)
+    orphans = sorted([str(uuid4()), f"{legacy.id}-b", f"{slotted.id}-x"])
+    apps = [
+        ModalApp(name=name, created_at=OLD)
+        for name in [str(legacy.id), f"{slotted.id}-g", f"{slotted.id}-b", *orphans]
+    ]
+    reconciler = ModalReconciler()
+    stopped = []
+
+    async def _stop(app_name: str) -> None:
+        await asyncio.sleep(0)
+        if app_name == orphans[0]:
+            raise KookaburraException("modal is down")
+        stopped.append(app_name)
+
+    with mock.patch.object(reconciler, "list_apps", return_value=apps), mock.patch(
+        "kookaburra.reconciler.deploy_svc.stop_modal_app", side_effect=_stop
+    ) as mock_stop:
+        assert await reconciler.reconcile(dry_run=True) == {
+            "apps": 6,
+            "orphans": 3,
+            "stopped": 0,
+        }
+        mock_stop.assert_not_called()
+
+        assert await reconciler.reconcile(dry_run=False) == {
+            "apps": 6,
+            "orphans": 3,
+            "stopped": 2,
+        }
+    assert sorted(stopped) == orphans[1:]
+    assert metrics.get("modal_reconcile_stopped") == 2
+    assert metrics.get("modal_reconcile_ms") >= 0
+
+
+async def test_reconcile_locked(async_db_session: AsyncSession) -> None:
+    reconciler = ModalReconciler()
+    await async_db_session.execute(
+        text("SELECT pg_advisory_xact_lock(:key)"), {"key": MODAL_RECONCILE_LOCK}
+    )
+    with mock.patch.object(reconciler, "list_apps") as mock_list_apps:
+        assert await reconciler.run() is False
+    mock_list_apps.assert_not_called()
+    await async_db_session.rollback()
+
+
+async def test_stop_bounded() -> None:
+    reconciler = ModalReconciler()
+    running = 0
+    most = 0
+
+    async def _stop(app_name: Any) -> None:
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    with mock.patch(
+        "kookaburra.reconciler.deploy_svc.stop_modal_app", side_effect=_stop
+    ):
+        assert await reconciler.stop([str(i) for i in range(10)]) == 10
+    assert most == env.MODAL_RECONCILE_CONCURRENCY
@@ -0,0 +1,36 @@
+from pathlib import Path
+
+import pytest
+from langchain.docstore.document import Document
+
+from kookaburra_deployment.index import build
+from kookaburra_deployment.retriever import MemmapVectorStore
+from tests.test_index import FakeEmbeddings
+
+
+def test_memmap_vector_store(tmp_path: Path) -> None:
+    embeddings = FakeEmbeddings()
+    with pytest.raises(ValueError):
+        MemmapVectorStore.load(embeddings, root=tmp_path)
+
+    documents = [
+        Document(page_content=f"document {i}", metadata={"i": i}) for i in range(3)
+    ]
+    build(documents, embeddings, tmp_path, sha="local", keep=[])
+    store = MemmapVectorStore.load(embeddings, root=tmp_path)
+    # a document is its own nearest neighbour
+    assert store.similarity_search("document 1", k=1) == [documents[1]]
+    results = store.similarity_search_with_score("document 2", k=5)
+    assert [doc for doc, _ in results][0] == documents[2]
+    # there are only 3 documents
+    assert len(results) == 3
+    assert results[0][1] == pytest.approx(1.0, abs=1e-5)
+    assert store.similarity_search_by_vector(
+        embeddings.embed_query("document 0"), k=1
+    ) == [documents[0]]
+
+    # the store is read-only
+    with pytest.raises(TypeError, match="kookaburra_deployment.index.build"):
+        store.add_texts(["document 3"])
+    with pytest.raises(TypeError, match="read-only"):
+        MemmapVectorStore.from_texts(["document 3"], embeddings)
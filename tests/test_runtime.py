@@ -0,0 +1,51 @@
+from pathlib import Path
+from unittest import mock
+
+from kookaburra.runtime import RuntimeCache
+
+
+def test_runtime_cache(tmp_path: Path) -> None:
+    src = tmp_path / "kookaburra_deployment"
+    (src / "__pycache__").mkdir(parents=True)
+    (src / "main.py").write_text("app")
+    (src / "_modal.py").write_text("stub")
+    (src / "__pycache__" / "main.cpython-311.pyc").write_text("")
+    cache = RuntimeCache(src=str(src), root=str(tmp_path / "cache"))
+
+    deploy_root = tmp_path / "deploy"
+    (deploy_root / "main.py").mkdir(parents=True)
+    (deploy_root / "_modal.py").write_text("the app's own")
+    (deploy_root / "kookaburra.py").write_text("the app")
+    assert cache.link_into(deploy_root) == {
+        "linked": 2,
+        "copied": 0,
+        "copied_bytes": 0,
+    }
+    pristine = cache.pristine()
+    assert (deploy_root / "main.py").read_text() == "app"
+    assert (deploy_root / "_modal.py").stat().st_ino == (
+        pristine / "_modal.py"
+    ).stat().st_ino
+    assert (deploy_root / "kookaburra.py").read_text() == "the app"
+    assert not (deploy_root / "__pycache__").exists()
+
+    # a new version of the runtime replaces the old copy, once no deploy is
+    # linking from the cache
+    (src / "main.py").write_text("app v2")
+    with cache._lock(exclusive=False):
+        assert cache.prune(keep=cache.pristine()) is False
+    assert pristine.exists()
+
+    # another filesystem can't be linked to
+    with mock.patch("kookaburra.runtime.os.link", side_effect=OSError):
+        assert cache.link_into(tmp_path / "other") == {
+            "linked": 0,
+            "copied": 2,
+            "copied_bytes": len("app v2") + len("stub"),
+        }
+    assert (tmp_path / "other" / "main.py").read_text() == "app v2"
+    assert not pristine.exists()
+    assert sorted(p.name for p in (tmp_path / "cache").iterdir()) == [
+        ".lock",
+        cache.pristine().name,
+    ]
@@ -1,12 +1,23 @@
 import urllib.parse
+from typing import Any, Awaitable, Callable, Dict
 from unittest import mock
+from uuid import uuid4
 
 from httpx import AsyncClient
+from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-from kookaburra.const import API_V0
-from kookaburra.models import GitHubUser, GitHubUserCreate, Llm, LLMCreate
-from kookaburra.types import BaseResponse
+from kookaburra.const import (
+    API_V0,
+    JOB_FAILED,
+    JOB_QUEUED,
+    JOB_SUCCEEDED,
+    SMS_INGEST_QUEUE,
+)
+from kookaburra.models import GitHubUser, GitHubUserCreate, Llm, LLMCreate, SmsJob
+from kookaburra.settings import env
+from kookaburra.sms import sms_svc
+from kookaburra.types import BaseResponse, FallbackResponse
 from tests.mocks import MockGoogleCloudStorageClient
 
 
@@ -23,16 +34,16 @@ async def test_sms_no_llm(server: AsyncClient) -> None:
 
 
 @mock.patch(
-    "kookaburra.api.twilio_svc.send_message",
+    "kookaburra.sms.twilio_svc.send_message",
     return_value=None,
 )
 @mock.patch(
-    "kookaburra.api.llm_svc.respond",
+    "kookaburra.sms.llm_svc.respond",
     return_value=BaseResponse(message="hello world!"),
 )
 @mock.patch(
     "kookaburra.gs.GsService._gs",
-    return_value=MockGoogleCloudStorageClient,
+    return_value=MockGoogleCloudStorageClient(),
 )
 async def test_sms_llm(
     mock_google_storage: mock.MagicMock,
@@ -72,3 +83,226 @@ async def test_sms_llm(
     )
     response = await server.post(f"{API_V0}/sms", data=data)  # type: ignore
     assert response.status_code == 200
+
+
+@mock.patch(
+    "kookaburra.sms.twilio_svc.send_message",
+    return_value=None,
+)
+@mock.patch(
+    "kookaburra.sms.llm_svc.respond",
+    return_value=BaseResponse(message="hello world!"),
+)
+@mock.patch(
+    "kookaburra.gs.GsService._gs",
+    return_value=MockGoogleCloudStorageClient(),
+)
+@mock.patch.object(env, "SMS_INGEST_MODE", SMS_INGEST_QUEUE)
+async def test_sms_llm_queue(
+    mock_google_storage: mock.MagicMock,
+    mock_llm_respond: mock.MagicMock,
+    mock_twilio: mock.MagicMock,
+    server: AsyncClient,
+    async_db_session: AsyncSession,
+) -> None:
+    async with async_db_session.begin():
+        ghuser_create = GitHubUserCreate(
+            username="user",
+            emails=["user@example.com"],
+        )
+        user = GitHubUser(**ghuser_create.dict())
+        async_db_session.add(user)
+        await async_db_session.commit()
+        assert user.id is not None
+
+    async with async_db_session.begin():
+        llm_Create = LLMCreate(
+            phone_number="+15555555555",
+            modal_url="https://example.com",
+            clone_url="https://github.com",
+            githubuser_id=user.id,
+        )
+        llm = Llm(**llm_Create.dict())
+        async_db_session.add(llm)
+        await async_db_session.commit()
+        assert llm.id is not None
+
+    data = "&".join(
+        [
+            "To=" + urllib.parse.quote("+15555555555"),
+            "From=" + urllib.parse.quote("+15555555554"),
+            "Body=" + urllib.parse.quote("Hello world"),
+            "MessageSid=" + urllib.parse.quote("SM123"),
+        ]
+    )
+    # twilio retries are ignored
+    for _ in range(2):
+        response = await server.post(f"{API_V0}/sms", data=data)  # type: ignore
+        assert response.status_code == 200
+    mock_llm_respond.assert_not_called()
+    mock_twilio.assert_not_called()
+
+    jobs = (await async_db_session.execute(select(SmsJob))).scalars().all()
+    assert len(jobs) == 1
+    assert jobs[0].status == JOB_QUEUED
+    assert jobs[0].llm_id == llm.id
+
+    assert await sms_svc.process_next() is True
+    assert await sms_svc.process_next() is False
+    mock_llm_respond.assert_called_once()
+    mock_twilio.assert_called_once()
+
+    await async_db_session.refresh(jobs[0])
+    assert jobs[0].status == JOB_SUCCEEDED
+    assert jobs[0].attempts == 1
+    assert jobs[0].finished_at is not None
+    assert jobs[0].respond_ms is not None
+
+
+@mock.patch(
+    "kookaburra.sms.llm_svc.respond",
+    side_effect=Exception("modal is down"),
+)
+@mock.patch(
+    "kookaburra.gs.GsService._gs",
+    return_value=MockGoogleCloudStorageClient(),
+)
+async def test_sms_job_retry(
+    mock_google_storage: mock.MagicMock,
+    mock_llm_respond: mock.MagicMock,
+    async_db_session: AsyncSession,
+) -> None:
+    async with async_db_session.begin():
+        ghuser_create = GitHubUserCreate(
+            username="user",
+            emails=["user@example.com"],
+        )
+        user = GitHubUser(**ghuser_create.dict())
+        async_db_session.add(user)
+        await async_db_session.commit()
+        assert user.id is not None
+
+    async with async_db_session.begin():
+        llm_Create = LLMCreate(
+            phone_number="+15555555555",
+            modal_url="https://example.com",
+            clone_url="https://github.com",
+            githubuser_id=user.id,
+        )
+        llm = Llm(**llm_Create.dict())
+        async_db_session.add(llm)
+        await async_db_session.commit()
+        assert llm.id is not None
+
+    await sms_svc.enqueue(
+        llm=llm,
+        body={"To": "+15555555555", "From": "+15555555554", "Body": "Hello"},
+        psql=async_db_session,
+    )
+    assert await sms_svc.process_next() is True
+    # the retry is scheduled in the future
+    assert await sms_svc.process_next() is False
+
+    job = (await async_db_session.execute(select(SmsJob))).scalars().one()
+    assert job.status == JOB_QUEUED
+    assert job.attempts == 1
+    assert job.last_error is not None
+    assert job.run_after > job.created_at
+
+
+async def test_sms_job_no_llm(async_db_session: AsyncSession) -> None:
+    llm = Llm(
+        id=uuid4(),
+        phone_number="+15555555555",
+        modal_url="https://example.com",
+        clone_url="https://github.com",
+    )
+    await sms_svc.enqueue(
+        llm=llm,
+        body={"To": "+15555555555", "From": "+15555555554", "Body": "Hello"},
+        psql=async_db_session,
+    )
+    assert await sms_svc.process_next() is True
+
+    job = (await async_db_session.execute(select(SmsJob))).scalars().one()
+    assert job.status == JOB_FAILED
+    assert job.finished_at is not None
+
+
+@mock.patch("kookaburra.sms.twilio_svc.send_message")
+@mock.patch(
+    "kookaburra.sms.llm_svc.respond",
+    return_value=FallbackResponse(message="Sorry, try again later."),
+)
+@mock.patch("kookaburra.sms.gs_svc.upload_sms_chat")
+@mock.patch("kookaburra.sms.gs_svc.get_sms_chat_history", return_value=[])
+async def test_sms_fallback_not_in_history(
+    mock_history: mock.MagicMock,
+    mock_upload: mock.MagicMock,
+    mock_llm_respond: mock.MagicMock,
+    mock_twilio: mock.MagicMock,
+) -> None:
+    llm = Llm(
+        id=uuid4(),
+        phone_number="+15555555555",
+        modal_url="https://example.com",
+        clone_url="https://github.com",
+    )
+    await sms_svc.reply(
+        llm=llm,
+        body={"To": "+15555555555", "From": "+15555555554", "Body": "Hello"},
+    )
+    mock_twilio.assert_called_once_with(
+        from_number="+15555555555",
+        to_number="+15555555554",
+        message="Sorry, try again later.",
+    )
+    mock_upload.assert_not_called()
+
+
+async def test_sms_job_sent_once(async_db_session: AsyncSession) -> None:
+    user = GitHubUser(
+        **GitHubUserCreate(username="user", emails=["user@example.com"]).dict()
+    )
+    async_db_session.add(user)
+    await async_db_session.commit()
+    llm = Llm(
+        **LLMCreate(
+            phone_number="+15555555555",
+            modal_url="https://example.com",
+            clone_url="https://github.com",
+            githubuser_id=user.id,
+        ).dict()
+    )
+    async_db_session.add(llm)
+    await async_db_session.commit()
+    await sms_svc.enqueue(
+        llm=llm,
+        body={"To": "+15555555555", "From": "+15555555554", "Body": "Hello"},
+        psql=async_db_session,
+    )
+
+    async def _reply(on_sent: Callable[[], Awaitable[None]], **kwargs: Any) -> Dict:
+        # the job's transaction isn't left open during the reply
+        assert not async_db_session.in_transaction()
+        await on_sent()
+        # e.g. the job timed out after the reply was sent
+        raise TimeoutError()
+
+    with mock.patch.object(sms_svc, "reply", side_effect=_reply) as mock_reply:
+        job = await sms_svc.claim(psql=async_db_session)
+        assert job is not None
+        await sms_svc.run(job=job, psql=async_db_session)
+        await async_db_session.refresh(job)
+        assert job.status == JOB_SUCCEEDED
+        assert job.sent_at is not None
+        assert job.last_error is not None
+
+        # a reclaimed job whose reply was sent isn't sent again
+        job.status = JOB_QUEUED
+        async_db_session.add(job)
+        await async_db_session.commit()
+        assert await sms_svc.process_next() is True
+        mock_reply.assert_called_once()
+    await async_db_session.refresh(job)
+    assert job.status == JOB_SUCCEEDED
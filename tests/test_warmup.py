@@ -0,0 +1,79 @@
+from datetime import datetime, timedelta
+from typing import Any
+from unittest import mock
+from uuid import uuid4
+
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from kookaburra.metrics import metrics
+from kookaburra.models import GitHubUser, GitHubUserCreate, Llm
+from kookaburra.settings import env
+from kookaburra.warmup import WarmupService
+
+
+def _llm(**kwargs: Any) -> Llm:
+    llm_id = uuid4()
+    return Llm(
+        id=llm_id,
+        phone_number=f"+1555{llm_id.int % 10**7:07d}",
+        modal_url=f"https://{llm_id}.example.com",
+        clone_url=f"https://github.com/user/{llm_id}.git",
+        **kwargs,
+    )
+
+
+@mock.patch("kookaburra.warmup.WarmupService._ping")
+async def test_warm(mock_ping: mock.MagicMock) -> None:
+    svc = WarmupService()
+    cold_start_ms, warm_ms = await svc.warm(_llm())
+    assert mock_ping.call_count == env.WARMUP_REQUESTS
+    assert cold_start_ms >= 0
+    assert warm_ms >= 0
+
+
+@mock.patch("kookaburra.warmup.WarmupService._ping")
+async def test_keep_warm(
+    mock_ping: mock.MagicMock,
+    async_db_session: AsyncSession,
+) -> None:
+    user = GitHubUser(
+        **GitHubUserCreate(username="user", emails=["user@example.com"]).dict()
+    )
+    async_db_session.add(user)
+    await async_db_session.commit()
+    now = datetime.utcnow()
+    day_ago = now - timedelta(days=1)
+    usual = [0] * 24
+    usual[now.hour] = env.KEEP_WARM_MIN_HOURLY_MESSAGES
+    llms = {
+        "recent": _llm(last_active_at=now - timedelta(minutes=1)),
+        # usually gets messages at this time of day
+        "regular": _llm(last_active_at=day_ago, active_hours=usual),
+        "idle": _llm(last_active_at=day_ago, active_hours=[1] * 24),
+        "gone": _llm(
+            last_active_at=now - timedelta(seconds=env.KEEP_WARM_FORGET_SECONDS + 1),
+            active_hours=usual,
+        ),
+        "stopped": _llm(last_active_at=now, idle_stopped_at=now),
+    }
+    for llm in llms.values():
+        llm.githubuser_id = user.id
+        async_db_session.add(llm)
+    await async_db_session.commit()
+
+    svc = WarmupService()
+    mock_ping.side_effect = lambda modal_url: (
+        None if modal_url == llms["recent"].modal_url else Exception("cold")
+    )
+    assert await svc.keep_warm() is False
+    assert sorted(c.args[0] for c in mock_ping.call_args_list) == sorted(
+        [llms["recent"].modal_url, llms["regular"].modal_url]
+    )
+    recent, regular = str(llms["recent"].id), str(llms["regular"].id)
+    assert metrics.get("keep_warm_pings", llm_id=recent, ok="true") == 1
+    assert metrics.get("keep_warm_pings", llm_id=regular, ok="false") == 1
+
+    # pinged once per interval, however many processes keep them warm
+    assert await WarmupService().claim_due() == []
+    later = datetime.utcnow() + timedelta(seconds=env.KEEP_WARM_INTERVAL_SECONDS)
+    assert len(await svc.claim_due(now=later)) == 2
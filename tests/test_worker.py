@@ -0,0 +1,23 @@
+import asyncio
+
+from kookaburra.worker import WorkerPool
+
+
+async def test_worker_pool() -> None:
+    calls = []
+
+    async def work() -> bool:
+        calls.append(1)
+        if len(calls) == 3:
+            raise Exception("this is an exception")
+        # keep working until there is nothing left to do
+        return len(calls) < 5
+
+    pool = WorkerPool(name="test", size=2, poll_seconds=0.01, work=work)
+    pool.start()
+    pool.start()
+    assert pool.running
+    await asyncio.sleep(0.1)
+    await pool.stop()
+    assert not pool.running
+    assert len(calls) > 5